@@ -3,28 +3,65 @@ grid_step_size = .025  #: Transverse grid step size in plasma units
 
 xi_step_size = .005  #: Step size in time-space coordinate xi
 xi_steps = int(3000 // xi_step_size)  #: Amount of xi steps
+xi_step_tolerance = None  #: Adapt the xi step to this field error, see docs
+xi_step_size_min = xi_step_size / 8  #: Smallest adaptive xi step
+xi_step_size_max = xi_step_size * 8  #: Largest adaptive xi step
 
 diagnostics_each_N_steps = int(1 / xi_step_size)
+zn_each_N_steps = None  #: Track zn more often, on GPU, see docs
+noise_spectrum_bins = None  #: Also save radial ro spectra, see docs
 
 field_solver_subtraction_trick = 1  #: 0 for Laplace eqn., Helmholtz otherwise
 field_solver_variant_A = True  #: Use Variant A or Variant B for Ex, Ey, Bx, By
+field_predictor = None  #: Extrapolate the fields, 'linear' or 'quadratic'
+corrector_rounds = 2  #: Field calculation and pushing rounds per step
+
+field_patch_steps = None  #: Finer field grid size around the axis, see docs
+field_patch_refinement = 4  #: How many times finer the patch cells are
+regrid = None  #: Switch the resolution mid-run, see docs
 
 reflect_padding_steps = 5  #: Plasma reflection <-> field calculation boundaries
 plasma_padding_steps = 10  #: Plasma placement <-> field calculation boundaries
 
 plasma_coarseness = 3  #: Square root of the amount of cells per coarse particle
 plasma_fineness = 2  #: Square root of the amount of fine particles per cell
+plasma_fineness_center = None  #: Higher fineness near the axes, see docs
+plasma_fineness_center_steps = 0  #: Half-width of that region in cells
+fused_push_deposit = False  #: Push and deposit plasma tile by tile, see docs
+autotune = True  #: Use the launch shapes tuned by ``lcode_autotune.py``
+cuda_graph = False  #: Replay whole steps as CUDA graphs, see docs
 
 
 from numpy import cos, exp, pi, sqrt
 
-def beam(xi_i, x, y):
+COMPRESS, BOOST, SIGMA, SHIFT = 1, 1, 1, 0  # beam parameters, scannable
+
+def beam_profile(x, y):  # or None, if the beam changes its shape with xi
+    r = sqrt(x**2 + (y - SHIFT)**2)
+    return .05 * BOOST * exp(-.5 * (r / SIGMA)**2)
+
+def beam_amplitude(xi_i):  # scales beam_profile, the fields are precomputed
     xi = -xi_i * xi_step_size
-    COMPRESS, BOOST, SIGMA, SHIFT = 1, 1, 1, 0
     if xi < -2 * sqrt(2 * pi) / COMPRESS:
         return 0
-    r = sqrt(x**2 + (y - SHIFT)**2)
-    return (.05 * BOOST * exp(-.5 * (r / SIGMA)**2) *
-            (1 - cos(xi * COMPRESS * sqrt(pi / 2))))
+    return 1 - cos(xi * COMPRESS * sqrt(pi / 2))
+
+def beam(xi_i, x, y):  # the general form, for the batched runs
+    return beam_amplitude(xi_i) * beam_profile(x, y)
 
 gpu_index = 0  #: Index of the GPU that should perform the calculations
+slab_gpu_indices = None  #: Split the plasma between GPUs, e.g., [0, 1, 2, 3]
+
+profile = False  #: Time the phases of each step and report them at exit
+profile_trace_file = 'profile.json'  #: Chrome trace output for ``profile``
+status_file = None  #: Keep the throughput, ETA and memory usage JSON there
+status_interval = 10  #: Seconds between the ``status_file`` updates
+
+tracked_particles = None  #: Record their trajectories, see docs
+tracking_block_steps = 1000  #: Trajectory steps saved at once
+
+live_file = None  #: Publish the fields there, e.g. '/dev/shm/lcode', see docs
+live_fields = ('Ez', 'ro')  #: Which state arrays to publish
+live_each_N_steps = 10  #: How often to publish them
+
+memory_budget = None  #: GPU memory to fit into (in bytes, e.g. 4 * 2**30)
@@ -16,10 +16,20 @@
 # along with LCODE.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from math import sqrt, floor
+from math import sqrt, floor, gcd
 
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import json
 import os
+import platform
+import re
+import resource
 import sys
+import time
+import types
 
 import matplotlib.pyplot as plt
 
@@ -30,7 +40,6 @@ import numba.cuda
 
 import cupy as cp
 
-import scipy.ndimage
 import scipy.signal
 
 
@@ -119,32 +128,200 @@ class GPUArraysView:
         # TODO: just copy+reassign it without preserving identity and shape?
 
 
+# Streams and synchronization #
+
+def launch_stream():
+    """
+    The stream to launch our CUDA kernels on, the current ``cupy`` one,
+    so that they are ordered with the ``cupy`` operations around them
+    (and captured along with them, see ``CapturedStep``).
+    """
+    ptr = cp.cuda.get_current_stream().ptr
+    return numba.cuda.external_stream(ptr) if ptr else 0
+
+
+def synchronize():
+    """
+    Wait for the GPU to finish, like ``numba.cuda.synchronize`` does,
+    unless the current stream is being captured (see ``CapturedStep``),
+    where nothing is executed yet and waiting is forbidden.
+    """
+    stream = cp.cuda.get_current_stream()
+    if not stream.ptr or not stream.is_capturing():
+        numba.cuda.synchronize()
+
+
+# Optional per-phase profiling #
+
+#: Timings collected by ``profile_region`` if enabled with ``config.profile``.
+profile = {'enabled': False, 'pending': [], 'totals': {}, 'trace': []}
+
+#: Chrome trace event limit, the totals are accumulated regardless of it.
+PROFILE_TRACE_LIMIT = 1000000
+
+
+def profile_start():
+    """
+    Enable profiling and reset the collected timings.
+    """
+    profile.update(enabled=True, pending=[], totals={}, trace=[],
+                   t0=time.perf_counter(), origin=cp.cuda.Event(),
+                   device=cp.cuda.Device().id)
+    profile['origin'].record()
+
+
+def profile_add(name, tid, ts, dur):
+    """
+    Account for a single ``dur`` ms long region that started at ``ts`` ms.
+    """
+    count_total = profile['totals'].setdefault(name, [0, 0.])
+    count_total[0], count_total[1] = count_total[0] + 1, count_total[1] + dur
+    if len(profile['trace']) < PROFILE_TRACE_LIMIT:
+        profile['trace'].append({'name': name, 'ph': 'X', 'pid': 0,
+                                 'tid': tid, 'ts': ts * 1e3, 'dur': dur * 1e3})
+
+
+@contextlib.contextmanager
+def profile_region(name, gpu=True):
+    """
+    Time the enclosed code as a region called ``name`` if profiling is enabled.
+    GPU regions are timed with CUDA events, which do not stall the GPU,
+    and are only resolved into timings later on by ``profile_collect``.
+    Host regions are timed with ``time.perf_counter``, and so are the GPU ones
+    on the GPUs other than the profiled one (see ``move_deposit_slabs``,
+    these are synchronous anyway).
+    """
+    if not profile['enabled']:
+        yield
+        return
+    device = cp.cuda.Device().id
+    if gpu and device == profile['device']:
+        start, end = cp.cuda.Event(), cp.cuda.Event()
+        start.record()
+        yield
+        end.record()
+        profile['pending'].append((name, start, end))
+    else:
+        start = time.perf_counter()
+        yield
+        end = time.perf_counter()
+        profile_add(name, f'gpu {device}' if gpu else 'host',
+                    (start - profile['t0']) * 1e3, (end - start) * 1e3)
+
+
+def profiled(func):
+    """
+    Time every invocation of the decorated function with ``profile_region``.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with profile_region(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def profile_collect():
+    """
+    Convert the recorded CUDA events into timings.
+    """
+    for name, start, end in profile['pending']:
+        end.synchronize()
+        profile_add(name, 'gpu',
+                    cp.cuda.get_elapsed_time(profile['origin'], start),
+                    cp.cuda.get_elapsed_time(start, end))
+    profile['pending'].clear()
+
+
+def profile_report(config):
+    """
+    Export the timings as a Chrome trace (``chrome://tracing``, Perfetto)
+    to ``config.profile_trace_file`` and print a per-region summary.
+    """
+    profile_collect()
+    with open(config.profile_trace_file, 'w') as f:
+        json.dump({'traceEvents': profile['trace']}, f)
+
+    totals = sorted(profile['totals'].items(), key=lambda kv: -kv[1][1])
+    print(f'{"region":>24} {"calls":>8} {"total, s":>10} {"mean, ms":>10}')
+    for name, (count, total) in totals:
+        print(f'{name:>24} {count:>8} {total / 1e3:>10.3f} '
+              f'{total / count:>10.3f}')
+
+
+# Helpers for (optionally batched) 2D arrays #
+
+# All the grid-sized arrays may have leading batch dimensions,
+# so the helpers below only touch the last two, transverse, ones.
+
+def flipud(a):
+    return cp.flip(a, -2)
+
+
+def fliplr(a):
+    return cp.flip(a, -1)
+
+
+def transpose(a):
+    return a.swapaxes(-2, -1)
+
+
+def batched(a):
+    """
+    View the array as a batch of 2D arrays (adding a leading 1 if needed),
+    which is the way our CUDA kernels expect them.
+    """
+    return a.reshape((-1,) + a.shape[-2:])
+
+
+def pad_perimeter(a):
+    """
+    Pad the last two dimensions of the array with a single layer of zeroes.
+    """
+    return cp.pad(a, ((0, 0),) * (a.ndim - 2) + ((1, 1), (1, 1)), 'constant')
+
+
+def in_chunks(func, a, chunk):
+    """
+    Apply ``func`` to a batch of 2D arrays ``chunk`` of them at a time
+    (all at once if ``chunk`` is None), which caps the size of the padded
+    buffers of the transforms inside ``func`` (see ``memory_budget``).
+    A single 2D array is never split, the field solvers lower its peak
+    by solving the field components one at a time instead.
+    """
+    if chunk is None or a.ndim == 2 or a.shape[0] <= chunk:
+        return func(a)
+    return cp.concatenate([func(a[i:i + chunk])
+                           for i in range(0, a.shape[0], chunk)])
+
+
 # Solving Laplace equation with Dirichlet boundary conditions (Ez) #
 
 def dst2d(a):
     """
     Calculate DST-Type1-2D, jury-rigged from anti-symmetrically-padded rFFT.
+    Leading dimensions of ``a``, if any, are treated as a batch.
     """
-    assert a.shape[0] == a.shape[1]
-    N = a.shape[0]
+    assert a.shape[-2] == a.shape[-1]
+    N = a.shape[-1]
     #                                    / 0  0  0  0  0  0 \
     #  0  0  0  0                       |  0 /1  2\ 0 -2 -1  |
     #  0 /1  2\ 0   anti-symmetrically  |  0 \3  4/ 0 -4 -3  |
     #  0 \3  4/ 0       padded to       |  0  0  0  0  0  0  |
     #  0  0  0  0                       |  0 -3 -4  0 +4 +3  |
     #                                    \ 0 -1 -2  0 +2 +1 /
-    p = cp.zeros((2 * N + 2, 2 * N + 2))
-    p[1:N+1, 1:N+1], p[1:N+1, N+2:] = a,             -cp.fliplr(a)
-    p[N+2:,  1:N+1], p[N+2:,  N+2:] = -cp.flipud(a), +cp.fliplr(cp.flipud(a))
+    p = cp.zeros(a.shape[:-2] + (2 * N + 2, 2 * N + 2))
+    p[..., 1:N+1, 1:N+1], p[..., 1:N+1, N+2:] = a, -fliplr(a)
+    p[..., N+2:, 1:N+1], p[..., N+2:, N+2:] = -flipud(a), +fliplr(flipud(a))
 
     # after padding: rFFT-2D, cut out the top-left segment, take -real part
-    return -cp.fft.rfft2(p)[1:N+1, 1:N+1].real
+    return -cp.fft.rfft2(p)[..., 1:N+1, 1:N+1].real
 
 
 @cp.memoize()
-def dirichlet_matrix(grid_steps, grid_step_size):
+def dirichlet_matrix(grid_steps, grid_step_size, shift=0):
     """
     Calculate a magical matrix that solves the Laplace equation
+    (or the Helmholtz one, with ``shift`` added to the eigenvalues)
     if you elementwise-multiply the RHS by it "in DST-space".
     See Samarskiy-Nikolaev, p. 187.
     """
@@ -153,34 +330,39 @@ def dirichlet_matrix(grid_steps, grid_step_size):
     k = cp.arange(1, grid_steps - 1)
     lam = 4 / grid_step_size**2 * cp.sin(k * cp.pi / (2 * (grid_steps - 1)))**2
     lambda_i, lambda_j = lam[:, None], lam[None, :]
-    mul = 1 / (lambda_i + lambda_j)
+    mul = 1 / (lambda_i + lambda_j + shift)
     return mul / (2 * (grid_steps - 1))**2  # additional 2xDST normalization
 
 
+@profiled
 def calculate_Ez(config, jx, jy):
     """
     Calculate Ez as iDST2D(dirichlet_matrix * DST2D(djx/dx + djy/dy)).
     """
     # 0. Calculate RHS (NOTE: it is smaller by 1 on each side).
     # NOTE: use gradient instead if available (cupy doesn't have gradient yet).
-    djx_dx = jx[2:, 1:-1] - jx[:-2, 1:-1]
-    djy_dy = jy[1:-1, 2:] - jy[1:-1, :-2]
+    djx_dx = jx[..., 2:, 1:-1] - jx[..., :-2, 1:-1]
+    djy_dy = jy[..., 1:-1, 2:] - jy[..., 1:-1, :-2]
     rhs_inner = -(djx_dx + djy_dy) / (config.grid_step_size * 2)  # -?
+    del djx_dx, djy_dy  # lower the peak memory usage
 
-    # 1. Apply DST-Type1-2D (Discrete Sine Transform Type 1 2D) to the RHS.
-    f = dst2d(rhs_inner)
+    def solve(rhs_inner):
+        # 1. Apply DST-Type1-2D (Discrete Sine Transform Type 1 2D) to the RHS.
+        f = dst2d(rhs_inner)
 
-    # 2. Multiply f by the special matrix that does the job and normalizes.
-    f *= dirichlet_matrix(config.grid_steps, config.grid_step_size)
-
-    # 3. Apply iDST-Type1-2D (Inverse Discrete Sine Transform Type 1 2D).
-    #    We don't have to define a separate iDST function, because
-    #    unnormalized DST-Type1 is its own inverse, up to a factor 2(N+1)
-    #    and we take all scaling matters into account with a single factor
-    #    hidden inside dirichlet_matrix.
-    Ez_inner = dst2d(f)
-    Ez = cp.pad(Ez_inner, 1, 'constant', constant_values=0)
-    numba.cuda.synchronize()
+        # 2. Multiply f by the special matrix that does the job and normalizes.
+        f *= dirichlet_matrix(config.grid_steps, config.grid_step_size)
+
+        # 3. Apply iDST-Type1-2D (Inverse Discrete Sine Transform Type 1 2D).
+        #    We don't have to define a separate iDST function, because
+        #    unnormalized DST-Type1 is its own inverse, up to a factor 2(N+1)
+        #    and we take all scaling matters into account with a single factor
+        #    hidden inside dirichlet_matrix.
+        return dst2d(f)
+
+    Ez_inner = in_chunks(solve, rhs_inner, config.transform_chunk)
+    Ez = pad_perimeter(Ez_inner)
+    synchronize()
     return Ez
 
 
@@ -195,21 +377,21 @@ def mix2d(a):
     (anti-symmetrically in first direction, symmetrically in second direction).
     """
     # NOTE: LCODE 3D uses x as the first direction, thus the confision below.
-    M, N = a.shape
+    M, N = a.shape[-2:]
     #                                  /(0  1  2  0)-2 -1 \      +---->  x
     #  / 1  2 \                       | (0  3  4  0)-4 -3  |     |      (M)
     #  | 3  4 |  mixed-symmetrically  | (0  5  6  0)-6 -5  |     |
     #  | 5  6 |       padded to       | (0  7  8  0)-8 -7  |     v
     #  \ 7  8 /                       |  0 +5 +6  0 -6 -5  |
     #                                  \ 0 +3 +4  0 -4 -3 /      y (N)
-    p = cp.zeros((2 * M + 2, 2 * N - 2))  # wider than before
-    p[1:M+1, :N] = a
-    p[M+2:2*M+2, :N] = -cp.flipud(a)  # flip to right on drawing above
-    p[1:M+1, N-1:2*N-2] = cp.fliplr(a)[:, :-1]  # flip down on drawing above
-    p[M+2:2*M+2, N-1:2*N-2] = -cp.flipud(cp.fliplr(a))[:, :-1]
+    p = cp.zeros(a.shape[:-2] + (2 * M + 2, 2 * N - 2))  # wider than before
+    p[..., 1:M+1, :N] = a
+    p[..., M+2:2*M+2, :N] = -flipud(a)  # flip to right on drawing above
+    p[..., 1:M+1, N-1:2*N-2] = fliplr(a)[..., :-1]  # flip down on drawing
+    p[..., M+2:2*M+2, N-1:2*N-2] = -flipud(fliplr(a))[..., :-1]
     # Note: the returned array is wider than the input array, it is padded
     # with zeroes (depicted above as a square region marked with round braces).
-    return -cp.fft.rfft2(p)[:M+2, :N].imag  # FFT, cut a corner with 0s, -imag
+    return -cp.fft.rfft2(p)[..., :M+2, :N].imag  # FFT, cut a corner, -imag
 
 
 @cp.memoize()
@@ -238,11 +420,36 @@ def dx_dy(arr, grid_step_size):
     NOTE: arrays are assumed to have zeros on the perimeter.
     """
     dx, dy = cp.zeros_like(arr), cp.zeros_like(arr)
-    dx[1:-1, 1:-1] = arr[2:, 1:-1] - arr[:-2, 1:-1]  # arrays have 0s
-    dy[1:-1, 1:-1] = arr[1:-1, 2:] - arr[1:-1, :-2]  # on the perimeter
+    dx[..., 1:-1, 1:-1] = arr[..., 2:, 1:-1] - arr[..., :-2, 1:-1]  # 0s on
+    dy[..., 1:-1, 1:-1] = arr[..., 1:-1, 2:] - arr[..., 1:-1, :-2]  # perimeter
     return dx / (grid_step_size * 2), dy / (grid_step_size * 2)
 
 
+def transverse_fields_rhs(config, grid_step_size, Ex_avg, Ey_avg, Bx_avg,
+                          By_avg, beam_ro, ro, jx, jy, jz, jx_prev, jy_prev):
+    """
+    Calculate the right hand sides of the Ex, Ey, Bx, By equations
+    on a grid with ``grid_step_size`` cells, yielding them one by one,
+    so that a caller solving each one before asking for the next
+    never holds more than one of them (and half of the gradients).
+    """
+    djx_dxi = (jx_prev - jx) / config.xi_step_size  # - ?
+    djy_dxi = (jy_prev - jy) / config.xi_step_size  # - ?
+
+    # Are we solving a Laplace equation or a Helmholtz one?
+    subtraction_trick = config.field_solver_subtraction_trick
+    dro_dx, dro_dy = dx_dy(ro + beam_ro, grid_step_size)
+    yield -((dro_dx - djx_dxi) - Ex_avg * subtraction_trick)  # Ex, -?
+    del dro_dx
+    yield -((dro_dy - djy_dxi) - Ey_avg * subtraction_trick)  # Ey
+    del dro_dy
+    djz_dx, djz_dy = dx_dy(jz + beam_ro, grid_step_size)
+    yield +((djz_dy - djy_dxi) + Bx_avg * subtraction_trick)  # Bx
+    del djz_dy
+    yield -((djz_dx - djx_dxi) - By_avg * subtraction_trick)  # By
+
+
+@profiled
 def calculate_Ex_Ey_Bx_By(config, Ex_avg, Ey_avg, Bx_avg, By_avg,
                           beam_ro, ro, jx, jy, jz, jx_prev, jy_prev):
     """
@@ -254,63 +461,88 @@ def calculate_Ex_Ey_Bx_By(config, Ex_avg, Ey_avg, Bx_avg, By_avg,
     #  must be closer to the center than the simulation window boundary
     #  minus the coarse plasma particle cloud width).
 
-    # 0. Calculate gradients and RHS.
-    dro_dx, dro_dy = dx_dy(ro + beam_ro, config.grid_step_size)
-    djz_dx, djz_dy = dx_dy(jz + beam_ro, config.grid_step_size)
-    djx_dxi = (jx_prev - jx) / config.xi_step_size  # - ?
-    djy_dxi = (jy_prev - jy) / config.xi_step_size  # - ?
-
-    # Are we solving a Laplace equation or a Helmholtz one?
-    subtraction_trick = config.field_solver_subtraction_trick
-    Ex_rhs = -((dro_dx - djx_dxi) - Ex_avg * subtraction_trick)  # -?
-    Ey_rhs = -((dro_dy - djy_dxi) - Ey_avg * subtraction_trick)
-    Bx_rhs = +((djz_dy - djy_dxi) + Bx_avg * subtraction_trick)
-    By_rhs = -((djz_dx - djx_dxi) - By_avg * subtraction_trick)
+    # 0. Calculate gradients and RHS
+    # (one at a time, see below, to lower the peak memory).
+    rhs = transverse_fields_rhs(
+        config, config.grid_step_size, Ex_avg, Ey_avg, Bx_avg, By_avg,
+        beam_ro, ro, jx, jy, jz, jx_prev, jy_prev
+    )
 
     # Boundary conditions application (for future reference, ours are zero):
     # rhs[:, 0] -= bound_bottom[:] * (2 / grid_step_size)
     # rhs[:, -1] += bound_top[:] * (2 / grid_step_size)
 
-    # 1. Apply our mixed DCT-DST transform to RHS.
-    Ey_f = mix2d(Ey_rhs[1:-1, :])[1:-1, :]
-
-    # 2. Multiply f by the magic matrix.
     mix_mat = mixed_matrix(config.grid_steps, config.grid_step_size,
                            config.field_solver_subtraction_trick)
-    Ey_f *= mix_mat
 
-    # 3. Apply our mixed DCT-DST transform again.
-    Ey = mix2d(Ey_f)
+    def solve(rhs):
+        # 1. Apply our mixed DCT-DST transform to RHS.
+        f = mix2d(rhs[..., 1:-1, :])[..., 1:-1, :]
+
+        # 2. Multiply f by the magic matrix.
+        f *= mix_mat
 
+        # 3. Apply our mixed DCT-DST transform again.
+        return mix2d(f)
+
+    # Every RHS is solved and released before the next one is calculated,
+    # even for a single simulation, which ``in_chunks`` cannot split.
+    chunk = config.transform_chunk
+    Ex = transpose(in_chunks(solve, transpose(next(rhs)), chunk))
+    Ey = in_chunks(solve, next(rhs), chunk)
     # Likewise for other fields:
-    Bx = mix2d(mix_mat * mix2d(Bx_rhs[1:-1, :])[1:-1, :])
-    By = mix2d(mix_mat * mix2d(By_rhs.T[1:-1, :])[1:-1, :]).T
-    Ex = mix2d(mix_mat * mix2d(Ex_rhs.T[1:-1, :])[1:-1, :]).T
+    Bx = in_chunks(solve, next(rhs), chunk)
+    By = transpose(in_chunks(solve, transpose(next(rhs)), chunk))
 
     return Ex, Ey, Bx, By
 
 
+def calculate_beam_fields(config, beam_ro):
+    """
+    Calculate the transverse fields of the beam alone.
+    As the fields are linear in the sources, the fields of a beam
+    with a fixed transverse profile are these ones times its amplitude.
+    The beam enters as both ro and jz, so its Bx, By are just -Ey, Ex.
+    """
+    zero = cp.zeros_like(beam_ro)
+    Ex, Ey, _, _ = calculate_Ex_Ey_Bx_By(config, zero, zero, zero, zero,
+                                         beam_ro, zero, zero, zero, zero,
+                                         zero, zero)
+    return Ex, Ey
+
+
+def add_beam_fields(beam_Ex, beam_Ey, beam_amplitude, Ex, Ey, Bx, By):
+    """
+    Add the fields of the beam with the fixed profile
+    (see ``calculate_beam_fields``) scaled by ``beam_amplitude``.
+    """
+    beam_Ex = beam_amplitude * beam_Ex
+    beam_Ey = beam_amplitude * beam_Ey
+    return Ex + beam_Ex, Ey + beam_Ey, Bx - beam_Ey, By + beam_Ex
+
+
 # Solving Laplace equation with Neumann boundary conditions (Bz) #
 
 def dct2d(a):
     """
     Calculate DCT-Type1-2D, jury-rigged from symmetrically-padded rFFT.
+    Leading dimensions of ``a``, if any, are treated as a batch.
     """
-    assert a.shape[0] == a.shape[1]
-    N = a.shape[0]
+    assert a.shape[-2] == a.shape[-1]
+    N = a.shape[-1]
     #                                    //1  2  3  4\ 3  2 \
     # /1  2  3  4\                      | |5  6  7  8| 7  6  |
     # |5  6  7  8|     symmetrically    | |9  A  B  C| B  A  |
     # |9  A  B  C|      padded to       | \D  E  F  G/ F  E  |
     # \D  E  F  G/                      |  9  A  B  C  B  A  |
     #                                    \ 5  6  7  8  7  6 /
-    p = cp.zeros((2 * N - 2, 2 * N - 2))
-    p[:N, :N] = a
-    p[N:, :N] = cp.flipud(a)[1:-1, :]  # flip to right on drawing above
-    p[:N, N:] = cp.fliplr(a)[:, 1:-1]  # flip down on drawing above
-    p[N:, N:] = cp.flipud(cp.fliplr(a))[1:-1, 1:-1]  # bottom-right corner
+    p = cp.zeros(a.shape[:-2] + (2 * N - 2, 2 * N - 2))
+    p[..., :N, :N] = a
+    p[..., N:, :N] = flipud(a)[..., 1:-1, :]  # flip to right on drawing above
+    p[..., :N, N:] = fliplr(a)[..., :, 1:-1]  # flip down on drawing above
+    p[..., N:, N:] = flipud(fliplr(a))[..., 1:-1, 1:-1]  # bottom-right corner
     # after padding: rFFT-2D, cut out the top-left segment, take -real part
-    return -cp.fft.rfft2(p)[:N, :N].real
+    return -cp.fft.rfft2(p)[..., :N, :N].real
 
 
 @cp.memoize()
@@ -330,42 +562,130 @@ def neumann_matrix(grid_steps, grid_step_size):
     return mul / (2 * (grid_steps - 1))**2  # additional 2xDST normalization
 
 
+@profiled
 def calculate_Bz(config, jx, jy):
     """
     Calculate Bz as iDCT2D(dirichlet_matrix * DCT2D(djx/dy - djy/dx)).
     """
     # 0. Calculate RHS.
     # NOTE: use gradient instead if available (cupy doesn't have gradient yet).
-    djx_dy = jx[1:-1, 2:] - jx[1:-1, :-2]
-    djy_dx = jy[2:, 1:-1] - jy[:-2, 1:-1]
-    djx_dy = cp.pad(djx_dy, 1, 'constant', constant_values=0)
-    djy_dx = cp.pad(djy_dx, 1, 'constant', constant_values=0)
+    djx_dy = pad_perimeter(jx[..., 1:-1, 2:] - jx[..., 1:-1, :-2])
+    djy_dx = pad_perimeter(jy[..., 2:, 1:-1] - jy[..., :-2, 1:-1])
     rhs = -(djx_dy - djy_dx) / (config.grid_step_size * 2)  # -?
+    del djx_dy, djy_dx  # lower the peak memory usage
 
     # As usual, the boundary conditions are zero
     # (otherwise add them to boundary cells, divided by grid_step_size/2
 
-    # 1. Apply DST-Type1-2D (Discrete Sine Transform Type 1 2D) to the RHS.
-    f = dct2d(rhs)
+    def solve(rhs):
+        # 1. Apply DST-Type1-2D (Discrete Sine Transform Type 1 2D) to the RHS.
+        f = dct2d(rhs)
+
+        # 2. Multiply f by the special matrix that does the job and normalizes.
+        f *= neumann_matrix(config.grid_steps, config.grid_step_size)
 
-    # 2. Multiply f by the special matrix that does the job and normalizes.
-    f *= neumann_matrix(config.grid_steps, config.grid_step_size)
+        # 3. Apply iDCT-Type1-2D (Inverse Discrete Cosine Transform Type 1 2D).
+        #    We don't have to define a separate iDCT function, because
+        #    unnormalized DCT-Type1 is its own inverse, up to a factor 2(N+1)
+        #    and we take all scaling matters into account with a single factor
+        #    hidden inside neumann_matrix.
+        return dct2d(f)
 
-    # 3. Apply iDCT-Type1-2D (Inverse Discrete Cosine Transform Type 1 2D).
-    #    We don't have to define a separate iDCT function, because
-    #    unnormalized DCT-Type1 is its own inverse, up to a factor 2(N+1)
-    #    and we take all scaling matters into account with a single factor
-    #    hidden inside neumann_matrix.
-    Bz = dct2d(f)
-    numba.cuda.synchronize()
+    Bz = in_chunks(solve, rhs, config.transform_chunk)
+    synchronize()
 
-    Bz -= Bz.mean()  # Integral over Bz must be 0.
+    Bz -= Bz.mean(axis=(-2, -1), keepdims=True)  # Integral over Bz must be 0.
 
     return Bz
 
 
+# Field refinement patch #
+
+def patch_step_size(config):
+    """
+    The cell size of the finer field grid around the axis,
+    see ``config_example.field_patch_steps``.
+    """
+    return config.grid_step_size / config.field_patch_refinement
+
+
+def patch_grid(config):
+    """
+    The coordinates of the finer field grid nodes around the axis
+    (a single 1D grid for both x and y).
+    """
+    steps = config.field_patch_steps
+    return (np.arange(steps) - steps // 2) * patch_step_size(config)
+
+
+def interpolate_to_patch(config, a):
+    """
+    Bilinearly interpolate a coarse grid array onto the patch.
+    The patch perimeter runs along the coarse grid lines.
+    """
+    refinement = config.field_patch_refinement
+    K, center = config.field_patch_steps // 2 // refinement, a.shape[-1] // 2
+    a = a[..., center - K:center + K + 1, center - K:center + K + 1]
+    k = cp.arange(config.field_patch_steps)
+    lo = cp.minimum(k // refinement, 2 * K - 1)
+    t = (k - lo * refinement) / refinement
+    a = a[..., lo, :] * (1 - t)[:, None] + a[..., lo + 1, :] * t[:, None]
+    return a[..., :, lo] * (1 - t) + a[..., :, lo + 1] * t
+
+
+def solve_patch(config, rhs, boundary, shift=0):
+    """
+    Solve ``-laplacian(u) + shift * u = rhs`` on the patch,
+    taking the values of ``u`` on its perimeter from ``boundary``.
+    """
+    h = patch_step_size(config)
+    # The known perimeter values move to the RHS of their inner neighbours.
+    rhs_inner = rhs[..., 1:-1, 1:-1].copy()
+    rhs_inner[..., 0, :] += boundary[..., 0, 1:-1] / h**2
+    rhs_inner[..., -1, :] += boundary[..., -1, 1:-1] / h**2
+    rhs_inner[..., :, 0] += boundary[..., 1:-1, 0] / h**2
+    rhs_inner[..., :, -1] += boundary[..., 1:-1, -1] / h**2
+    f = dst2d(rhs_inner)
+    f *= dirichlet_matrix(config.field_patch_steps, h, shift)
+    u = boundary.copy()
+    u[..., 1:-1, 1:-1] = dst2d(f)
+    return u
+
+
+@profiled
+def calculate_patch_fields(config, coarse_fields, Ex_avg, Ey_avg, Bx_avg,
+                           By_avg, beam_ro, ro, jx, jy, jz, jx_prev, jy_prev):
+    """
+    Calculate the six fields on the patch from the sources deposited on it
+    (see ``deposit``), solving the same equations as
+    ``calculate_Ex_Ey_Bx_By``, ``calculate_Ez`` and ``calculate_Bz`` do,
+    but with the perimeter values interpolated from the ``coarse_fields``
+    (Ex, Ey, Ez, Bx, By, Bz) solved from the same sources.
+    """
+    h = patch_step_size(config)
+    shift = 1 if config.field_solver_subtraction_trick else 0
+    Ex_rhs, Ey_rhs, Bx_rhs, By_rhs = transverse_fields_rhs(
+        config, h, Ex_avg, Ey_avg, Bx_avg, By_avg,
+        beam_ro, ro, jx, jy, jz, jx_prev, jy_prev
+    )
+    djx_dx, djx_dy = dx_dy(jx, h)
+    djy_dx, djy_dy = dx_dy(jy, h)
+    Ez_rhs = -(djx_dx + djy_dy)
+    Bz_rhs = -(djx_dy - djy_dx)
+    del djx_dx, djx_dy, djy_dx, djy_dy
+
+    rhs_shifts = ((Ex_rhs, shift), (Ey_rhs, shift), (Ez_rhs, 0),
+                  (Bx_rhs, shift), (By_rhs, shift), (Bz_rhs, 0))
+    fields = [solve_patch(config, rhs, interpolate_to_patch(config, coarse),
+                          rhs_shift)
+              for (rhs, rhs_shift), coarse in zip(rhs_shifts, coarse_fields)]
+    synchronize()
+    return fields
+
+
 # Pushing particles without any fields (used for initial halfstep estimation) #
 
+@profiled
 def move_estimate_wo_fields(config,
                             m, x_init, y_init, prev_x_offt, prev_y_offt,
                             px, py, pz):
@@ -379,15 +699,16 @@ def move_estimate_wo_fields(config,
     x += px / (gamma_m - pz) * config.xi_step_size
     y += py / (gamma_m - pz) * config.xi_step_size
 
+    # (without boolean indexing, which waits for the GPU to count the hits)
     reflect = config.reflect_boundary
-    x[x >= +reflect] = +2 * reflect - x[x >= +reflect]
-    x[x <= -reflect] = -2 * reflect - x[x <= -reflect]
-    y[y >= +reflect] = +2 * reflect - y[y >= +reflect]
-    y[y <= -reflect] = -2 * reflect - y[y <= -reflect]
+    x = cp.where(x >= +reflect, +2 * reflect - x, x)
+    x = cp.where(x <= -reflect, -2 * reflect - x, x)
+    y = cp.where(y >= +reflect, +2 * reflect - y, y)
+    y = cp.where(y <= -reflect, -2 * reflect - y, y)
 
     x_offt, y_offt = x - x_init, y - y_init
 
-    numba.cuda.synchronize()
+    synchronize()
     return x_offt, y_offt
 
 
@@ -430,6 +751,37 @@ def interp9(a, i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM):
     )
 
 
+@numba.jit(inline=True)
+def add6(f, i, j, w, Ex, Ey, Ez, Bx, By, Bz):
+    """
+    Add the weighted contents of an interleaved fields cell (see ``interp9x6``)
+    to the values accumulated so far.
+    """
+    return (Ex + f[i, j, 0] * w, Ey + f[i, j, 1] * w, Ez + f[i, j, 2] * w,
+            Bx + f[i, j, 3] * w, By + f[i, j, 4] * w, Bz + f[i, j, 5] * w)
+
+
+@numba.jit(inline=True)
+def interp9x6(f, i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM):
+    """
+    Collect all six field components from a cell and 8 surrounding cells
+    (using `weights` output) of the interleaved fields array ``f``,
+    which stores the six components of a cell next to each other,
+    so that every cell of the stencil is only fetched once.
+    """
+    Ex, Ey, Ez, Bx, By, Bz = 0., 0., 0., 0., 0., 0.
+    Ex, Ey, Ez, Bx, By, Bz = add6(f, i - 1, j + 1, wMP, Ex, Ey, Ez, Bx, By, Bz)
+    Ex, Ey, Ez, Bx, By, Bz = add6(f, i + 0, j + 1, w0P, Ex, Ey, Ez, Bx, By, Bz)
+    Ex, Ey, Ez, Bx, By, Bz = add6(f, i + 1, j + 1, wPP, Ex, Ey, Ez, Bx, By, Bz)
+    Ex, Ey, Ez, Bx, By, Bz = add6(f, i - 1, j + 0, wM0, Ex, Ey, Ez, Bx, By, Bz)
+    Ex, Ey, Ez, Bx, By, Bz = add6(f, i + 0, j + 0, w00, Ex, Ey, Ez, Bx, By, Bz)
+    Ex, Ey, Ez, Bx, By, Bz = add6(f, i + 1, j + 0, wP0, Ex, Ey, Ez, Bx, By, Bz)
+    Ex, Ey, Ez, Bx, By, Bz = add6(f, i - 1, j - 1, wMM, Ex, Ey, Ez, Bx, By, Bz)
+    Ex, Ey, Ez, Bx, By, Bz = add6(f, i + 0, j - 1, w0M, Ex, Ey, Ez, Bx, By, Bz)
+    Ex, Ey, Ez, Bx, By, Bz = add6(f, i + 1, j - 1, wPM, Ex, Ey, Ez, Bx, By, Bz)
+    return Ex, Ey, Ez, Bx, By, Bz
+
+
 @numba.jit(inline=True)
 def deposit9(a, i, j, val, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM):
     """
@@ -449,6 +801,32 @@ def deposit9(a, i, j, val, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM):
     numba.cuda.atomic.add(a, (i + 1, j - 1), val * wPM)
 
 
+@numba.jit(inline=True)
+def deposit1_clipped(a, i, j, val):
+    """
+    Deposit value into a cell if it is inside ``a``.
+    """
+    if 0 <= i < a.shape[0] and 0 <= j < a.shape[1]:
+        numba.cuda.atomic.add(a, (i, j), val)
+
+
+@numba.jit(inline=True)
+def deposit9_clipped(a, i, j, val,
+                     wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM):
+    """
+    Deposit value like ``deposit9`` does, skipping the cells outside of ``a``.
+    """
+    deposit1_clipped(a, i - 1, j + 1, val * wMP)
+    deposit1_clipped(a, i + 0, j + 1, val * w0P)
+    deposit1_clipped(a, i + 1, j + 1, val * wPP)
+    deposit1_clipped(a, i - 1, j + 0, val * wM0)
+    deposit1_clipped(a, i + 0, j + 0, val * w00)
+    deposit1_clipped(a, i + 1, j + 0, val * wP0)
+    deposit1_clipped(a, i - 1, j - 1, val * wMM)
+    deposit1_clipped(a, i + 0, j - 1, val * w0M)
+    deposit1_clipped(a, i + 1, j - 1, val * wPM)
+
+
 # Coarse and fine plasma initialization #
 
 def make_coarse_plasma_grid(steps, step_size, coarseness=3):
@@ -487,7 +865,35 @@ def make_fine_plasma_grid(steps, step_size, fineness=2):
     return plasma_grid
 
 
-def make_plasma(steps, cell_size, coarseness=3, fineness=2):
+def refine_fine_plasma_grid(fine_grid, step_size, fineness,
+                            center_fineness=None, center_steps=0):
+    """
+    Replace the fine plasma particles of the central ``2 * center_steps + 1``
+    cells of ``fine_grid`` with ``center_fineness`` particles per cell.
+    Returns the new grid and the fineness each of its particles has.
+
+    As the same 1D grid is used for both x and y, the refined region
+    is a cross along the axes, with the squared fineness in the center.
+    """
+    fineness_of = np.full(fine_grid.shape, fineness)
+    if center_fineness is None or center_fineness == fineness:
+        return fine_grid, fineness_of
+    assert center_fineness == int(center_fineness)
+    assert center_steps < fine_grid[-1] / step_size - 1
+    outer = np.abs(fine_grid) > (center_steps + .5) * step_size
+    # same as in make_fine_plasma_grid, none on the cell edges
+    cells = np.arange(-center_steps, center_steps + 1)[:, None]
+    within = (np.arange(center_fineness) + .5) / center_fineness - .5
+    inner = (cells + within).ravel() * step_size
+    plasma_grid = np.concatenate([fine_grid[outer], inner])
+    fineness_of = np.concatenate([fineness_of[outer],
+                                  np.full(inner.shape, center_fineness)])
+    order = np.argsort(plasma_grid, kind='stable')
+    return plasma_grid[order], fineness_of[order]
+
+
+def make_plasma(steps, cell_size, coarseness=3, fineness=2,
+                center_fineness=None, center_steps=0):
     """
     Make coarse plasma initial state arrays and the arrays needed to intepolate
     coarse plasma into fine plasma (``virt_params``).
@@ -495,6 +901,8 @@ def make_plasma(steps, cell_size, coarseness=3, fineness=2):
     Coarse is the one that will evolve and fine is the one to be bilinearly
     interpolated from the coarse one based on the initial positions
     (using 1 to 4 coarse plasma particles that initially were the closest).
+    The central cells can have more fine particles,
+    see ``refine_fine_plasma_grid``.
     """
     coarse_step = cell_size * coarseness
 
@@ -505,7 +913,10 @@ def make_plasma(steps, cell_size, coarseness=3, fineness=2):
     coarse_grid = make_coarse_plasma_grid(steps, cell_size, coarseness)
     coarse_grid_xs, coarse_grid_ys = coarse_grid[:, None], coarse_grid[None, :]
 
-    fine_grid = make_fine_plasma_grid(steps, cell_size, fineness)
+    fine_grid, fine_fineness = refine_fine_plasma_grid(
+        make_fine_plasma_grid(steps, cell_size, fineness), cell_size,
+        fineness, center_fineness, center_steps
+    )
 
     Nc = len(coarse_grid)
 
@@ -562,17 +973,45 @@ def make_plasma(steps, cell_size, coarseness=3, fineness=2):
     # inf_next[ni] * (inf_prev[pj] * <top-left> + inf_next[nj] * <top-right>)
 
     # Values of m, q, px, py, pz should be scaled by 1/(fineness*coarseness)**2
+    # or, with the fineness varying between the particles,
+    # by fine_weight[i] * fine_weight[j].
+    fine_weight = 1 / (coarseness * fine_fineness)
+
+    # The fine particles virtualized from each tile of FUSED_TILE_SIZE**2
+    # coarse particles (by indices_prev) in ``move_deposit_kernel``
+    # are the ones from tile_fine_starts[ti] to tile_fine_starts[ti + 1].
+    tile_fine_starts = np.searchsorted(
+        indices_prev, np.arange(0, Nc + FUSED_TILE_SIZE, FUSED_TILE_SIZE)
+    )
 
     virt_params = GPUArrays(
         influence_prev=influence_prev, influence_next=influence_next,
         indices_prev=indices_prev, indices_next=indices_next,
-        fine_grid=fine_grid,
+        fine_grid=fine_grid, fine_weight=fine_weight,
+        tile_fine_starts=tile_fine_starts,
     )
 
     return (coarse_x_init, coarse_y_init, coarse_x_offt, coarse_y_offt,
             coarse_px, coarse_py, coarse_pz, coarse_m, coarse_q, virt_params)
 
 
+@cp.memoize(for_each_device=True)
+def cached_plasma(steps, cell_size, coarseness, fineness,
+                  center_fineness=None, center_steps=0):
+    """
+    Make the constant plasma arrays and ``virt_params`` (see ``make_plasma``)
+    on the current GPU, only once for the given parameters and GPU,
+    so that the processes running several simulations
+    (see ``lcode_server.py``) or driving several GPUs
+    (see ``move_deposit_slabs``) do not repeat that.
+    """
+    x_init, y_init, _, _, _, _, _, m, q, virt_params = make_plasma(
+        steps, cell_size, coarseness=coarseness, fineness=fineness,
+        center_fineness=center_fineness, center_steps=center_steps
+    )
+    return GPUArrays(m=m, q=q, x_init=x_init, y_init=y_init), virt_params
+
+
 @numba.jit(inline=True)
 def mix(coarse, A, B, C, D, pi, ni, pj, nj):
     """
@@ -590,7 +1029,7 @@ def mix(coarse, A, B, C, D, pi, ni, pj, nj):
 
 @numba.jit(inline=True)
 def coarse_to_fine(fi, fj, c_x_offt, c_y_offt, c_m, c_q, c_px, c_py, c_pz,
-                   virtplasma_smallness_factor, fine_grid,
+                   fine_weight, fine_grid,
                    influence_prev, influence_next, indices_prev, indices_next):
     """
     Bilinearly interpolate fine plasma properties from four
@@ -611,6 +1050,9 @@ def coarse_to_fine(fi, fj, c_x_offt, c_y_offt, c_m, c_q, c_px, c_py, c_pz,
     x = fine_grid[fi] + x_offt  # x_fine_init
     y = fine_grid[fj] + y_offt  # y_fine_init
 
+    # The fine particles are lighter where they are more numerous.
+    virtplasma_smallness_factor = fine_weight[fi] * fine_weight[fj]
+
     # TODO: const m and q
     m = virtplasma_smallness_factor * mix(c_m, A, B, C, D, pi, ni, pj, nj)
     q = virtplasma_smallness_factor * mix(c_q, A, B, C, D, pi, ni, pj, nj)
@@ -623,8 +1065,8 @@ def coarse_to_fine(fi, fj, c_x_offt, c_y_offt, c_m, c_q, c_px, c_py, c_pz,
 
 # Deposition #
 
-@numba.cuda.jit
-def deposit_kernel(grid_steps, grid_step_size, virtplasma_smallness_factor,
+@numba.cuda.jit(cache=True)
+def deposit_kernel(grid_steps, grid_step_size, fine_weight,
                    c_x_offt, c_y_offt, c_m, c_q, c_px, c_py, c_pz,  # coarse
                    fine_grid,
                    influence_prev, influence_next, indices_prev, indices_next,
@@ -632,18 +1074,22 @@ def deposit_kernel(grid_steps, grid_step_size, virtplasma_smallness_factor,
     """
     Interpolate coarse plasma into fine plasma and deposit it on the
     charge density and current grids.
+    The first dimension of the evolving coarse plasma arrays and the output
+    arrays enumerates the simulations in a batch, ``c_m`` and ``c_q``
+    are shared by all of them.
     """
     # Do nothing if our thread does not have a fine particle to deposit.
     fk = numba.cuda.grid(1)
-    if fk >= fine_grid.size**2:
+    if fk >= out_ro.shape[0] * fine_grid.size**2:
         return
+    b, fk = fk // fine_grid.size**2, fk % fine_grid.size**2  # batch index
     fi, fj = fk // fine_grid.size, fk % fine_grid.size
 
     # Interpolate fine plasma particle from coarse particle characteristics
-    x, y, m, q, px, py, pz = coarse_to_fine(fi, fj, c_x_offt, c_y_offt,
-                                            c_m, c_q, c_px, c_py, c_pz,
-                                            virtplasma_smallness_factor,
-                                            fine_grid,
+    x, y, m, q, px, py, pz = coarse_to_fine(fi, fj, c_x_offt[b], c_y_offt[b],
+                                            c_m, c_q,
+                                            c_px[b], c_py[b], c_pz[b],
+                                            fine_weight, fine_grid,
                                             influence_prev, influence_next,
                                             indices_prev, indices_next)
 
@@ -657,89 +1103,152 @@ def deposit_kernel(grid_steps, grid_step_size, virtplasma_smallness_factor,
     i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM = weights(
         x, y, grid_steps, grid_step_size
     )
-    deposit9(out_ro, i, j, dro, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
-    deposit9(out_jx, i, j, djx, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
-    deposit9(out_jy, i, j, djy, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
-    deposit9(out_jz, i, j, djz, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+    deposit9(out_ro[b], i, j, dro, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+    deposit9(out_jx[b], i, j, djx, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+    deposit9(out_jy[b], i, j, djy, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+    deposit9(out_jz[b], i, j, djz, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+
+
+@numba.cuda.jit(cache=True)
+def deposit_patch_kernel(patch_steps, patch_step_size, fine_weight,
+                         c_x_offt, c_y_offt, c_m, c_q, c_px, c_py, c_pz,
+                         fine_grid,
+                         influence_prev, influence_next,
+                         indices_prev, indices_next,
+                         out_ro, out_jx, out_jy, out_jz):
+    """
+    Interpolate coarse plasma into fine plasma like ``deposit_kernel`` does
+    and deposit the part of it that reaches the field patch on it.
+    """
+    fk = numba.cuda.grid(1)
+    if fk >= out_ro.shape[0] * fine_grid.size**2:
+        return
+    b, fk = fk // fine_grid.size**2, fk % fine_grid.size**2  # batch index
+    fi, fj = fk // fine_grid.size, fk % fine_grid.size
 
+    x, y, m, q, px, py, pz = coarse_to_fine(fi, fj, c_x_offt[b], c_y_offt[b],
+                                            c_m, c_q,
+                                            c_px[b], c_py[b], c_pz[b],
+                                            fine_weight, fine_grid,
+                                            influence_prev, influence_next,
+                                            indices_prev, indices_next)
+    reach = (patch_steps // 2 + 2) * patch_step_size
+    if abs(x) > reach or abs(y) > reach:
+        return
 
-def deposit(config, ro_initial, x_offt, y_offt, m, q, px, py, pz, virt_params):
+    gamma_m = sqrt(m**2 + px**2 + py**2 + pz**2)
+    dro = q / (1 - pz / gamma_m)
+    djx = px * (dro / gamma_m)
+    djy = py * (dro / gamma_m)
+    djz = pz * (dro / gamma_m)
+
+    i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM = weights(
+        x, y, patch_steps, patch_step_size
+    )
+    deposit9_clipped(out_ro[b], i, j, dro,
+                     wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+    deposit9_clipped(out_jx[b], i, j, djx,
+                     wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+    deposit9_clipped(out_jy[b], i, j, djy,
+                     wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+    deposit9_clipped(out_jz[b], i, j, djz,
+                     wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+
+
+@profiled
+def deposit(config, ro_initial, x_offt, y_offt, m, q, px, py, pz, virt_params,
+            patch=False):
     """
     Interpolate coarse plasma into fine plasma and deposit it on the
-    charge density and current grids.
-    This is a convenience wrapper around the ``deposit_kernel`` CUDA kernel.
-    """
-    virtplasma_smallness_factor = 1 / (config.plasma_coarseness *
-                                       config.plasma_fineness)**2
-    ro = cp.zeros((config.grid_steps, config.grid_steps))
-    jx = cp.zeros((config.grid_steps, config.grid_steps))
-    jy = cp.zeros((config.grid_steps, config.grid_steps))
-    jz = cp.zeros((config.grid_steps, config.grid_steps))
-    cfg = int(np.ceil(virt_params.fine_grid.size**2 / WARP_SIZE)), WARP_SIZE
-    deposit_kernel[cfg](config.grid_steps, config.grid_step_size,
-                        virtplasma_smallness_factor,
-                        x_offt, y_offt, m, q, px, py, pz,
-                        virt_params.fine_grid,
-                        virt_params.influence_prev, virt_params.influence_next,
-                        virt_params.indices_prev, virt_params.indices_next,
-                        ro, jx, jy, jz)
+    charge density and current grids (the field patch ones if ``patch``).
+    This is a convenience wrapper around the ``deposit_kernel``
+    (``deposit_patch_kernel``) CUDA kernel.
+    Leading (batch) dimensions of the coarse plasma arrays, if any,
+    are preserved in the resulting charge density and currents.
+    """
+    if not patch:
+        kernel, steps = deposit_kernel, config.grid_steps
+        step_size = config.grid_step_size
+    else:
+        kernel, steps = deposit_patch_kernel, config.field_patch_steps
+        step_size = patch_step_size(config)
+    shape = x_offt.shape[:-2] + (steps, steps)
+    ro, jx, jy, jz = [cp.zeros(shape) for _ in range(4)]
+    batch_size = int(np.prod(x_offt.shape[:-2]))
+    fine_particles = batch_size * virt_params.fine_grid.size**2
+    threads = config.threads_per_block['deposit']
+    cfg = int(np.ceil(fine_particles / threads)), threads, launch_stream()
+    kernel[cfg](steps, step_size, virt_params.fine_weight,
+                batched(x_offt), batched(y_offt), m, q,
+                batched(px), batched(py), batched(pz),
+                virt_params.fine_grid,
+                virt_params.influence_prev, virt_params.influence_next,
+                virt_params.indices_prev, virt_params.indices_next,
+                batched(ro), batched(jx), batched(jy), batched(jz))
+    if patch:  # the same charge in the smaller cells
+        for a in ro, jx, jy, jz:
+            a *= config.field_patch_refinement**2
     # Also add the background ion charge density.
     ro += ro_initial  # Do it last to preserve more float precision
-    numba.cuda.synchronize()
+    synchronize()
     return ro, jx, jy, jz
 
 
-def initial_deposition(config, x_offt, y_offt, px, py, pz, m, q, virt_params):
+def initial_deposition(config, x_offt, y_offt, px, py, pz, m, q, virt_params,
+                       patch=False):
     """
     Determine the background ion charge density by depositing the electrons
     with their initial parameters and negating the result.
     """
     ro_electrons_initial, _, _, _ = deposit(config, 0, x_offt, y_offt,
-                                            m, q, px, py, pz, virt_params)
+                                            m, q, px, py, pz, virt_params,
+                                            patch)
     return -ro_electrons_initial  # Right on the GPU, huh
 
 
 # Field interpolation and particle movement (fused) #
 
-@numba.cuda.jit
-def move_smart_kernel(xi_step_size, reflect_boundary,
-                      grid_step_size, grid_steps,
-                      ms, qs,
-                      x_init, y_init,
-                      prev_x_offt, prev_y_offt,
-                      estimated_x_offt, estimated_y_offt,
-                      prev_px, prev_py, prev_pz,
-                      Ex_avg, Ey_avg, Ez_avg, Bx_avg, By_avg, Bz_avg,
-                      new_x_offt, new_y_offt, new_px, new_py, new_pz):
+@numba.jit(inline=True)
+def move_smart_particle(k, c, b, xi_step_size, reflect_boundary,
+                        grid_step_size, grid_steps,
+                        ms, qs,
+                        x_init, y_init,
+                        prev_x_offt, prev_y_offt,
+                        estimated_x_offt, estimated_y_offt,
+                        prev_px, prev_py, prev_pz,
+                        fields_avg, patch_steps, patch_step_size,
+                        patch_fields_avg):
     """
-    Update plasma particle coordinates and momenta according to the field
-    values interpolated halfway between the previous plasma particle location
-    and the the best estimation of its next location currently available to us.
-    Also reflect the particles from ``+-reflect_boundary``.
+    Calculate the new coordinates and momenta of a single coarse particle
+    (``k`` is its index in the evolving arrays, ``c`` in the constant ones,
+    ``b`` is its batch index), see ``move_smart_kernel``.
+    The fields are taken from the finer patch grid where it covers
+    the whole interpolation stencil.
     """
-    # Do nothing if our thread does not have a coarse particle to move.
-    k = numba.cuda.grid(1)
-    if k >= ms.size:
-        return
-
-    m, q = ms[k], qs[k]
+    m, q = ms[c], qs[c]
 
     opx, opy, opz = prev_px[k], prev_py[k], prev_pz[k]
     px, py, pz = opx, opy, opz
     x_offt, y_offt = prev_x_offt[k], prev_y_offt[k]
 
     # Calculate midstep positions and fields in them.
-    x_halfstep = x_init[k] + (prev_x_offt[k] + estimated_x_offt[k]) / 2
-    y_halfstep = y_init[k] + (prev_y_offt[k] + estimated_y_offt[k]) / 2
-    i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM = weights(
-        x_halfstep, y_halfstep, grid_steps, grid_step_size
-    )
-    Ex = interp9(Ex_avg, i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
-    Ey = interp9(Ey_avg, i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
-    Ez = interp9(Ez_avg, i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
-    Bx = interp9(Bx_avg, i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
-    By = interp9(By_avg, i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
-    Bz = interp9(Bz_avg, i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+    x_halfstep = x_init[c] + (prev_x_offt[k] + estimated_x_offt[k]) / 2
+    y_halfstep = y_init[c] + (prev_y_offt[k] + estimated_y_offt[k]) / 2
+    patch_reach = (patch_steps // 2 - 2) * patch_step_size
+    if abs(x_halfstep) < patch_reach and abs(y_halfstep) < patch_reach:
+        i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM = weights(
+            x_halfstep, y_halfstep, patch_steps, patch_step_size
+        )
+        Ex, Ey, Ez, Bx, By, Bz = interp9x6(patch_fields_avg[b], i, j,
+                                           wMP, w0P, wPP, wM0, w00, wP0,
+                                           wMM, w0M, wPM)
+    else:
+        i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM = weights(
+            x_halfstep, y_halfstep, grid_steps, grid_step_size
+        )
+        Ex, Ey, Ez, Bx, By, Bz = interp9x6(fields_avg[b], i, j,
+                                           wMP, w0P, wPP, wM0, w00, wP0,
+                                           wMM, w0M, wPM)
 
     # Move the particles according the the fields
     gamma_m = sqrt(m**2 + pz**2 + px**2 + py**2)
@@ -769,46 +1278,103 @@ def move_smart_kernel(xi_step_size, reflect_boundary,
 
     # Reflect the particles from `+-reflect_boundary`.
     # TODO: avoid branching?
-    x = x_init[k] + x_offt
-    y = y_init[k] + y_offt
+    x = x_init[c] + x_offt
+    y = y_init[c] + y_offt
     if x > +reflect_boundary:
         x = +2 * reflect_boundary - x
-        x_offt = x - x_init[k]
+        x_offt = x - x_init[c]
         px = -px
     if x < -reflect_boundary:
         x = -2 * reflect_boundary - x
-        x_offt = x - x_init[k]
+        x_offt = x - x_init[c]
         px = -px
     if y > +reflect_boundary:
         y = +2 * reflect_boundary - y
-        y_offt = y - y_init[k]
+        y_offt = y - y_init[c]
         py = -py
     if y < -reflect_boundary:
         y = -2 * reflect_boundary - y
-        y_offt = y - y_init[k]
+        y_offt = y - y_init[c]
         py = -py
 
+    return x_offt, y_offt, px, py, pz
+
+
+@numba.cuda.jit(cache=True)
+def move_smart_kernel(xi_step_size, reflect_boundary,
+                      grid_step_size, grid_steps,
+                      ms, qs,
+                      x_init, y_init,
+                      prev_x_offt, prev_y_offt,
+                      estimated_x_offt, estimated_y_offt,
+                      prev_px, prev_py, prev_pz,
+                      fields_avg, patch_steps, patch_step_size,
+                      patch_fields_avg,
+                      new_x_offt, new_y_offt, new_px, new_py, new_pz):
+    """
+    Update plasma particle coordinates and momenta according to the field
+    values interpolated halfway between the previous plasma particle location
+    and the the best estimation of its next location currently available to us.
+    Also reflect the particles from ``+-reflect_boundary``.
+    The evolving particle arrays may hold a batch of several simulations
+    (one after another), the constant ones (``ms``, ``qs``, ``x_init``,
+    ``y_init``) are shared by all of them, and the first dimension
+    of the interleaved fields (see ``interleave_fields``)
+    enumerates the simulations in a batch.
+    The fields of the patch grid around the axis (``patch_fields_avg``)
+    are used where they are available, see ``move_smart_particle``.
+    """
+    # Do nothing if our thread does not have a coarse particle to move.
+    k = numba.cuda.grid(1)
+    if k >= prev_x_offt.size:
+        return
+    b, c = k // ms.size, k % ms.size  # batch index, index in const arrays
+
+    x_offt, y_offt, px, py, pz = move_smart_particle(
+        k, c, b, xi_step_size, reflect_boundary, grid_step_size, grid_steps,
+        ms, qs, x_init, y_init, prev_x_offt, prev_y_offt,
+        estimated_x_offt, estimated_y_offt, prev_px, prev_py, prev_pz,
+        fields_avg, patch_steps, patch_step_size, patch_fields_avg
+    )
+
     # Save the results into the output arrays  # TODO: get rid of that
     new_x_offt[k], new_y_offt[k] = x_offt, y_offt
     new_px[k], new_py[k], new_pz[k] = px, py, pz
 
 
+def patch_launch_args(config, patch_fields_avg):
+    """
+    The patch arguments of ``move_smart_kernel`` and ``move_deposit_kernel``
+    for the interleaved ``patch_fields_avg`` or for no patch at all (None).
+    """
+    if patch_fields_avg is None:
+        return 0, config.grid_step_size, cp.zeros((1, 1, 1, 6))
+    return (config.field_patch_steps, patch_step_size(config),
+            patch_fields_avg.reshape((-1,) + patch_fields_avg.shape[-3:]))
+
+
+@profiled
 def move_smart(config,
                m, q, x_init, y_init, x_prev_offt, y_prev_offt,
                estimated_x_offt, estimated_y_offt, px_prev, py_prev, pz_prev,
-               Ex_avg, Ey_avg, Ez_avg, Bx_avg, By_avg, Bz_avg):
+               fields_avg, patch_fields_avg=None):
     """
     Update plasma particle coordinates and momenta according to the field
     values interpolated halfway between the previous plasma particle location
     and the the best estimation of its next location currently available to us.
     This is a convenience wrapper around the ``move_smart_kernel`` CUDA kernel.
+    The fields are passed interleaved (see ``interleave_fields``).
+    The evolving particle arrays and the fields may have a leading batch
+    dimension (see ``init``).
+    The fields of the field patch, if any, are passed as ``patch_fields_avg``.
     """
     x_offt_new = cp.zeros_like(x_prev_offt)
     y_offt_new = cp.zeros_like(y_prev_offt)
     px_new = cp.zeros_like(px_prev)
     py_new = cp.zeros_like(py_prev)
     pz_new = cp.zeros_like(pz_prev)
-    cfg = int(np.ceil(x_init.size / WARP_SIZE)), WARP_SIZE
+    threads = config.threads_per_block['move_smart']
+    cfg = int(np.ceil(x_prev_offt.size / threads)), threads, launch_stream()
     move_smart_kernel[cfg](config.xi_step_size, config.reflect_boundary,
                            config.grid_step_size, config.grid_steps,
                            m.ravel(), q.ravel(),
@@ -816,27 +1382,572 @@ def move_smart(config,
                            x_prev_offt.ravel(), y_prev_offt.ravel(),
                            estimated_x_offt.ravel(), estimated_y_offt.ravel(),
                            px_prev.ravel(), py_prev.ravel(), pz_prev.ravel(),
-                           Ex_avg, Ey_avg, Ez_avg, Bx_avg, By_avg, Bz_avg,
+                           fields_avg.reshape((-1,) + fields_avg.shape[-3:]),
+                           *patch_launch_args(config, patch_fields_avg),
                            x_offt_new.ravel(), y_offt_new.ravel(),
                            px_new.ravel(), py_new.ravel(), pz_new.ravel())
-    numba.cuda.synchronize()
+    synchronize()
     return x_offt_new, y_offt_new, px_new, py_new, pz_new
 
 
+# Pushing and deposition, fused and tiled #
+
+#: Coarse particles tile side length for ``move_deposit_kernel``.
+FUSED_TILE_SIZE = 8
+#: Side length of the ``move_deposit_kernel`` tile-local accumulator in cells.
+#: Has to be a compile-time constant. Deposition outside of it, be it
+#: due to large ``plasma_coarseness`` or particles travelling far away,
+#: falls back to global memory atomics.
+FUSED_TILE_CELLS = 32
+#: Threads per ``move_deposit_kernel`` block, unless tuned (see ``init``).
+FUSED_TILE_THREADS = 128
+
+
+@numba.jit(inline=True)
+def deposit9_tile(tile, a, oi, oj, i, j, val,
+                  wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM):
+    """
+    Deposit value into a cell and 8 surrounding cells (using `weights` output)
+    of the tile-local accumulator ``tile`` with its corner in cell ``oi, oj``,
+    or directly into the grid ``a`` if they do not fit into ``tile``.
+    """
+    ti, tj = i - oi, j - oj
+    if 1 <= ti < FUSED_TILE_CELLS - 1 and 1 <= tj < FUSED_TILE_CELLS - 1:
+        deposit9(tile, ti, tj, val,
+                 wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+    else:
+        deposit9(a, i, j, val, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+
+
+@numba.cuda.jit(cache=True)
+def move_deposit_kernel(xi_step_size, reflect_boundary,
+                        grid_step_size, grid_steps,
+                        fine_weight, coarse_steps,
+                        tile_offset,
+                        ms, qs,
+                        x_init, y_init,
+                        prev_x_offt, prev_y_offt,
+                        estimated_x_offt, estimated_y_offt,
+                        prev_px, prev_py, prev_pz,
+                        fields_avg, patch_steps, patch_step_size,
+                        patch_fields_avg,
+                        fine_grid,
+                        influence_prev, influence_next,
+                        indices_prev, indices_next, tile_fine_starts,
+                        new_x_offt, new_y_offt, new_px, new_py, new_pz,
+                        out_ro, out_jx, out_jy, out_jz):
+    """
+    Move the coarse plasma particles like ``move_smart_kernel`` does
+    and immediately deposit the fine ones like ``deposit_kernel`` does,
+    one tile of ``FUSED_TILE_SIZE**2`` coarse particles per block.
+    The arguments follow the ones of these two kernels,
+    ``blockIdx.z`` enumerates the simulations in a batch
+    and the rows of tiles start from ``tile_offset``.
+    """
+    T, C = FUSED_TILE_SIZE, FUSED_TILE_CELLS
+    ti, tj, b = (numba.cuda.blockIdx.x + tile_offset, numba.cuda.blockIdx.y,
+                 numba.cuda.blockIdx.z)
+    t, threads = numba.cuda.threadIdx.x, numba.cuda.blockDim.x
+    ci0, cj0 = ti * T, tj * T  # the first coarse particle of the tile
+
+    # The tile coarse particles after the push plus a one-particle halo
+    # on the high side, as the fine particles between the tiles
+    # are virtualized from both of them.
+    tile_x_offt = numba.cuda.shared.array((T + 1, T + 1), numba.float64)
+    tile_y_offt = numba.cuda.shared.array((T + 1, T + 1), numba.float64)
+    tile_m = numba.cuda.shared.array((T + 1, T + 1), numba.float64)
+    tile_q = numba.cuda.shared.array((T + 1, T + 1), numba.float64)
+    tile_px = numba.cuda.shared.array((T + 1, T + 1), numba.float64)
+    tile_py = numba.cuda.shared.array((T + 1, T + 1), numba.float64)
+    tile_pz = numba.cuda.shared.array((T + 1, T + 1), numba.float64)
+    # The tile-local ro, jx, jy, jz accumulators, merged into the grids last.
+    tile_ro = numba.cuda.shared.array((C, C), numba.float64)
+    tile_jx = numba.cuda.shared.array((C, C), numba.float64)
+    tile_jy = numba.cuda.shared.array((C, C), numba.float64)
+    tile_jz = numba.cuda.shared.array((C, C), numba.float64)
+
+    # Push the tile particles along with the halo ones
+    # (the halo is pushed redundantly by the neighbouring tiles as well).
+    for h in range(t, (T + 1)**2, threads):
+        li, lj = h // (T + 1), h % (T + 1)
+        ci = min(ci0 + li, coarse_steps - 1)  # the halo of the last tile
+        cj = min(cj0 + lj, coarse_steps - 1)  # is clipped to the last row
+        c = ci * coarse_steps + cj
+        k = b * coarse_steps**2 + c
+        x_offt, y_offt, px, py, pz = move_smart_particle(
+            k, c, b, xi_step_size, reflect_boundary,
+            grid_step_size, grid_steps, ms, qs, x_init, y_init,
+            prev_x_offt, prev_y_offt, estimated_x_offt, estimated_y_offt,
+            prev_px, prev_py, prev_pz, fields_avg,
+            patch_steps, patch_step_size, patch_fields_avg
+        )
+        tile_x_offt[li, lj], tile_y_offt[li, lj] = x_offt, y_offt
+        tile_m[li, lj], tile_q[li, lj] = ms[c], qs[c]
+        tile_px[li, lj], tile_py[li, lj], tile_pz[li, lj] = px, py, pz
+        if li < T and lj < T and ci == ci0 + li and cj == cj0 + lj:
+            new_x_offt[k], new_y_offt[k] = x_offt, y_offt
+            new_px[k], new_py[k], new_pz[k] = px, py, pz
+    for h in range(t, C * C, threads):
+        li, lj = h // C, h % C
+        tile_ro[li, lj], tile_jx[li, lj] = 0, 0
+        tile_jy[li, lj], tile_jz[li, lj] = 0, 0
+    numba.cuda.syncthreads()
+
+    # Center the accumulator on the initial location of the tile.
+    c_lo = ci0 * coarse_steps + cj0
+    c_hi = (min(ci0 + T, coarse_steps - 1) * coarse_steps +
+            min(cj0 + T, coarse_steps - 1))
+    oi = (int(floor((x_init[c_lo] + x_init[c_hi]) / 2 / grid_step_size + .5))
+          + grid_steps // 2 - C // 2)
+    oj = (int(floor((y_init[c_lo] + y_init[c_hi]) / 2 / grid_step_size + .5))
+          + grid_steps // 2 - C // 2)
+
+    # Virtualize the fine particles of the tile and deposit them.
+    fi0, fj0 = tile_fine_starts[ti], tile_fine_starts[tj]
+    fine_i = tile_fine_starts[ti + 1] - fi0
+    fine_j = tile_fine_starts[tj + 1] - fj0
+    for h in range(t, fine_i * fine_j, threads):
+        fi, fj = fi0 + h // fine_j, fj0 + h % fine_j
+        A = influence_prev[fi] * influence_prev[fj]
+        B = influence_prev[fi] * influence_next[fj]
+        C_ = influence_next[fi] * influence_prev[fj]
+        D = influence_next[fi] * influence_next[fj]
+        # indices within the tile
+        pi, ni = indices_prev[fi] - ci0, indices_next[fi] - ci0
+        pj, nj = indices_prev[fj] - cj0, indices_next[fj] - cj0
+
+        x = fine_grid[fi] + mix(tile_x_offt, A, B, C_, D, pi, ni, pj, nj)
+        y = fine_grid[fj] + mix(tile_y_offt, A, B, C_, D, pi, ni, pj, nj)
+        virtplasma_smallness_factor = fine_weight[fi] * fine_weight[fj]
+        m = virtplasma_smallness_factor * mix(tile_m, A, B, C_, D,
+                                              pi, ni, pj, nj)
+        q = virtplasma_smallness_factor * mix(tile_q, A, B, C_, D,
+                                              pi, ni, pj, nj)
+        px = virtplasma_smallness_factor * mix(tile_px, A, B, C_, D,
+                                               pi, ni, pj, nj)
+        py = virtplasma_smallness_factor * mix(tile_py, A, B, C_, D,
+                                               pi, ni, pj, nj)
+        pz = virtplasma_smallness_factor * mix(tile_pz, A, B, C_, D,
+                                               pi, ni, pj, nj)
+
+        gamma_m = sqrt(m**2 + px**2 + py**2 + pz**2)
+        dro = q / (1 - pz / gamma_m)
+        djx = px * (dro / gamma_m)
+        djy = py * (dro / gamma_m)
+        djz = pz * (dro / gamma_m)
+
+        i, j, wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM = weights(
+            x, y, grid_steps, grid_step_size
+        )
+        deposit9_tile(tile_ro, out_ro[b], oi, oj, i, j, dro,
+                      wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+        deposit9_tile(tile_jx, out_jx[b], oi, oj, i, j, djx,
+                      wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+        deposit9_tile(tile_jy, out_jy[b], oi, oj, i, j, djy,
+                      wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+        deposit9_tile(tile_jz, out_jz[b], oi, oj, i, j, djz,
+                      wMP, w0P, wPP, wM0, w00, wP0, wMM, w0M, wPM)
+    numba.cuda.syncthreads()
+
+    # Merge the accumulator into the grids (the neighbouring tiles overlap).
+    for h in range(t, C * C, threads):
+        li, lj = h // C, h % C
+        i, j = oi + li, oj + lj
+        if 0 <= i < grid_steps and 0 <= j < grid_steps:
+            if tile_ro[li, lj] != 0:
+                numba.cuda.atomic.add(out_ro, (b, i, j), tile_ro[li, lj])
+            if tile_jx[li, lj] != 0:
+                numba.cuda.atomic.add(out_jx, (b, i, j), tile_jx[li, lj])
+            if tile_jy[li, lj] != 0:
+                numba.cuda.atomic.add(out_jy, (b, i, j), tile_jy[li, lj])
+            if tile_jz[li, lj] != 0:
+                numba.cuda.atomic.add(out_jz, (b, i, j), tile_jz[li, lj])
+
+
+@profiled
+def move_deposit(config, ro_initial, m, q, x_init, y_init,
+                 x_prev_offt, y_prev_offt, estimated_x_offt, estimated_y_offt,
+                 px_prev, py_prev, pz_prev, fields_avg, virt_params,
+                 tile_rows=None, patch_fields_avg=None):
+    """
+    Do what ``move_smart`` and then ``deposit`` do in a single pass.
+    This is a convenience wrapper around the ``move_deposit_kernel``
+    CUDA kernel. Returns the new coarse particles coordinates and momenta,
+    the charge density and the currents.
+    Only the rows of tiles from ``tile_rows[0]`` to ``tile_rows[1]``
+    are processed if ``tile_rows`` is specified.
+    The fields of the field patch, if any, are passed as ``patch_fields_avg``.
+    """
+    coarse_steps = m.shape[-1]
+    x_offt_new = cp.zeros_like(x_prev_offt)
+    y_offt_new = cp.zeros_like(y_prev_offt)
+    px_new = cp.zeros_like(px_prev)
+    py_new = cp.zeros_like(py_prev)
+    pz_new = cp.zeros_like(pz_prev)
+    shape = x_prev_offt.shape[:-2] + (config.grid_steps, config.grid_steps)
+    ro, jx, jy, jz = [cp.zeros(shape) for _ in range(4)]
+    batch_size = int(np.prod(x_prev_offt.shape[:-2]))
+    tiles = len(virt_params.tile_fine_starts) - 1
+    first_row, last_row = (0, tiles) if tile_rows is None else tile_rows
+    threads = config.threads_per_block['move_deposit']
+    cfg = (last_row - first_row, tiles, batch_size), threads, launch_stream()
+    move_deposit_kernel[cfg](config.xi_step_size, config.reflect_boundary,
+                             config.grid_step_size, config.grid_steps,
+                             virt_params.fine_weight, coarse_steps,
+                             first_row,
+                             m.ravel(), q.ravel(),
+                             x_init.ravel(), y_init.ravel(),
+                             x_prev_offt.ravel(), y_prev_offt.ravel(),
+                             estimated_x_offt.ravel(),
+                             estimated_y_offt.ravel(),
+                             px_prev.ravel(), py_prev.ravel(), pz_prev.ravel(),
+                             fields_avg.reshape((-1,) + fields_avg.shape[-3:]),
+                             *patch_launch_args(config, patch_fields_avg),
+                             virt_params.fine_grid,
+                             virt_params.influence_prev,
+                             virt_params.influence_next,
+                             virt_params.indices_prev,
+                             virt_params.indices_next,
+                             virt_params.tile_fine_starts,
+                             x_offt_new.ravel(), y_offt_new.ravel(),
+                             px_new.ravel(), py_new.ravel(), pz_new.ravel(),
+                             batched(ro), batched(jx),
+                             batched(jy), batched(jz))
+    # Also add the background ion charge density.
+    ro += ro_initial  # Do it last to preserve more float precision
+    synchronize()
+    return x_offt_new, y_offt_new, px_new, py_new, pz_new, ro, jx, jy, jz
+
+
+# Splitting the plasma between several GPUs #
+
+@functools.lru_cache()
+def slab_executor(gpus):
+    """
+    Make a pool of threads to drive the ``gpus`` GPUs concurrently.
+    """
+    return concurrent.futures.ThreadPoolExecutor(gpus)
+
+
+def copy_rows(dst, src, lo, hi):
+    """
+    Copy rows ``lo:hi`` of a C-contiguous array ``src``
+    into the same rows of ``dst``, which may reside on another GPU.
+    """
+    if hi > lo:
+        dst[lo:hi].data.copy_from_device(src[lo:hi].data, src[lo:hi].nbytes)
+
+
+def rows_touched(config, x_min, x_max):
+    """
+    Determine the range of grid rows the TSC stencils of the particles
+    with ``x_min <= x <= x_max`` can reach.
+    """
+    h, N = config.grid_step_size, config.grid_steps
+    lo = int(floor(x_min / h + .5)) + N // 2 - 1
+    hi = int(floor(x_max / h + .5)) + N // 2 + 2
+    return max(lo, 0), min(hi, N)
+
+
+@profiled
+def move_deposit_slabs(config, const, virt_params, prev, x_offt, y_offt,
+                       fields_avg):
+    """
+    Do what ``move_deposit`` does, splitting the plasma between the GPUs
+    listed in ``config.slab_gpu_indices`` as slabs of rows of tiles
+    (see ``move_deposit_kernel``).
+
+    Every GPU pushes its own slab (plus the halo row of particles
+    the neighbouring slab owns, just like every tile does)
+    and deposits its own fine particles.
+    Only the grid rows the particles of a slab can reach are transferred:
+    the fields rows to the GPU and the charge density and currents rows back,
+    where they are summed up.
+    The arrays passed and returned reside on the current GPU,
+    which solves for the fields. Batches are not supported.
+    """
+    gpu_indices = config.slab_gpu_indices
+    plasma_params = (config.grid_steps - config.plasma_padding_steps * 2,
+                     config.grid_step_size,
+                     config.plasma_coarseness, config.plasma_fineness,
+                     config.plasma_fineness_center,
+                     config.plasma_fineness_center_steps)
+    tiles = len(virt_params.tile_fine_starts) - 1
+    coarse_steps = const.m.shape[-1]
+    bounds = np.linspace(0, tiles, len(gpu_indices) + 1).round().astype(int)
+    tile_fine_starts = virt_params.tile_fine_starts.get()
+    particles_in = (prev.x_offt, prev.y_offt, x_offt, y_offt,
+                    prev.px, prev.py, prev.pz)
+
+    def work(slab):
+        first_row, last_row = bounds[slab], bounds[slab + 1]
+        if first_row == last_row:
+            return None  # more GPUs than rows of tiles
+        # the particles this slab pushes, including the halo row
+        lo = first_row * FUSED_TILE_SIZE
+        hi = min(last_row * FUSED_TILE_SIZE + 1, coarse_steps)
+        gpu = gpu_indices[slab]
+        with cp.cuda.Device(gpu), numba.cuda.gpus[gpu]:
+            slab_const, slab_virt_params = cached_plasma(*plasma_params)
+            particles = [cp.zeros(a.shape) for a in particles_in]
+            for local, a in zip(particles, particles_in):
+                copy_rows(local, a, lo, hi)
+
+            # Only the fields around the midpoints are interpolated.
+            x_init = slab_const.x_init[lo:hi]
+            x_prev, x_estimated = (x_init + particles[0][lo:hi],
+                                   x_init + particles[2][lo:hi])
+            fields_lo, fields_hi = rows_touched(
+                config, min(float(x_prev.min()), float(x_estimated.min())),
+                max(float(x_prev.max()), float(x_estimated.max()))
+            )
+            fields = cp.empty(fields_avg.shape)
+            copy_rows(fields, fields_avg, fields_lo, fields_hi)
+
+            return move_deposit(config, 0, slab_const.m, slab_const.q,
+                                slab_const.x_init, slab_const.y_init,
+                                *particles, fields, slab_virt_params,
+                                tile_rows=(first_row, last_row))
+
+    # the slabs copy their inputs on their own GPUs' streams,
+    # so the ones computing them on this GPU have to be done first
+    cp.cuda.get_current_stream().synchronize()
+    slabs = list(slab_executor(len(gpu_indices)).map(work,
+                                                     range(len(gpu_indices))))
+
+    particles = [cp.zeros_like(a) for a in particles_in[:5]]
+    for slab, results in enumerate(slabs):
+        if results is None:
+            continue
+        lo = bounds[slab] * FUSED_TILE_SIZE
+        hi = min(bounds[slab + 1] * FUSED_TILE_SIZE, coarse_steps)
+        for a, slab_a in zip(particles, results[:5]):
+            copy_rows(a, slab_a, lo, hi)
+
+    ro, jx, jy, jz = [cp.zeros(const.ro_initial.shape) for _ in range(4)]
+    for slab, results in enumerate(slabs):
+        if results is None:
+            continue
+        first_row, last_row = bounds[slab], bounds[slab + 1]
+        # The fine particles of the slab are offset from their initial
+        # positions by a mix of the offsets of its coarse particles
+        # and the halo row, which only the next slab has pushed for real.
+        x_offt = particles[0][first_row * FUSED_TILE_SIZE:
+                              min(last_row * FUSED_TILE_SIZE + 1,
+                                  coarse_steps)]
+        fine_lo = int(tile_fine_starts[first_row])
+        fine_hi = int(tile_fine_starts[last_row]) - 1
+        roj_lo, roj_hi = rows_touched(
+            config,
+            float(virt_params.fine_grid[fine_lo]) + float(x_offt.min()),
+            float(virt_params.fine_grid[fine_hi]) + float(x_offt.max())
+        )
+        for a, slab_a in zip((ro, jx, jy, jz), results[5:]):
+            rows = cp.empty(a.shape)
+            copy_rows(rows, slab_a, roj_lo, roj_hi)
+            a[roj_lo:roj_hi] += rows[roj_lo:roj_hi]
+    # Also add the background ion charge density.
+    ro += const.ro_initial  # Do it last to preserve more float precision
+    return (*particles, ro, jx, jy, jz)
+
+
+# Ahead-of-time kernel compilation #
+
+# The argument types that ``deposit`` and ``move_smart`` launch the kernels
+# with. Arrays are declared with 'A' (any) layout, so that both contiguous
+# and transposed ``cupy`` arrays are accepted by the same compiled kernel.
+_i8, _f8 = numba.int64, numba.float64
+_i8_1d, _f8_1d, _f8_2d = numba.int64[:], numba.float64[:], numba.float64[:, :]
+_f8_3d = numba.float64[:, :, :]  # batches of 2D arrays, see ``batched``
+
+#: Argument types of ``deposit_kernel`` and ``deposit_patch_kernel``,
+#: see ``precompile``.
+DEPOSIT_KERNEL_SIGNATURE = ((_i8, _f8, _f8_1d) + (_f8_3d,) * 2 +
+                            (_f8_2d,) * 2 +
+                            (_f8_3d,) * 3 +
+                            (_f8_1d,) * 3 + (_i8_1d,) * 2 + (_f8_3d,) * 4)
+
+#: Argument types of ``move_smart_kernel``, see ``precompile``.
+MOVE_SMART_KERNEL_SIGNATURE = ((_f8, _f8, _f8, _i8) + (_f8_1d,) * 11 +
+                               (numba.float64[:, :, :, ::1],) +  # interleaved
+                               (_i8, _f8, numba.float64[:, :, :, ::1]) +
+                               (_f8_1d,) * 5)
+
+#: Argument types of ``move_deposit_kernel``, see ``precompile``.
+MOVE_DEPOSIT_KERNEL_SIGNATURE = ((_f8, _f8, _f8, _i8, _f8_1d, _i8, _i8) +
+                                 (_f8_1d,) * 11 +
+                                 (numba.float64[:, :, :, ::1],) +
+                                 (_i8, _f8, numba.float64[:, :, :, ::1]) +
+                                 (_f8_1d,) * 3 + (_i8_1d,) * 3 +
+                                 (_f8_1d,) * 5 + (_f8_3d,) * 4)
+
+
+def precompile():
+    """
+    Compile the CUDA kernels for the argument types we actually launch them
+    with, or load them from the on-disk cache if they were compiled before
+    (see ``NUMBA_CACHE_DIR``). Returns the time it took in seconds.
+    """
+    start = time.perf_counter()
+    deposit_kernel.compile(DEPOSIT_KERNEL_SIGNATURE)
+    deposit_patch_kernel.compile(DEPOSIT_KERNEL_SIGNATURE)
+    move_smart_kernel.compile(MOVE_SMART_KERNEL_SIGNATURE)
+    move_deposit_kernel.compile(MOVE_DEPOSIT_KERNEL_SIGNATURE)
+    return time.perf_counter() - start
+
+
 # The scheme of a single step in xi #
 
-def step(config, const, virt_params, prev, beam_ro):
+def interleave_fields(Ex, Ey, Ez, Bx, By, Bz, prev=None):
+    """
+    Store the fields interleaved in a single array
+    (``fields[..., i, j, :]`` are the six components in cell ``i, j``),
+    which is how ``move_smart`` accepts them.
+    If ``prev`` is passed, average the fields with the ``prev`` ones
+    on the way, writing the results directly into the interleaved array.
+    """
+    fields = cp.empty(Ex.shape + (6,))
+    if prev is None:
+        for k, component in enumerate((Ex, Ey, Ez, Bx, By, Bz)):
+            fields[..., k] = component
+    else:
+        for k, (component, prev_component) in enumerate(zip(
+                (Ex, Ey, Ez, Bx, By, Bz),
+                (prev.Ex, prev.Ey, prev.Ez, prev.Bx, prev.By, prev.Bz))):
+            cp.add(component, prev_component, out=fields[..., k])
+        fields /= 2
+    return fields
+
+
+#: How many steps before ``prev`` does each ``config.field_predictor`` need.
+FIELD_PREDICTOR_DEPTHS = {None: 0, 'linear': 1, 'quadratic': 2}
+
+
+def predict_fields_avg(config, prev, fields):
+    """
+    Estimate the fields averaged over the new step by extrapolating
+    the interleaved ``fields`` of ``prev`` and the ones of the steps before
+    (``prev.fields_history``) linearly or quadratically,
+    depending on ``config.field_predictor``.
+    Without a predictor, the fields of ``prev`` are used as they are.
+    """
+    history = prev.fields_history
+    if config.field_predictor is None:
+        return fields
+    elif config.field_predictor == 'linear':
+        predicted = 2 * fields - history[0]
+    elif config.field_predictor == 'quadratic':
+        predicted = 3 * fields - 3 * history[0] + history[1]
+    return (predicted + fields) / 2
+
+
+def move_and_deposit(config, const, virt_params, prev, x_offt, y_offt,
+                     fields_avg, patch_fields_avg=None):
+    """
+    Move the plasma particles from ``prev`` with ``fields_avg``
+    (and ``patch_fields_avg`` near the axis, if there is a field patch)
+    (using ``x_offt``, ``y_offt`` as the estimation of the new coordinates)
+    and deposit them, in one pass if ``config.fused_push_deposit`` is set,
+    on several GPUs if ``config.slab_gpu_indices`` is set.
+    Returns the new coarse particles coordinates and momenta,
+    the charge density and the currents,
+    and the charge density and the currents on the field patch
+    (a tuple of them, or None if there is no patch).
+    """
+    if config.slab_gpu_indices:
+        return (*move_deposit_slabs(config, const, virt_params, prev,
+                                    x_offt, y_offt, fields_avg), None)
+    if config.fused_push_deposit:
+        x_offt, y_offt, px, py, pz, ro, jx, jy, jz = move_deposit(
+            config, const.ro_initial, const.m, const.q,
+            const.x_init, const.y_init,
+            prev.x_offt, prev.y_offt, x_offt, y_offt,
+            prev.px, prev.py, prev.pz, fields_avg, virt_params,
+            patch_fields_avg=patch_fields_avg
+        )
+    else:
+        x_offt, y_offt, px, py, pz = move_smart(
+            config, const.m, const.q, const.x_init, const.y_init,
+            prev.x_offt, prev.y_offt, x_offt, y_offt,
+            prev.px, prev.py, prev.pz, fields_avg, patch_fields_avg
+        )
+        ro, jx, jy, jz = deposit(config, const.ro_initial, x_offt, y_offt,
+                                 const.m, const.q, px, py, pz, virt_params)
+    patch_roj = None
+    if patch_fields_avg is not None:
+        patch_roj = deposit(config, const.patch_ro_initial, x_offt, y_offt,
+                            const.m, const.q, px, py, pz, virt_params,
+                            patch=True)
+    return x_offt, y_offt, px, py, pz, ro, jx, jy, jz, patch_roj
+
+
+def patch_fields_round(config, const, prev, patch_fields_avg, coarse_fields,
+                       beam_ro, beam_amplitude, patch_roj):
+    """
+    Calculate the fields on the field patch like a corrector round of ``step``
+    does on the main grid, from the charge density and currents
+    deposited on the patch (``patch_roj``) and the patch-sampled beam,
+    with the perimeter values taken from the ``coarse_fields``
+    (Ex, Ey, Ez, Bx, By, Bz) as they were solved from the same sources,
+    see ``calculate_patch_fields``.
+    Returns the new interleaved patch fields.
+    """
+    ro, jx, jy, jz = patch_roj
+    if config.field_solver_variant_A:
+        ro, jz = (ro + prev.patch_ro) / 2, (jz + prev.patch_jz) / 2
+    Ex, Ey, Ez, Bx, By, Bz = calculate_patch_fields(
+        config, coarse_fields,
+        patch_fields_avg[..., 0], patch_fields_avg[..., 1],
+        patch_fields_avg[..., 3], patch_fields_avg[..., 4],
+        beam_ro, ro, jx, jy, jz, prev.patch_jx, prev.patch_jy
+    )
+    if beam_amplitude is not None:
+        Ex, Ey, Bx, By = add_beam_fields(const.patch_beam_Ex,
+                                         const.patch_beam_Ey,
+                                         beam_amplitude, Ex, Ey, Bx, By)
+    if config.field_solver_variant_A:
+        prev_fields = prev.patch_fields
+        Ex, Ey = 2 * Ex - prev_fields[..., 0], 2 * Ey - prev_fields[..., 1]
+        Bx, By = 2 * Bx - prev_fields[..., 3], 2 * By - prev_fields[..., 4]
+    return interleave_fields(Ex, Ey, Ez, Bx, By, Bz)
+
+
+def step(config, const, virt_params, prev, beam_ro, beam_amplitude=None,
+         patch_beam_ro=None):
     """
     Calculate the next iteration of plasma evolution and response.
     Returns the new state with the following attributes:
     ``x_offt``, ``y_offt``, ``px``, ``py``, ``pz``,
     ``Ex``, ``Ey``, ``Ez``, ``Bx``, ``By``, ``Bz``,
-    ``ro``, ``jx``, ``jy``, ``jz``.
+    ``ro``, ``jx``, ``jy``, ``jz``,
+    the fields of the earlier steps for ``predict_fields_avg``
+    (``fields_history``) and the largest change of the fields
+    in the last of the ``config.corrector_rounds`` (``field_correction``).
     Pass the returned value as ``prev`` for the next iteration.
     Wrap it in ``GPUArraysView`` if you want transparent conversion
     to ``numpy`` arrays.
+
+    If ``config.beam_profile`` is set, the beam can be specified
+    by its ``beam_amplitude`` instead (with ``beam_ro`` of None),
+    then the beam fields precomputed by ``init`` are scaled and added.
+
+    If ``config.field_patch_steps`` is set, the state also holds
+    the fields, the charge density and the currents on the field patch
+    (``patch_fields``, interleaved, ``patch_ro``, ``patch_jx``, ``patch_jy``,
+    ``patch_jz``), and the beam has to be sampled on the patch as well
+    (``patch_beam_ro``, see ``patch_grid``) unless it is specified
+    by its ``beam_amplitude``.
     """
-    beam_ro = cp.asarray(beam_ro)  # copy the array is on GPU if it's not there
+    patch = config.field_patch_steps is not None
+    if beam_amplitude is None:
+        beam_ro = cp.asarray(beam_ro)  # copy the array to GPU if needed
+        if patch:
+            patch_beam_ro = cp.asarray(patch_beam_ro)
+    else:
+        beam_ro = patch_beam_ro = 0  # the beam fields are added after solving
+        # a scalar or one amplitude for each simulation in a batch
+        beam_amplitude = cp.asarray(beam_amplitude, dtype=float)
+        beam_amplitude = beam_amplitude[..., None, None]
 
     # Estimate the midpoint particle position without knowing the fields yet
     # TODO: use regular pusher and pass zero fields? previous fields?
@@ -845,100 +1956,534 @@ def step(config, const, virt_params, prev, beam_ro):
                                              prev.x_offt, prev.y_offt,
                                              prev.px, prev.py, prev.pz)
 
-    # Interpolate fields in midpoint and move particles with previous fields.
-    x_offt, y_offt, px, py, pz = move_smart(
-        config, const.m, const.q, const.x_init, const.y_init,
-        prev.x_offt, prev.y_offt, x_offt, y_offt, prev.px, prev.py, prev.pz,
-        # no halfstep-averaged fields yet
-        prev.Ex, prev.Ey, prev.Ez, prev.Bx, prev.By, prev.Bz
-    )
-    # Recalculate the plasma density and currents.
-    ro, jx, jy, jz = deposit(
-        config, const.ro_initial, x_offt, y_offt, const.m, const.q, px, py, pz,
-        virt_params
-    )
-
-    # Calculate the fields.
-    ro_in = ro if not config.field_solver_variant_A else (ro + prev.ro) / 2
-    jz_in = jz if not config.field_solver_variant_A else (jz + prev.jz) / 2
-    Ex, Ey, Bx, By = calculate_Ex_Ey_Bx_By(config,
-                                           prev.Ex, prev.Ey, prev.Bx, prev.By,
-                                           # no halfstep-averaged fields yet
-                                           beam_ro, ro_in, jx, jy, jz_in,
-                                           prev.jx, prev.jy)
-    if config.field_solver_variant_A:
-        Ex, Ey = 2 * Ex - prev.Ex, 2 * Ey - prev.Ey
-        Bx, By = 2 * Bx - prev.Bx, 2 * By - prev.By
-
-    Ez = calculate_Ez(config, jx, jy)
-    Bz = calculate_Bz(config, jx, jy)
-
-    Ex_avg = (Ex + prev.Ex) / 2
-    Ey_avg = (Ey + prev.Ey) / 2
-    Ez_avg = (Ez + prev.Ez) / 2
-    Bx_avg = (Bx + prev.Bx) / 2
-    By_avg = (By + prev.By) / 2
-    Bz_avg = (Bz + prev.Bz) / 2
-
-    # Repeat the previous procedure using averaged fields.
-    x_offt, y_offt, px, py, pz = move_smart(
-        config, const.m, const.q, const.x_init, const.y_init,
-        prev.x_offt, prev.y_offt, x_offt, y_offt,
-        prev.px, prev.py, prev.pz,
-        Ex_avg, Ey_avg, Ez_avg, Bx_avg, By_avg, Bz_avg
-    )
-    ro, jx, jy, jz = deposit(config, const.ro_initial, x_offt, y_offt,
-                             const.m, const.q, px, py, pz, virt_params)
-
-    ro_in = ro if not config.field_solver_variant_A else (ro + prev.ro) / 2
-    jz_in = jz if not config.field_solver_variant_A else (jz + prev.jz) / 2
-    Ex, Ey, Bx, By = calculate_Ex_Ey_Bx_By(config,
-                                           Ex_avg, Ey_avg, Bx_avg, By_avg,
-                                           beam_ro, ro_in, jx, jy, jz_in,
-                                           prev.jx, prev.jy)
-    if config.field_solver_variant_A:
-        Ex, Ey = 2 * Ex - prev.Ex, 2 * Ey - prev.Ey
-        Bx, By = 2 * Bx - prev.Bx, 2 * By - prev.By
-
-    Ez = calculate_Ez(config, jx, jy)
-    Bz = calculate_Bz(config, jx, jy)
-
-    Ex_avg = (Ex + prev.Ex) / 2
-    Ey_avg = (Ey + prev.Ey) / 2
-    Ez_avg = (Ez + prev.Ez) / 2
-    Bx_avg = (Bx + prev.Bx) / 2
-    By_avg = (By + prev.By) / 2
-    Bz_avg = (Bz + prev.Bz) / 2
-
-    # Repeat the previous procedure using averaged fields once again.
-    x_offt, y_offt, px, py, pz = move_smart(
-        config, const.m, const.q, const.x_init, const.y_init,
-        prev.x_offt, prev.y_offt, x_offt, y_offt,
-        prev.px, prev.py, prev.pz,
-        Ex_avg, Ey_avg, Ez_avg, Bx_avg, By_avg, Bz_avg
+    # Interpolate fields in midpoint and move particles with previous fields
+    # (or the extrapolated halfstep-averaged ones),
+    # recalculate the plasma density and currents.
+    fields = interleave_fields(prev.Ex, prev.Ey, prev.Ez,
+                               prev.Bx, prev.By, prev.Bz)
+    fields_avg = predict_fields_avg(config, prev, fields)
+    patch_fields_avg = prev.patch_fields if patch else None
+    x_offt, y_offt, px, py, pz, ro, jx, jy, jz, patch_roj = move_and_deposit(
+        config, const, virt_params, prev, x_offt, y_offt,
+        fields_avg, patch_fields_avg
     )
-    ro, jx, jy, jz = deposit(config, const.ro_initial, x_offt, y_offt,
-                             const.m, const.q, px, py, pz, virt_params)
+    patch_fields = prev.patch_fields
+
+    for _ in range(config.corrector_rounds):
+        Ex_avg, Ey_avg, Bx_avg, By_avg = (fields_avg[..., 0],
+                                          fields_avg[..., 1],
+                                          fields_avg[..., 3],
+                                          fields_avg[..., 4])
+
+        # Calculate the fields.
+        ro_in = ro if not config.field_solver_variant_A else (ro + prev.ro) / 2
+        jz_in = jz if not config.field_solver_variant_A else (jz + prev.jz) / 2
+        Ex, Ey, Bx, By = calculate_Ex_Ey_Bx_By(config,
+                                               Ex_avg, Ey_avg, Bx_avg, By_avg,
+                                               beam_ro, ro_in, jx, jy, jz_in,
+                                               prev.jx, prev.jy)
+        coarse_fields = Ex, Ey, Bx, By  # as solved, for the patch perimeter
+        if beam_amplitude is not None:
+            Ex, Ey, Bx, By = add_beam_fields(const.beam_Ex, const.beam_Ey,
+                                             beam_amplitude, Ex, Ey, Bx, By)
+        if config.field_solver_variant_A:
+            Ex, Ey = 2 * Ex - prev.Ex, 2 * Ey - prev.Ey
+            Bx, By = 2 * Bx - prev.Bx, 2 * By - prev.By
+
+        Ez = calculate_Ez(config, jx, jy)
+        Bz = calculate_Bz(config, jx, jy)
+
+        if patch:
+            Ex_c, Ey_c, Bx_c, By_c = coarse_fields
+            patch_fields = patch_fields_round(
+                config, const, prev, patch_fields_avg,
+                (Ex_c, Ey_c, Ez, Bx_c, By_c, Bz),
+                patch_beam_ro, beam_amplitude, patch_roj
+            )
+            patch_fields_avg = (patch_fields + prev.patch_fields) / 2
+
+        # Repeat the previous procedure using averaged fields.
+        fields_avg_prev = fields_avg
+        fields_avg = interleave_fields(Ex, Ey, Ez, Bx, By, Bz, prev)
+        x_offt, y_offt, px, py, pz, ro, jx, jy, jz, patch_roj = \
+            move_and_deposit(config, const, virt_params, prev,
+                             x_offt, y_offt, fields_avg, patch_fields_avg)
 
     # TODO: what do we need that roj_new for, jx_prev/jy_prev only?
 
+    # How much did the last round change the fields? Should be small.
+    field_correction = cp.abs(fields_avg - fields_avg_prev).max()
+
+    # The fields of the earlier steps, the latest first.
+    depth = FIELD_PREDICTOR_DEPTHS[config.field_predictor]
+    fields_history = cp.concatenate((fields[None],
+                                     prev.fields_history))[:depth]
+
+    patch_ro, patch_jx, patch_jy, patch_jz = (
+        patch_roj if patch else
+        (prev.patch_ro, prev.patch_jx, prev.patch_jy, prev.patch_jz)
+    )
+
     # Return the array collection that would serve as `prev` for the next step.
     new_state = GPUArrays(x_offt=x_offt, y_offt=y_offt, px=px, py=py, pz=pz,
                           Ex=Ex.copy(), Ey=Ey.copy(), Ez=Ez.copy(),
                           Bx=Bx.copy(), By=By.copy(), Bz=Bz.copy(),
-                          ro=ro, jx=jx, jy=jy, jz=jz)
+                          ro=ro, jx=jx, jy=jy, jz=jz,
+                          fields_history=fields_history,
+                          field_correction=field_correction,
+                          patch_fields=patch_fields, patch_ro=patch_ro,
+                          patch_jx=patch_jx, patch_jy=patch_jy,
+                          patch_jz=patch_jz)
 
     return new_state
 
 
+# Replaying whole steps as CUDA graphs #
+
+class CapturedStep:
+    """
+    A replacement for ``step`` that records a whole step,
+    from the initial push estimation to the last corrector round,
+    into a CUDA graph once and then replays it
+    (see ``config_example.cuda_graph``).
+    A replay launches all the kernels, transforms and copies of the step
+    with a single call, so the Python overhead of dispatching them,
+    which dominates the small grids, is gone.
+
+    The first call makes a regular ``step``, which creates the solver matrices
+    and the FFT plans, and then captures the next one on a dedicated stream,
+    reading and writing the preallocated state and beam buffers.
+    Every replay updates the state in place, so the same object is returned
+    every time and is overwritten by the next call:
+    copy the arrays you want to keep.
+
+    Usage: ``advance = CapturedStep(config, const, virt_params)``, then
+    ``state = advance(state, beam_ro)`` instead of ``step``.
+    """
+    def __init__(self, config, const, virt_params):
+        self.config, self.const, self.virt_params = config, const, virt_params
+        self.graph = self.state = self.beam = None
+        self.stream = self.pool = None
+
+    def __call__(self, prev, beam_ro, beam_amplitude=None, patch_beam_ro=None):
+        """
+        Make a step from ``prev`` with the beam specified like for ``step``.
+        """
+        beam = {'beam_ro': beam_ro, 'beam_amplitude': beam_amplitude,
+                'patch_beam_ro': patch_beam_ro}
+        if self.graph is None:
+            new_state = step(self.config, self.const, self.virt_params, prev,
+                             **beam)
+            self.capture(new_state, beam)
+            return self.state
+
+        current = cp.cuda.get_current_stream()
+        self.stream.wait_event(current.record())
+        with self.stream:
+            if prev is not self.state:
+                for name, a in vars(self.state).items():
+                    a[...] = getattr(prev, name)
+            for name, value in beam.items():
+                if self.beam[name] is not None:
+                    self.beam[name][...] = cp.asarray(value)
+            self.graph.launch()
+        current.wait_event(self.stream.record())
+        return self.state
+
+    def capture(self, state, beam):
+        """
+        Allocate the buffers, initialize the state ones with ``state``
+        and capture a step advancing them in place.
+        """
+        self.state = GPUArrays(**{name: a.copy()
+                                  for name, a in vars(state).items()})
+        patch = self.config.field_patch_steps is not None
+        if beam['beam_amplitude'] is None:
+            self.beam = {'beam_ro': cp.zeros(state.Ex.shape),
+                         'beam_amplitude': None,
+                         'patch_beam_ro': (cp.zeros(state.patch_ro.shape)
+                                           if patch else None)}
+        else:
+            amplitude_shape = np.shape(beam['beam_amplitude'])
+            self.beam = {'beam_ro': None,
+                         'beam_amplitude': cp.zeros(amplitude_shape),
+                         'patch_beam_ro': None}
+
+        # The temporary arrays of the step get a memory pool of their own,
+        # so that nothing else reuses the memory the graph is bound to.
+        # Under a budget, it gets what the default one has left of it,
+        # and the default one is capped at what the graph has left.
+        self.stream = cp.cuda.Stream(non_blocking=True)
+        self.pool = cp.cuda.MemoryPool()
+        default_pool = cp.get_default_memory_pool()
+        if self.config.memory_budget is not None:
+            self.pool.set_limit(size=max(default_pool.get_limit() -
+                                         default_pool.total_bytes(), 1))
+        # numba must not synchronize the stream it is launching on
+        interface_sync = numba.config.CUDA_ARRAY_INTERFACE_SYNC
+        numba.config.CUDA_ARRAY_INTERFACE_SYNC = False
+        try:
+            with cp.cuda.using_allocator(self.pool.malloc), self.stream:
+                self.stream.begin_capture(
+                    cp.cuda.runtime.streamCaptureModeRelaxed
+                )
+                try:
+                    new_state = step(self.config, self.const,
+                                     self.virt_params, self.state,
+                                     **self.beam)
+                    for name, a in vars(self.state).items():
+                        a[...] = getattr(new_state, name)
+                    del new_state
+                finally:
+                    self.graph = self.stream.end_capture()
+        finally:
+            numba.config.CUDA_ARRAY_INTERFACE_SYNC = interface_sync
+        if self.config.memory_budget is not None:
+            default_pool.set_limit(size=default_pool.get_limit() -
+                                   self.pool.total_bytes())
+
+
+# Memory estimation and budgeting #
+
+#: Rough host and GPU memory taken by the Python interpreter, the libraries
+#: and the CUDA context regardless of the grid size, in bytes.
+MEMORY_OVERHEAD = 300 * 2**20
+
+
+def estimate_memory(config, batch_size=None):
+    """
+    Predict the peak host and GPU memory usage (in bytes) of a simulation
+    with ``config`` by counting the arrays alive at the peak of ``step``,
+    without allocating anything.
+    Returns a dictionary with the ``host`` and ``device`` totals,
+    the ``device_arrays`` part of the latter (the rest is
+    ``MEMORY_OVERHEAD``) and the amount of batch members the field solvers
+    have to transform at once to fit into ``config.memory_budget``
+    (``transform_chunk``, None if there is no budget).
+    """
+    K = 1 if batch_size is None else batch_size
+    N = config.grid_steps
+    plasma_steps = N - config.plasma_padding_steps * 2
+    Nc = len(make_coarse_plasma_grid(plasma_steps, config.grid_step_size,
+                                     config.plasma_coarseness))
+    fine_grid, _ = refine_fine_plasma_grid(
+        make_fine_plasma_grid(plasma_steps, config.grid_step_size,
+                              config.plasma_fineness),
+        config.grid_step_size, config.plasma_fineness,
+        config.plasma_fineness_center, config.plasma_fineness_center_steps
+    )
+    grid, coarse, fine = 8 * N**2, 8 * Nc**2, 8 * len(fine_grid)
+
+    # const, virt_params and the memoized solver matrices
+    shared = 2 * coarse + grid + 7 * fine + 3 * grid
+    if config.beam_profile is not None:
+        shared += 2 * grid  # the precomputed beam fields
+    # prev state; new and estimated particles; the fields of the previous pass
+    # and their averages; ro, j and their variant A averages; the beam;
+    # field solvers right hand sides and results
+    per_member = ((10 * grid + 5 * coarse) + 7 * coarse + 12 * grid +
+                  6 * grid + grid + 8 * grid)
+    # the fields of the earlier steps kept for the predictor
+    per_member += 6 * grid * FIELD_PREDICTOR_DEPTHS[config.field_predictor]
+    if config.field_patch_steps is not None:
+        patch = 8 * config.field_patch_steps**2
+        # ro_initial, the beam fields and the solver matrices
+        shared += 3 * patch + 2 * patch
+        # prev patch state; the new fields and their averages;
+        # ro, j and their averages; right hand sides, results and transforms
+        per_member += 10 * patch + 12 * patch + 6 * patch + 6 * 8 * patch
+    tracks = 0
+    if config.tracked_particles is not None:
+        # the trajectory buffer (a region may cover all the particles)
+        tracked = config.tracked_particles
+        tracked = (Nc**2 if callable(tracked) else
+                   tracked if isinstance(tracked, (int, np.integer)) else
+                   len(tracked))
+        tracks = 5 * 8 * config.tracking_block_steps * min(tracked, Nc**2)
+        shared += tracks
+    # a transform in flight: padded buffer, spectrum, cuFFT work area, result
+    per_transform = (4 + 4 + 4 + 1) * grid
+    # cached cuFFT plans keep a work area for dst2d, mix2d and dct2d each
+    per_plans = 3 * 4 * grid
+    # a CUDA graph keeps the state and beam buffers and its own memory pool
+    # holds the temporaries of the captured step, besides the ones
+    # of the first regular step, which stay cached in the default one
+    steps = 2 if config.cuda_graph else 1
+
+    if config.memory_budget is None:
+        transform_chunk = None
+        arrays = shared + K * (steps * (per_member + per_transform) +
+                               per_plans)
+    else:
+        available = (config.memory_budget - MEMORY_OVERHEAD -
+                     shared - steps * K * per_member)
+        transform_chunk = int(min(K, max(1, available //
+                                         (steps * per_transform))))
+        arrays = shared + steps * (K * per_member +
+                                   transform_chunk * per_transform)
+
+    # the beam and its temporaries, the fields copied for the diagnostics,
+    # the trajectories being saved
+    host = MEMORY_OVERHEAD + (6 * K + 3) * grid + 2 * tracks
+    return {'host': host, 'device': MEMORY_OVERHEAD + arrays,
+            'device_arrays': arrays, 'transform_chunk': transform_chunk}
+
+
+#: The memory pool limit and the cuFFT plan cache size
+#: from before ``budget_memory`` changed them, if it did.
+unbudgeted = {}
+
+
+def budget_memory(config, batch_size=None):
+    """
+    Check that the simulation is going to fit into ``config.memory_budget``
+    before allocating anything and make it stay there:
+    cap the ``cupy`` memory pool, stop caching the cuFFT plans
+    (along with their work areas) and make the field solvers
+    transform the batch members in chunks (``config.transform_chunk``).
+    Only batches are chunked, a single simulation gets the pool cap
+    and the field solvers handling one component at a time (as always).
+    The resolutions ``config.regrid`` switches to are checked as well.
+    If there is no budget, only sets ``config.transform_chunk`` to None
+    and restores the pool limit and the plan cache size in case
+    an earlier simulation in the same process had a budget.
+    """
+    estimate = estimate_memory(config, batch_size)
+    config.transform_chunk = estimate['transform_chunk']
+    pool = cp.get_default_memory_pool()
+    plan_cache = cp.fft.config.get_plan_cache()
+    if config.memory_budget is None:
+        if unbudgeted:
+            pool.set_limit(size=unbudgeted.pop('pool_limit'))
+            plan_cache.set_size(unbudgeted.pop('plan_cache_size'))
+        return
+    stage, stages = config, [(estimate, '')]
+    for _, params in config.regrid or ():
+        stage = regrid_config(stage, params)
+        stages.append((estimate_memory(stage, batch_size),
+                       f' after switching to {params}'))
+    for stage_estimate, switch in stages:
+        if stage_estimate['device'] > config.memory_budget:
+            raise MemoryError(f'estimated peak GPU memory usage of '
+                              f'{stage_estimate["device"] / 2**20:.0f} MiB'
+                              f'{switch} exceeds memory_budget of '
+                              f'{config.memory_budget / 2**20:.0f} MiB')
+    unbudgeted.setdefault('pool_limit', pool.get_limit())
+    unbudgeted.setdefault('plan_cache_size', plan_cache.get_size())
+    pool.set_limit(size=config.memory_budget - MEMORY_OVERHEAD)
+    plan_cache.set_size(0)
+
+
+def measure_memory(config, batch_size=None, steps=3):
+    """
+    Run ``steps`` steps of a simulation with ``config`` and measure
+    the actual peak host and GPU memory usage (in bytes).
+    Returns a dictionary with the ``host`` total (the whole process)
+    and the ``device_arrays`` part, comparable to ``estimate_memory``.
+    """
+    pool = cp.get_default_memory_pool()
+    pool.free_all_blocks()
+    peak = pool.used_bytes()
+
+    def malloc(size):
+        nonlocal peak
+        memory = pool.malloc(size)
+        peak = max(peak, pool.used_bytes())
+        return memory
+
+    cp.cuda.set_allocator(malloc)
+    try:
+        xs, ys, const, virt_params, state = init(config, batch_size)
+        for xi_i in range(steps):
+            beam_ro = config.beam(xi_i, xs, ys)
+            if batch_size is not None:
+                beam_ro = np.broadcast_to(beam_ro, (batch_size,) +
+                                          (config.grid_steps,) * 2)
+            state = step(config, const, virt_params, state, beam_ro)
+            state.Ez.get(), state.ro.get()  # like the diagnostics do
+    finally:
+        cp.cuda.set_allocator(pool.malloc)
+    host = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linux
+    return {'host': host, 'device_arrays': peak}
+
+
+def memory_report(config, measure=False):
+    """
+    Print the ``estimate_memory`` prediction for ``config``
+    and compare it to the measured values if ``measure`` is set.
+    """
+    estimate = estimate_memory(config)
+    print(f'Estimated peak host memory usage: '
+          f'{estimate["host"] / 2**20:.0f} MiB')
+    print(f'Estimated peak GPU memory usage: '
+          f'{estimate["device"] / 2**20:.0f} MiB '
+          f'({estimate["device_arrays"] / 2**20:.0f} MiB in arrays)')
+    if measure:
+        with cp.cuda.Device(config.gpu_index):
+            measured = measure_memory(config)
+        print(f'Measured peak host memory usage: '
+              f'{measured["host"] / 2**20:.0f} MiB')
+        print(f'Measured peak GPU memory usage in arrays: '
+              f'{measured["device_arrays"] / 2**20:.0f} MiB')
+
+
+# Launch shapes tuning #
+
+#: Threads per block of the kernel launches
+#: unless tuned for the machine by ``lcode_autotune.py``.
+DEFAULT_THREADS_PER_BLOCK = {'deposit': WARP_SIZE, 'move_smart': WARP_SIZE,
+                             'move_deposit': FUSED_TILE_THREADS}
+
+#: The directory of the per-machine ``lcode_autotune.py`` profiles.
+AUTOTUNE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lcode')
+
+
+def autotune_profile_path(gpu_index):
+    """
+    The path of the ``lcode_autotune.py`` profile for this machine
+    and the GPU ``gpu_index``.
+    """
+    props = cp.cuda.runtime.getDeviceProperties(gpu_index)
+    machine = f'{platform.node()}-{props["name"].decode()}'
+    return os.path.join(AUTOTUNE_DIR, re.sub(r'[^\w.-]+', '_', machine) +
+                        '.json')
+
+
+def load_launch_shapes(config):
+    """
+    Set ``config.threads_per_block`` to the values tuned for this machine
+    by ``lcode_autotune.py`` (if ``config.autotune`` is set and it was run),
+    falling back to ``DEFAULT_THREADS_PER_BLOCK``.
+    """
+    config.threads_per_block = dict(DEFAULT_THREADS_PER_BLOCK)
+    if not config.autotune:
+        return
+    path = autotune_profile_path(config.gpu_index)
+    if os.path.exists(path):
+        with open(path) as f:
+            config.threads_per_block.update(json.load(f)['threads_per_block'])
+
+
 # Array initialization #
 
-def init(config):
+#: The options added to ``config_example`` over time, with the values
+#: the configs written before them keep running with
+#: (the callable ones are derived from the rest of the config),
+#: see ``fill_config_defaults``.
+CONFIG_DEFAULTS = {
+    'xi_step_tolerance': None,
+    'xi_step_size_min': lambda config: config.xi_step_size / 8,
+    'xi_step_size_max': lambda config: config.xi_step_size * 8,
+    'zn_each_N_steps': None,
+    'noise_spectrum_bins': None,
+    'field_predictor': None,
+    'corrector_rounds': 2,
+    'field_patch_steps': None,
+    'field_patch_refinement': 4,
+    'regrid': None,
+    'plasma_fineness_center': None,
+    'plasma_fineness_center_steps': 0,
+    'fused_push_deposit': False,
+    'autotune': True,
+    'cuda_graph': False,
+    'beam_profile': None,
+    'beam_amplitude': None,
+    'slab_gpu_indices': None,
+    'profile': False,
+    'profile_trace_file': 'profile.json',
+    'status_file': None,
+    'status_interval': 10,
+    'tracked_particles': None,
+    'tracking_block_steps': 1000,
+    'live_file': None,
+    'live_fields': ('Ez', 'ro'),
+    'live_each_N_steps': 10,
+    'memory_budget': None,
+}
+
+
+def fill_config_defaults(config):
+    """
+    Set the options missing from ``config`` to their ``CONFIG_DEFAULTS``
+    (in place, like ``init`` sets ``config.reflect_boundary``).
+    Returns the ``config``.
+    """
+    for name, default in CONFIG_DEFAULTS.items():
+        if not hasattr(config, name):
+            setattr(config, name,
+                    default(config) if callable(default) else default)
+    return config
+
+
+def init(config, batch_size=None):
     """
     Initialize all the arrays needed for ``step`` and ``config.beam``.
+
+    If ``batch_size`` is specified, the evolving ``state`` arrays
+    get a leading dimension of that size and ``step`` advances that many
+    independent simulations at once. They share the grids and the plasma,
+    but can have different beams (``beam_ro`` of ``(batch_size, N, N)``).
+
+    The options missing from ``config`` are filled in first
+    (see ``fill_config_defaults``).
+    """
+
+    fill_config_defaults(config)
+    assert config.grid_steps % 2 == 1
+    assert config.corrector_rounds >= 1
+    assert config.field_predictor in FIELD_PREDICTOR_DEPTHS
+
+    if config.profile:
+        profile_start()
+    else:
+        profile['enabled'] = False  # possibly left on by an earlier run
+
+    budget_memory(config, batch_size)
+    load_launch_shapes(config)
+
+    if config.slab_gpu_indices and batch_size is not None:
+        raise ValueError('batches cannot be split between several GPUs')
+    if config.xi_step_tolerance is not None and config.field_predictor:
+        # the history would hold the fields of unequal steps
+        raise ValueError('the field predictor assumes equal xi steps')
+    for _, params in config.regrid or ():
+        for name in params:
+            if name not in REGRID_PARAMS:
+                raise ValueError(f'{name} cannot be switched mid-run')
+        if config.tracked_particles is not None:
+            raise ValueError('the tracked particles do not survive a regrid')
+    if config.cuda_graph:
+        # a graph replays a fixed sequence of launches on a single GPU
+        if config.xi_step_tolerance is not None:
+            raise ValueError('CUDA graphs cannot adapt the xi step')
+        if config.slab_gpu_indices:
+            raise ValueError('CUDA graphs cannot span several GPUs')
+        if config.profile:
+            raise ValueError('CUDA graphs cannot be profiled phase by phase')
+    if config.field_patch_steps is not None and config.slab_gpu_indices:
+        raise ValueError('the field patch cannot be split between GPUs')
+
+    return init_arrays(config, batch_size)
+
+
+def init_arrays(config, batch_size=None):
+    """
+    The part of ``init`` building the grid, the plasma and the arrays
+    from the ``config`` geometry, free of the process-wide side effects
+    (profiling, memory pool and launch shapes),
+    so that ``regrid`` can rerun it mid-run.
     """
 
     assert config.grid_steps % 2 == 1
+    patch = config.field_patch_steps is not None
+    if patch:
+        # the patch perimeter should run along the coarse grid lines
+        assert (config.field_patch_steps - 1) % (
+            2 * config.field_patch_refinement
+        ) == 0
+        assert config.field_patch_steps // config.field_patch_refinement < (
+            config.grid_steps - 2 * config.reflect_padding_steps
+        )
 
     # virtual particles should not reach the window pre-boundary cells
     assert config.reflect_padding_steps > config.plasma_coarseness + 1
@@ -952,49 +2497,277 @@ def init(config):
             * config.grid_step_size)
     xs, ys = grid[:, None], grid[None, :]
 
-    x_init, y_init, x_offt, y_offt, px, py, pz, m, q, virt_params = \
-        make_plasma(config.grid_steps - config.plasma_padding_steps * 2,
-                    config.grid_step_size,
-                    coarseness=config.plasma_coarseness,
-                    fineness=config.plasma_fineness)
+    plasma, virt_params = cached_plasma(
+        config.grid_steps - config.plasma_padding_steps * 2,
+        config.grid_step_size,
+        config.plasma_coarseness, config.plasma_fineness,
+        config.plasma_fineness_center, config.plasma_fineness_center_steps
+    )
+    m, q, x_init, y_init = plasma.m, plasma.q, plasma.x_init, plasma.y_init
+    # the plasma starts at rest at its initial positions
+    x_offt, y_offt, px, py, pz = [cp.zeros(m.shape) for _ in range(5)]
 
     ro_initial = initial_deposition(config, x_offt, y_offt,
                                     px, py, pz, m, q, virt_params)
 
+    beam_fields = {}
+    if config.beam_profile is not None:
+        beam_profile = np.broadcast_to(config.beam_profile(xs, ys),
+                                       (config.grid_steps,) * 2)
+        beam_fields['beam_Ex'], beam_fields['beam_Ey'] = \
+            calculate_beam_fields(config, cp.asarray(beam_profile))
+
+    patch_shape = (config.field_patch_steps,) * 2 if patch else (0, 0)
+    patch_const = {}
+    if patch:
+        patch_const['patch_ro_initial'] = initial_deposition(
+            config, x_offt, y_offt, px, py, pz, m, q, virt_params, patch=True
+        )
+    if patch and config.beam_profile is not None:
+        patch_xs, patch_ys = patch_grid(config)[:, None], patch_grid(config)
+        beam_profile = np.broadcast_to(config.beam_profile(patch_xs, patch_ys),
+                                       patch_shape)
+        zero, beam_zero = cp.zeros(patch_shape), cp.zeros(ro_initial.shape)
+        Ex, Ey = beam_fields['beam_Ex'], beam_fields['beam_Ey']
+        patch_const['patch_beam_Ex'], patch_const['patch_beam_Ey'], *_ = \
+            calculate_patch_fields(config, (Ex, Ey, beam_zero, -Ey, Ex,
+                                            beam_zero),
+                                   zero, zero, zero, zero,
+                                   cp.asarray(beam_profile), zero, zero, zero,
+                                   zero, zero, zero)
+
     const = GPUArrays(m=m, q=q, x_init=x_init, y_init=y_init,
-                      ro_initial=ro_initial)
+                      ro_initial=ro_initial,
+                      tracked=select_tracked(config, x_init, y_init),
+                      **beam_fields, **patch_const)
+
+    batch_shape = () if batch_size is None else (batch_size,)
 
     def zeros():
-        return cp.zeros((config.grid_steps, config.grid_steps))
+        return cp.zeros(batch_shape + (config.grid_steps, config.grid_steps))
+
+    def repeat(a):
+        return cp.broadcast_to(a, batch_shape + a.shape).copy()
+
+    x_offt, y_offt, px, py, pz = map(repeat, (x_offt, y_offt, px, py, pz))
+    # the fields are zero before the beam, and so they were before that
+    depth = FIELD_PREDICTOR_DEPTHS[config.field_predictor]
+    fields_history = cp.zeros((depth,) + batch_shape +
+                              (config.grid_steps, config.grid_steps, 6))
+
+    # the field patch ones are empty if there is no patch
+    patch_zeros = [cp.zeros(batch_shape + patch_shape) for _ in range(4)]
+    patch_fields = cp.zeros(batch_shape + patch_shape + (6,))
 
     state = GPUArrays(x_offt=x_offt, y_offt=y_offt, px=px, py=py, pz=pz,
                       Ex=zeros(), Ey=zeros(), Ez=zeros(),
                       Bx=zeros(), By=zeros(), Bz=zeros(),
-                      ro=zeros(), jx=zeros(), jy=zeros(), jz=zeros())
+                      ro=zeros(), jx=zeros(), jy=zeros(), jz=zeros(),
+                      fields_history=fields_history,
+                      field_correction=cp.zeros(()),
+                      patch_fields=patch_fields,
+                      patch_ro=patch_zeros[0], patch_jx=patch_zeros[1],
+                      patch_jy=patch_zeros[2], patch_jz=patch_zeros[3])
 
     return xs, ys, const, virt_params, state
 
 
+# Switching the resolution mid-run #
+
+#: The ``config`` attributes that ``config.regrid`` can switch.
+REGRID_PARAMS = (
+    'grid_steps', 'grid_step_size',
+    'plasma_coarseness', 'plasma_fineness',
+    'plasma_fineness_center', 'plasma_fineness_center_steps',
+    'plasma_padding_steps', 'reflect_padding_steps',
+    'field_patch_steps', 'field_patch_refinement',
+)
+
+
+def interpolation_matrix(old_grid, new_grid):
+    """
+    The matrix linearly interpolating the values at the ``old_grid`` nodes
+    onto the ``new_grid`` ones (both sorted 1D grids),
+    taking the nearest value outside of the ``old_grid`` range,
+    like ``make_plasma`` does for the fine particles.
+    A 2D array on the same grid along both axes is interpolated
+    as ``W @ a @ W.T``.
+    """
+    i = np.clip(np.searchsorted(old_grid, new_grid) - 1, 0, len(old_grid) - 2)
+    t = np.clip((new_grid - old_grid[i]) / (old_grid[i + 1] - old_grid[i]),
+                0, 1)
+    W = np.zeros((len(new_grid), len(old_grid)))
+    W[np.arange(len(new_grid)), i] = 1 - t
+    W[np.arange(len(new_grid)), i + 1] = t
+    return cp.asarray(W)
+
+
+def regrid_config(config, params):
+    """
+    Derive the config with the ``params`` (a dictionary of the
+    ``REGRID_PARAMS`` values) replaced.
+    """
+    new_config = types.SimpleNamespace(**vars(config))
+    for name, value in params.items():
+        if name not in REGRID_PARAMS:
+            raise ValueError(f'{name} cannot be switched mid-run')
+        setattr(new_config, name, value)
+    return new_config
+
+
+def regrid(config, new_config, const, state):
+    """
+    Carry the ``state`` of a simulation initialized with ``config``
+    over to ``new_config`` with a different transverse grid or plasma
+    resolution (see ``regrid_config``), rebuilding the rest
+    with ``init_arrays`` (the profile, the memory pool and the launch shapes
+    set up by ``init`` stay as they are).
+
+    The coarse particles are a grid in their initial positions,
+    so their displacements and momenta per unit mass are interpolated
+    from the old particles to the new ones initially located in between,
+    just like the fine particles are (see ``make_plasma``).
+    The fields are interpolated onto the new grid
+    (and the field patch, if there is one),
+    while the charge density and the currents are deposited anew
+    by the remapped particles, so the total charge is conserved exactly.
+    Returns what ``init`` does, with the ``state`` carried over.
+    """
+    new_config.transform_chunk = estimate_memory(new_config)['transform_chunk']
+    xs, ys, new_const, virt_params, new_state = init_arrays(new_config)
+
+    W = interpolation_matrix(cp.asnumpy(const.x_init[:, 0]),
+                             cp.asnumpy(new_const.x_init[:, 0]))
+    x_offt, y_offt = W @ state.x_offt @ W.T, W @ state.y_offt @ W.T
+    px, py, pz = [W @ (p / const.m) @ W.T * new_const.m
+                  for p in (state.px, state.py, state.pz)]
+    ro, jx, jy, jz = deposit(new_config, new_const.ro_initial, x_offt, y_offt,
+                             new_const.m, new_const.q, px, py, pz, virt_params)
+
+    old_grid = ((np.arange(config.grid_steps) - config.grid_steps // 2)
+                * config.grid_step_size)
+    W = interpolation_matrix(old_grid, xs[:, 0])
+    Ex, Ey, Ez, Bx, By, Bz = [
+        W @ a @ W.T
+        for a in (state.Ex, state.Ey, state.Ez, state.Bx, state.By, state.Bz)
+    ]
+    history = cp.moveaxis(state.fields_history, -1, -3)
+    fields_history = cp.ascontiguousarray(
+        cp.moveaxis(W @ history @ W.T, -3, -1)
+    )
+
+    # the field patch ones are empty if there is no patch
+    patch_fields, patch_ro, patch_jx, patch_jy, patch_jz = (
+        new_state.patch_fields, new_state.patch_ro,
+        new_state.patch_jx, new_state.patch_jy, new_state.patch_jz
+    )
+    if new_config.field_patch_steps is not None:
+        patch_ro, patch_jx, patch_jy, patch_jz = deposit(
+            new_config, new_const.patch_ro_initial, x_offt, y_offt,
+            new_const.m, new_const.q, px, py, pz, virt_params, patch=True
+        )
+        patch_fields = interleave_fields(*[interpolate_to_patch(new_config, a)
+                                           for a in (Ex, Ey, Ez, Bx, By, Bz)])
+
+    state = GPUArrays(x_offt=x_offt, y_offt=y_offt, px=px, py=py, pz=pz,
+                      Ex=Ex, Ey=Ey, Ez=Ez, Bx=Bx, By=By, Bz=Bz,
+                      ro=ro, jx=jx, jy=jy, jz=jz,
+                      fields_history=fields_history,
+                      field_correction=state.field_correction,
+                      patch_fields=patch_fields, patch_ro=patch_ro,
+                      patch_jx=patch_jx, patch_jy=patch_jy,
+                      patch_jz=patch_jz)
+    return xs, ys, new_const, virt_params, state
+
+
 # Some really sloppy diagnostics #
 
-max_zn = 0
-def diags_ro_zn(config, ro):
-    global max_zn
+#: The width of the Gaussian blur separating the high-frequency part of ro
+#: (the noise) for zn, in plasma units.
+ZN_BLUR_SIGMA = .25
 
-    sigma = 0.25 / config.grid_step_size
-    blurred = scipy.ndimage.gaussian_filter(ro, sigma=sigma)
-    hf = ro - blurred
-    zn = np.abs(hf).mean() / 4.23045376e-04
-    max_zn = max(max_zn, zn)
-    return max_zn
 
+@cp.memoize()
+def highpass_matrix(grid_steps, grid_step_size, sigma):
+    """
+    Calculate a matrix that leaves the high-frequency part of an array,
+    i.e., subtracts its Gaussian blur with ``sigma``,
+    if you elementwise-multiply it "in DCT-space" (see ``dct2d``)
+    and transform it back.
+    """
+    # mode k of DCT-Type1 is cos(pi * k * x / L), where L = h * (N - 1)
+    k = cp.arange(grid_steps) * cp.pi / (grid_step_size * (grid_steps - 1))
+    blur = cp.exp(-(k * sigma)**2 / 2)
+    mul = 1 - blur[:, None] * blur[None, :]
+    return mul / (2 * (grid_steps - 1))**2  # additional 2xDCT normalization
 
-def diags_peak_msg(Ez_00_history):
+
+@cp.memoize()
+def spectrum_rings(grid_steps, grid_step_size, bins):
+    """
+    Split the DCT modes into ``bins`` rings of equal width in ``|k|``.
+    Returns the ring index of every mode, the amount of modes in each ring
+    and the ring centers.
+    """
+    k = cp.arange(grid_steps) * cp.pi / (grid_step_size * (grid_steps - 1))
+    k_abs = cp.sqrt(k[:, None]**2 + k[None, :]**2)
+    width = float(k_abs.max()) / bins
+    rings = cp.minimum((k_abs / width).astype(int), bins - 1).ravel()
+    counts = cp.bincount(rings, minlength=bins)
+    return rings, counts, (cp.arange(bins) + .5) * width
+
+
+def diags_ro_noise(config, ro, spectrum_bins=None):
+    """
+    Calculate zn, the mean absolute high-frequency part of ``ro``
+    (relative to the one of a reference run), on GPU
+    by high-pass filtering the ``ro`` spectrum (see ``highpass_matrix``),
+    and, if ``spectrum_bins`` is specified, the radial power spectrum of ``ro``
+    (the mean squared amplitude of the modes in every ring,
+    see ``spectrum_rings``).
+    Leading (batch) dimensions of ``ro``, if any, are preserved.
+    Returns the GPU arrays, so that only the scalars are copied back.
+    """
+    N = config.grid_steps
+    f = dct2d(ro)
+    hf = dct2d(f * highpass_matrix(N, config.grid_step_size, ZN_BLUR_SIGMA))
+    zn = cp.abs(hf).mean(axis=(-2, -1)) / 4.23045376e-04
+    if spectrum_bins is None:
+        return zn, None
+
+    rings, counts, _ = spectrum_rings(N, config.grid_step_size, spectrum_bins)
+    power = (f / (N - 1)**2).reshape((-1, N * N))**2  # cos amplitudes squared
+    batch_rings = rings + spectrum_bins * cp.arange(len(power))[:, None]
+    spectrum = cp.bincount(batch_rings.ravel(), weights=power.ravel(),
+                           minlength=len(power) * spectrum_bins)
+    spectrum = spectrum.reshape(ro.shape[:-2] + (spectrum_bins,)) / counts
+    return zn, spectrum
+
+
+def diags_ro_spectrum(config, xi, spectrum, out_dir):
+    """
+    Append the radial ``ro`` power spectrum to ``ro_spectrum.txt``,
+    the first line of which lists the ring centers in ``|k|``.
+    """
+    fname = os.path.join(out_dir, 'ro_spectrum.txt')
+    if not os.path.exists(fname):
+        _, _, k = spectrum_rings(config.grid_steps, config.grid_step_size,
+                                 config.noise_spectrum_bins)
+        with open(fname, 'w') as f:
+            print('# k', *(f'{k_i:.4e}' for k_i in k.get()), file=f)
+    with open(fname, 'a') as f:
+        print(f'{xi:+.4f}', *(f'{p:.4e}' for p in spectrum), file=f)
+
+
+def diags_peaks(Ez_00_history):
     Ez_00_array = np.array(Ez_00_history)
-    peak_indices = scipy.signal.argrelmax(Ez_00_array)[0]
+    return Ez_00_array[scipy.signal.argrelmax(Ez_00_array)[0]]
+
+
+def diags_peak_msg(Ez_00_history):
+    peak_values = diags_peaks(Ez_00_history)
 
-    if peak_indices.size:
-        peak_values = Ez_00_array[peak_indices]
+    if peak_values.size:
         rel_deviations_perc = 100 * (peak_values / peak_values[0] - 1)
         return (f'{peak_values[-1]:0.4e} '
                 f'{rel_deviations_perc[-1]:+0.2f}%')
@@ -1002,54 +2775,630 @@ def diags_peak_msg(Ez_00_history):
         return '...'
 
 
-def diags_ro_slice(config, xi_i, xi, ro):
+def diags_ro_slice(config, xi_i, xi, ro, out_dir):
     if xi_i % int(1 / config.xi_step_size):
         return
-    if not os.path.isdir('transverse'):
-        os.mkdir('transverse')
+    ro = cp.asnumpy(ro)
+    if not os.path.isdir(os.path.join(out_dir, 'transverse')):
+        os.mkdir(os.path.join(out_dir, 'transverse'))
 
     fname = f'ro_{xi:+09.2f}.png' if xi else 'ro_-00000.00.png'
-    plt.imsave(os.path.join('transverse', fname), ro.T,
+    plt.imsave(os.path.join(out_dir, 'transverse', fname), ro.T,
                origin='lower', vmin=-0.1, vmax=0.1, cmap='bwr')
 
 
-def diagnostics(view_state, config, xi_i, Ez_00_history):
+def diagnostics(ro, config, xi_i, Ez_00_history, max_zn,
+                out_dir='.', file=None, status=''):
+    """
+    Print the diagnostics line and save the ``ro`` slice and spectrum.
+    ``ro`` can be a GPU array, then it is only copied to host for the slices.
+    Returns the largest zn so far, ``max_zn`` included.
+    """
     xi = -xi_i * config.xi_step_size
 
     Ez_00 = Ez_00_history[-1]
     peak_report = diags_peak_msg(Ez_00_history)
 
-    ro = view_state.ro
-    max_zn = diags_ro_zn(config, ro)
-    diags_ro_slice(config, xi_i, xi, ro)
+    zn, spectrum = diags_ro_noise(config, cp.asarray(ro),
+                                  config.noise_spectrum_bins)
+    max_zn = max(max_zn, float(zn))
+    if spectrum is not None:
+        diags_ro_spectrum(config, xi, spectrum.get(), out_dir)
+    diags_ro_slice(config, xi_i, xi, ro, out_dir)
 
-    print(f'xi={xi:+.4f} {Ez_00:+.4e}|{peak_report}|zn={max_zn:.3f}')
-    sys.stdout.flush()
+    status = f'|{status}' if status else ''
+    print(f'xi={xi:+.4f} {Ez_00:+.4e}|{peak_report}|zn={max_zn:.3f}{status}',
+          file=file, flush=True)
+    return max_zn
 
 
-# Main loop #
+# Telemetry #
 
-def main():
-    import config
-    with cp.cuda.Device(config.gpu_index):
+class Telemetry:
+    """
+    Track the throughput (over the last ``window`` steps), the ETA
+    and the memory usage of a running simulation,
+    writing them to ``config.status_file`` as JSON
+    every ``config.status_interval`` seconds (if set).
+    Call ``telemetry.step(xi_i)`` after every step, it only takes a couple
+    of host-side calls, the rest is calculated when reporting.
+    """
+    def __init__(self, config, window=100):
+        self.config = config
+        self.start = self.last_write = time.time()
+        self.steps, self.xi_i = 0, None
+        self.history = collections.deque([(time.perf_counter(), -1)],
+                                         maxlen=window + 1)
+        self.device_peak = 0
+
+    def step(self, xi_i):
+        self.steps, self.xi_i = self.steps + 1, xi_i
+        self.history.append((time.perf_counter(), xi_i))
+        pool = cp.get_default_memory_pool()
+        self.device_peak = max(self.device_peak, pool.used_bytes())
+        if (self.config.status_file is not None and
+                time.time() - self.last_write >= self.config.status_interval):
+            self.write()
+
+    def status(self):
+        """
+        Collect the current figures into a JSON-serializable dictionary.
+        """
+        times, xi_is = map(np.array, zip(*self.history))
+        step_times = np.diff(times)
+        elapsed = times[-1] - times[0]
+        steps_per_second = len(step_times) / elapsed if elapsed else None
+        # in the units of xi_step_size, which matters with adaptive steps
+        progress_rate = (xi_is[-1] - xi_is[0]) / elapsed if elapsed else None
+        remaining = self.config.xi_steps - 1 - xi_is[-1]
+        eta = remaining / progress_rate if progress_rate else None
+
+        percentiles = {}
+        if len(step_times):
+            for p in 50, 90, 99:
+                percentiles[f'p{p}'] = 1000 * np.percentile(step_times, p)
+            percentiles['max'] = 1000 * step_times.max()
+
+        try:
+            with open('/proc/self/statm') as f:
+                host_current = int(f.read().split()[1]) * os.sysconf(
+                    'SC_PAGE_SIZE')
+        except OSError:  # not Linux
+            host_current = None
+        host_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        host_peak = max(host_peak, host_current or 0)  # coarser units
+
+        pool = cp.get_default_memory_pool()
+        pinned_pool = cp.get_default_pinned_memory_pool()
+        free, total = cp.cuda.runtime.memGetInfo()
+
+        return {
+            'time': time.time(), 'pid': os.getpid(),
+            'elapsed': time.time() - self.start,
+            'steps': self.steps, 'xi_i': float(xi_is[-1]),
+            'xi': -float(xi_is[-1]) * self.config.xi_step_size,
+            'xi_steps': self.config.xi_steps,
+            'steps_per_second': steps_per_second,
+            'eta_seconds': eta,
+            'step_time_ms': percentiles,
+            'host_memory': {'current': host_current, 'peak': host_peak},
+            'device_memory': {'used': pool.used_bytes(),
+                              'peak': max(self.device_peak,
+                                          pool.used_bytes()),
+                              'pool_total': pool.total_bytes(),
+                              'pool_free_blocks': pool.n_free_blocks(),
+                              'free': free, 'total': total},
+            'pinned_memory_pool_free_blocks': pinned_pool.n_free_blocks(),
+        }
+
+    def write(self):
+        """
+        Replace ``config.status_file`` with the current status atomically,
+        so that the readers never see a partially written one.
+        """
+        path = self.config.status_file
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.status(), f, indent=1)
+        os.replace(f'{path}.tmp', path)
+        self.last_write = time.time()
 
-        xs, ys, const, virt_params, state = init(config)
-        Ez_00_history = []
+    def message(self):
+        """
+        A short status for the console line.
+        """
+        status = self.status()
+        if status['steps_per_second'] is None:
+            return ''
+        eta = status['eta_seconds']
+        if eta is None:
+            eta = '-'
+        elif eta < 86400:
+            eta = time.strftime('%H:%M:%S', time.gmtime(eta))
+        else:
+            eta = f'{eta / 86400:.1f} days'
+        return (f'{status["steps_per_second"]:.1f} steps/s ETA {eta} '
+                f'GPU {status["device_memory"]["used"] / 2**20:.0f}/'
+                f'{status["device_memory"]["peak"] / 2**20:.0f} MiB')
+
+
+# Tracked particles #
+
+def select_tracked(config, x_init, y_init):
+    """
+    Pick the coarse particles to record the trajectories of,
+    see ``config_example.tracked_particles``, which can be
+    a number of randomly chosen particles (the same ones every run),
+    a function of the initial positions ``x, y`` selecting the ones
+    in a region or a list of the (flattened) particle indices.
+    Returns the sorted indices.
+    """
+    tracked = config.tracked_particles
+    if tracked is None:
+        return np.zeros(0, dtype=int)
+    if callable(tracked):
+        x_init, y_init = cp.asnumpy(x_init), cp.asnumpy(y_init)
+        return np.flatnonzero(np.broadcast_to(tracked(x_init, y_init),
+                                              x_init.shape))
+    if isinstance(tracked, (int, np.integer)):
+        rng = np.random.default_rng(0)
+        return np.sort(rng.choice(x_init.size, min(tracked, x_init.size),
+                                  replace=False))
+    indices = np.unique(np.asarray(tracked, dtype=int))
+    assert indices.size == 0 or 0 <= indices[0] <= indices[-1] < x_init.size
+    return indices
+
+
+class Tracker:
+    """
+    Record the trajectories of the tracked coarse particles
+    (``const.tracked``, see ``select_tracked``).
+    Call ``tracker.record(xi, state)`` after every step,
+    it only gathers their coordinates and momenta on GPU into
+    a preallocated buffer for ``config.tracking_block_steps`` steps,
+    which is copied back and saved to ``out_dir/tracks/tracks_000000.npz``,
+    ``tracks_000001.npz``, ... once full and by ``tracker.flush()``.
+    Use ``load_tracks`` to read them.
+    """
+    def __init__(self, config, const, out_dir='.'):
+        self.tracked, self.out_dir = const.tracked, out_dir
+        self.x_init = cp.asnumpy(const.x_init.reshape(-1)[self.tracked])
+        self.y_init = cp.asnumpy(const.y_init.reshape(-1)[self.tracked])
+        self.buffer = cp.zeros((config.tracking_block_steps, 5,
+                                self.tracked.size))
+        self.xi, self.blocks = [], 0
+
+    def record(self, xi, state):
+        row = self.buffer[len(self.xi)]
+        for k, a in enumerate((state.x_offt, state.y_offt,
+                               state.px, state.py, state.pz)):
+            cp.take(a.reshape(-1), self.tracked, out=row[k])
+        self.xi.append(xi)
+        if len(self.xi) == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """
+        Save the recorded steps, if any, as the next block.
+        """
+        if not self.xi:
+            return
+        data = self.buffer[:len(self.xi)].get()
+        x_offt, y_offt, px, py, pz = data.swapaxes(0, 1)
+        os.makedirs(os.path.join(self.out_dir, 'tracks'), exist_ok=True)
+        np.savez(os.path.join(self.out_dir, 'tracks',
+                              f'tracks_{self.blocks:06d}.npz'),
+                 xi=np.array(self.xi), index=cp.asnumpy(self.tracked),
+                 x=self.x_init + x_offt, y=self.y_init + y_offt,
+                 px=px, py=py, pz=pz)
+        self.xi, self.blocks = [], self.blocks + 1
+
+
+def load_tracks(out_dir='.'):
+    """
+    Read the trajectories saved by ``Tracker``.
+    Returns a dictionary of ``xi`` (of every recorded step),
+    ``index`` (the tracked particle indices) and
+    ``x``, ``y``, ``px``, ``py``, ``pz`` (shaped as steps x particles).
+    """
+    tracks_dir = os.path.join(out_dir, 'tracks')
+    blocks = [np.load(os.path.join(tracks_dir, name))
+              for name in sorted(os.listdir(tracks_dir))
+              if re.fullmatch(r'tracks_\d+\.npz', name)]
+    tracks = {name: np.concatenate([block[name] for block in blocks])
+              for name in ('xi', 'x', 'y', 'px', 'py', 'pz')}
+    tracks['index'] = blocks[0]['index']
+    return tracks
 
-        for xi_i in range(config.xi_steps):
-            beam_ro = config.beam(xi_i, xs, ys)
 
-            state = step(config, const, virt_params, state, beam_ro)
-            view_state = GPUArraysView(state)
+# Main loop #
+
+class StepResult:
+    """
+    The results of a single ``simulate`` step:
+    ``result.xi_i``, ``result.xi`` and the requested ``fields``
+    as ``numpy`` arrays, e.g., ``result.Ez``.
+
+    A field is copied from GPU on the first access only and cached,
+    the fields never accessed are never copied.
+    The whole ``step`` output is available as ``result.state``
+    (wrap it with ``GPUArraysView`` to access the rest),
+    the throughput and memory usage as ``result.telemetry``,
+    the config the step was made with (a derived one
+    after a switch of the resolution, see ``regrid``) as ``result.config``.
+    """
+    def __init__(self, xi_i, xi, state, fields, telemetry=None, config=None):
+        self.xi_i, self.xi, self.state = xi_i, xi, state
+        self.telemetry, self.config = telemetry, config
+        self._fields, self._cache = fields, {}
+
+    def __getattr__(self, name):
+        """
+        Copy the requested field (or its part) from GPU once.
+        """
+        if name.startswith('_') or name not in self._fields:
+            raise AttributeError(f'{name} was not requested from simulate')
+        if name not in self._cache:
+            part = self._fields[name]
+            if callable(part):  # depends on the grid
+                part = part(self.config)
+            array = getattr(self.state, name)
+            with array.device:  # not necessarily the current one
+                self._cache[name] = cp.asnumpy(array[part])
+        return self._cache[name]
+
+
+def step_with_beam(config, const, virt_params, prev, xi_i, xs, ys,
+                   xi_step_size=None, captured=None):
+    """
+    Evaluate the beam at ``xi_i`` and make a ``step``
+    of ``xi_step_size`` (``config.xi_step_size`` if not specified),
+    or replay the ``captured`` one (a ``CapturedStep``), if passed.
+    """
+    with profile_region('beam', gpu=False):
+        patch_beam_ro = None
+        if config.beam_profile is None:
+            beam_ro, amplitude = config.beam(xi_i, xs, ys), None
+            if config.field_patch_steps is not None:
+                patch_xs = patch_grid(config)
+                patch_beam_ro = config.beam(xi_i, patch_xs[:, None],
+                                            patch_xs[None, :])
+        else:
+            beam_ro, amplitude = None, config.beam_amplitude(xi_i)
+
+    if xi_step_size is not None:
+        # the config functions, like beam, still see the original value
+        config = types.SimpleNamespace(**vars(config))
+        config.xi_step_size = xi_step_size
+    with profile_region('step'):
+        if captured is not None:
+            return captured(prev, beam_ro, amplitude, patch_beam_ro)
+        return step(config, const, virt_params, prev, beam_ro, amplitude,
+                    patch_beam_ro)
+
+
+def fixed_steps(config, const, virt_params, state, xs, ys, xi_i=-1):
+    """
+    Advance ``state`` (the one at ``xi_i``, before the first step
+    by default) with ``config.xi_step_size``,
+    yielding ``xi_i`` and the new state after every step
+    (the same object every time if ``config.cuda_graph`` is set).
+    """
+    captured = (CapturedStep(config, const, virt_params)
+                if config.cuda_graph else None)
+    for xi_i in range(xi_i + 1, config.xi_steps):
+        state = step_with_beam(config, const, virt_params, state, xi_i, xs, ys,
+                               captured=captured)
+        yield xi_i, state
 
-            ez = view_state.Ez[config.grid_steps // 2, config.grid_steps // 2]
-            Ez_00_history.append(ez)
 
-            time_for_diags = xi_i % config.diagnostics_each_N_steps == 0
-            last_step = xi_i == config.xi_steps - 1
+def adaptive_steps(config, const, virt_params, state, xs, ys, xi_i=-1):
+    """
+    Advance ``state`` (the one at ``xi_i``, before the first step
+    by default) with the xi steps growing and shrinking
+    between ``config.xi_step_size_min`` and ``config.xi_step_size_max``,
+    so that the ``field_correction`` of every step
+    stays below ``config.xi_step_tolerance``.
+    A step exceeding it is retried with half the step size,
+    a step well below it makes the next one twice as long.
+
+    Yields ``xi_i`` and the new state after every step, with ``xi_i``
+    measured in ``config.xi_step_size`` and fractional in general,
+    so that ``config.beam`` gets sampled at the actual xi positions.
+    The steps are shortened to land exactly on the integer ``xi_i``
+    where the diagnostics, zn (``config.zn_each_N_steps``)
+    or the live fields (``config.live_each_N_steps``) are due
+    and on the last one, ``config.xi_steps - 1``.
+    """
+    # the positions and the step sizes are counted in the smallest steps
+    ticks_per_step = round(config.xi_step_size / config.xi_step_size_min)
+    max_ticks = int(config.xi_step_size_max / config.xi_step_size_min)
+    assert np.isclose(ticks_per_step * config.xi_step_size_min,
+                      config.xi_step_size)
+    periods = [config.diagnostics_each_N_steps,
+               max(int(1 / config.xi_step_size), 1)]
+    if config.zn_each_N_steps:
+        periods.append(config.zn_each_N_steps)
+    if config.live_file is not None:
+        periods.append(config.live_each_N_steps)
+    landings = ticks_per_step * functools.reduce(gcd, periods)
+    end = (config.xi_steps - 1) * ticks_per_step
+
+    position, ticks = round(xi_i * ticks_per_step), ticks_per_step
+    while position < end:
+        next_landing = min((position // landings + 1) * landings, end)
+        ticks = min(ticks, max_ticks, next_landing - position)
+        new_state = step_with_beam(config, const, virt_params, state,
+                                   (position + ticks) / ticks_per_step,
+                                   xs, ys, ticks * config.xi_step_size_min)
+        error = float(new_state.field_correction)
+        if error > config.xi_step_tolerance and ticks > 1:
+            ticks //= 2
+            continue
+        position, state = position + ticks, new_state
+        if error < config.xi_step_tolerance / 4:
+            ticks *= 2
+        yield position / ticks_per_step, state
+
+
+def regridding_steps(config, const, virt_params, state, xs, ys):
+    """
+    Advance ``state`` with ``fixed_steps`` or ``adaptive_steps``,
+    switching the resolution as ``config.regrid`` lists (see ``regrid``).
+    Yields ``xi_i``, the new state and the config it was made with
+    after every step.
+    """
+    stages, xi_i = list(config.regrid or ()), -1
+    while True:
+        advance = (fixed_steps if config.xi_step_tolerance is None
+                   else adaptive_steps)
+        steps = advance(config, const, virt_params, state, xs, ys, xi_i)
+        for xi_i, state in steps:
+            yield xi_i, state, config
+            if stages:
+                when, params = stages[0]
+                due = (when(xi_i, state) if callable(when) else
+                       xi_i >= when)
+                if due:
+                    break
+        else:
+            return
+        steps.close()
+        stages.pop(0)
+        new_config = regrid_config(config, params)
+        with profile_region('regrid', gpu=False):
+            xs, ys, const, virt_params, state = regrid(config, new_config,
+                                                       const, state)
+        config = new_config
+
+
+def simulate(config, fields=('Ez', 'ro'), every=1, out_dir='.'):
+    """
+    Run the simulation configured by ``config`` (a module or any object
+    with the attributes of ``config_example``), yielding a ``StepResult``
+    after every ``every``-th step (the ones with ``xi_i % every == 0``).
+
+    ``fields`` lists the state attributes to make available
+    (``'Ez'``, ``'ro'``, ``'x_offt'``, ...) or maps them to the parts
+    that are needed, e.g., ``{'Ez': np.s_[N // 2, :], 'ro': ...}``,
+    or to the functions of the config returning them,
+    which keep up with ``config.regrid``.
+    Stop iterating to stop the simulation early.
+
+    With ``config.xi_step_tolerance`` set, the xi step is adapted
+    (see ``adaptive_steps``) and ``xi_i`` may be fractional;
+    ``every=1`` then yields after every step.
+
+    With ``config.tracked_particles`` set, their trajectories are recorded
+    every step and saved to ``out_dir`` (see ``Tracker``).
+
+    With ``config.regrid`` set, the resolution is switched mid-run
+    (see ``regridding_steps``), ``result.config`` tells the current one.
+
+    The GPU ``config.gpu_index`` is only made current while a step is made,
+    not in between, so that several simulations can be iterated alternately;
+    select it (``with cupy.cuda.Device(config.gpu_index):``)
+    to process ``result.state`` in place.
+    """
+    if not isinstance(fields, dict):
+        fields = {name: ... for name in fields}
+    device = cp.cuda.Device(config.gpu_index)
+    with device:
+        xs, ys, const, virt_params, state = init(config)
+        steps = regridding_steps(config, const, virt_params, state, xs, ys)
+        telemetry = Telemetry(config)
+        tracker = (Tracker(config, const, out_dir)
+                   if config.tracked_particles is not None else None)
+    try:
+        while True:
+            with device:
+                try:
+                    xi_i, state, step_config = next(steps)
+                except StopIteration:
+                    break
+                telemetry.step(xi_i)
+                if tracker is not None:
+                    tracker.record(-xi_i * config.xi_step_size, state)
+            if every == 1 or xi_i % every == 0:
+                xi = -xi_i * config.xi_step_size
+                yield StepResult(xi_i, xi, state, fields, telemetry,
+                                 step_config)
+
+            if config.profile:
+                with device:
+                    profile_collect()
+    finally:
+        with device:
+            if tracker is not None:
+                tracker.flush()
+            if config.profile:
+                profile_report(config)
+                profile['enabled'] = False
+
+
+def publish_live(config, live, result, Ez_00, max_zn):
+    """
+    Publish ``config.live_fields`` of the ``result`` state to
+    ``config.live_file`` every ``config.live_each_N_steps`` steps
+    with ``lcode_live.LiveWriter`` (``live``, created on the first call
+    and anew when the resolution is switched),
+    finishing the earlier publication if it has been copied from GPU.
+    Returns the writer.
+    """
+    if result.xi_i % config.live_each_N_steps == 0:
+        import lcode_live
+
+        fields = {name: getattr(result.state, name)
+                  for name in config.live_fields}
+        if live is None or any(live.fields[name].shape != a.shape
+                               for name, a in fields.items()):
+            # the readers reattach to the new file after a regrid
+            live = lcode_live.LiveWriter(config.live_file, fields,
+                                         ('xi_i', 'xi', 'Ez_00', 'max_zn'))
+        live.publish(fields, xi_i=result.xi_i, xi=result.xi, Ez_00=Ez_00,
+                     max_zn=max_zn)
+    elif live is not None:
+        live.poll()
+    return live
+
+
+def main(config=None, out_dir='.', file=None):
+    """
+    Run the simulation configured by ``config``
+    (imported from ``config.py`` in the current directory if not specified),
+    saving the diagnostics to ``out_dir`` and printing them to ``file``
+    (``sys.stdout`` if not specified).
+    """
+    if config is None:
+        import config
+    fill_config_defaults(config)
+
+    def center(config):  # also after a switch of the resolution
+        return config.grid_steps // 2, config.grid_steps // 2
+
+    with cp.cuda.Device(config.gpu_index):  # for processing the results too
+        print(f'Kernels compiled or loaded in {precompile():.2f}s')
+
+        Ez_00_history, max_zn, live = [], 0, None
+        for result in simulate(config, {'Ez': center}, out_dir=out_dir):
+            with profile_region('Ez_00', gpu=False):
+                Ez_00_history.append(result.Ez)
+            zn_due = config.zn_each_N_steps and (
+                result.xi_i % config.zn_each_N_steps == 0
+            )
+            if zn_due:
+                zn, _ = diags_ro_noise(result.config, result.state.ro)
+                max_zn = max(max_zn, float(zn))
+
+            time_for_diags = result.xi_i % config.diagnostics_each_N_steps == 0
+            last_step = result.xi_i == config.xi_steps - 1
             if time_for_diags or last_step:
-                diagnostics(view_state, config, xi_i, Ez_00_history)
+                with profile_region('diagnostics', gpu=False):
+                    status = result.telemetry.message()
+                    max_zn = diagnostics(result.state.ro, result.config,
+                                         result.xi_i, Ez_00_history, max_zn,
+                                         out_dir, file, status)
+
+            if config.live_file is not None:
+                with profile_region('live', gpu=False):
+                    live = publish_live(config, live, result,
+                                        Ez_00_history[-1], max_zn)
+        if live is not None:
+            live.flush()
+
+
+#: The ``config`` attributes that must be equal for ``main_batch``.
+BATCH_SHARED_PARAMS = (
+    'grid_steps', 'grid_step_size', 'xi_step_size', 'xi_steps',
+    'diagnostics_each_N_steps', 'zn_each_N_steps', 'noise_spectrum_bins',
+    'gpu_index', 'profile', 'memory_budget',
+    'fused_push_deposit', 'slab_gpu_indices', 'autotune', 'cuda_graph',
+    'field_predictor', 'corrector_rounds',
+    'field_solver_subtraction_trick', 'field_solver_variant_A',
+    'reflect_padding_steps', 'plasma_padding_steps',
+    'plasma_coarseness', 'plasma_fineness',
+    'plasma_fineness_center', 'plasma_fineness_center_steps',
+    'field_patch_steps', 'field_patch_refinement',
+)
+
+
+def main_batch(configs, out_dirs):
+    """
+    Run several simulations that only differ in their beams in lockstep
+    as a single batch (see ``init``), which is faster than running them
+    one by one for grids too small to saturate the GPU.
+    The diagnostics of ``configs[k]`` go to ``out_dirs[k]``.
+    """
+    configs = [fill_config_defaults(config) for config in configs]
+    config = configs[0]
+    if config.xi_step_tolerance is not None:
+        raise ValueError('batches cannot adapt the xi step')
+    if config.field_patch_steps is not None:
+        raise ValueError('batches cannot have a field patch')
+    if config.tracked_particles is not None:
+        raise ValueError('batches cannot track particles')
+    if config.live_file is not None:
+        raise ValueError('batches cannot publish live fields')
+    if config.regrid is not None:
+        raise ValueError('batches cannot switch the resolution')
+    for other in configs[1:]:
+        for name in BATCH_SHARED_PARAMS:
+            if getattr(other, name) != getattr(config, name):
+                raise ValueError(f'{name} differs in the batched configs')
+    N = config.grid_steps
+
+    logs = [open(os.path.join(d, 'log.txt'), 'a') for d in out_dirs]
+    with cp.cuda.Device(config.gpu_index):
+        print(f'Kernels compiled or loaded in {precompile():.2f}s')
+
+        xs, ys, const, virt_params, state = init(config, len(configs))
+        advance = (CapturedStep(config, const, virt_params)
+                   if config.cuda_graph else
+                   functools.partial(step, config, const, virt_params))
+        Ez_00_histories = [[] for _ in configs]
+        max_zns = [0 for _ in configs]
+        telemetry = Telemetry(config)
+
+        try:
+            for xi_i in range(config.xi_steps):
+                beam_ro = np.stack([np.broadcast_to(c.beam(xi_i, xs, ys),
+                                                    (N, N)) for c in configs])
+                state = advance(state, beam_ro)
+                telemetry.step(xi_i)
+
+                for k, ez in enumerate(state.Ez[:, N // 2, N // 2].get()):
+                    Ez_00_histories[k].append(ez)
+                if (config.zn_each_N_steps and
+                        xi_i % config.zn_each_N_steps == 0):
+                    zns, _ = diags_ro_noise(config, state.ro)
+                    max_zns = [max(m, zn) for m, zn in zip(max_zns,
+                                                           zns.get())]
+
+                time_for_diags = xi_i % config.diagnostics_each_N_steps == 0
+                last_step = xi_i == config.xi_steps - 1
+                if time_for_diags or last_step:
+                    status = telemetry.message()
+                    for k in range(len(configs)):
+                        max_zns[k] = diagnostics(state.ro[k], configs[k], xi_i,
+                                                 Ez_00_histories[k],
+                                                 max_zns[k],
+                                                 out_dirs[k], logs[k], status)
+
+                if config.profile:
+                    profile_collect()
+        finally:
+            for log in logs:
+                log.close()
+            if config.profile:
+                profile_report(config)
+                profile['enabled'] = False
 
 
 if __name__ == '__main__':
-    main()
+    if '--precompile' in sys.argv[1:]:
+        print(f'Kernels compiled or loaded in {precompile():.2f}s')
+    elif {'--estimate-memory', '--measure-memory'} & set(sys.argv[1:]):
+        import config
+        memory_report(fill_config_defaults(config),
+                      measure='--measure-memory' in sys.argv[1:])
+    else:
+        main()
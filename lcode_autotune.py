@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016-2019 LCODE team <team@lcode.info>.
+
+# LCODE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCODE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LCODE.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tune the LCODE 3D kernel launch shapes for this machine
+and suggest fast grid sizes.
+
+Usage: ``python lcode_autotune.py [--grid-steps 641] [--gpu-index 0]``
+to benchmark the candidate threads per block of every kernel
+and save the fastest ones to the profile of this machine and GPU
+(see ``lcode.autotune_profile_path``), which ``lcode.init`` then loads
+unless ``config.autotune`` is False.
+
+``python lcode_autotune.py --window 16 --grid-step-size .025`` additionally
+times a whole ``step`` for the FFT-friendly ``grid_steps`` covering
+a transverse window of at least that width (and up to ``--window-slack``
+wider) and suggests the fastest of them.
+"""
+
+import argparse
+import json
+import os
+import platform
+
+import numpy as np
+
+import cupy as cp
+
+import lcode
+import lcode_benchmark
+
+
+#: The candidate threads per block of every kernel launch.
+THREADS_CANDIDATES = (32, 64, 128, 256, 512)
+
+
+def factorize(n):
+    factors, i = [], 2
+    while n > 1:
+        while n % i == 0:
+            factors.append(i)
+            n //= i
+        i += 1
+    return factors
+
+
+def good_size(n):
+    """
+    Check whether the FFTs for a grid of ``n`` cells are efficient,
+    see :doc:`technicalities/grid_sizes`.
+    """
+    factors = factorize(n - 1)
+    return (n % 2 == 1 and all(f in (2, 3, 5, 7, 11, 13) for f in factors)
+            and factors.count(11) + factors.count(13) < 2)
+
+
+def tune_threads(grid_steps, repeat):
+    """
+    Time every tuned kernel with every candidate threads per block
+    on a ``grid_steps`` grid.
+    Returns the fastest threads per block and all the timings (in ms).
+    """
+    config = lcode_benchmark.make_config(grid_steps, 3, 2)
+    config.autotune = False
+    cases = lcode_benchmark.benchmark_cases(config)
+    best, timings = {}, {}
+    for kernel in lcode.DEFAULT_THREADS_PER_BLOCK:
+        timings[kernel] = {}
+        for threads in THREADS_CANDIDATES:
+            config.threads_per_block[kernel] = threads
+            timings[kernel][threads] = float(np.median(
+                lcode_benchmark.time_gpu(cases[kernel], repeat)
+            ))
+            print(f'{kernel:>16} {threads:4} threads '
+                  f'{timings[kernel][threads]:10.3f} ms', flush=True)
+        best[kernel] = min(timings[kernel], key=timings[kernel].get)
+        config.threads_per_block[kernel] = best[kernel]
+    return best, timings
+
+
+def suggest_grid_steps(window, grid_step_size, slack, repeat, max_candidates):
+    """
+    Time a ``step`` for the FFT-friendly grid sizes covering a window
+    ``window`` to ``window * (1 + slack)`` wide with ``grid_step_size`` cells.
+    Returns the timings (in ms) of the smallest ``max_candidates`` of them.
+    """
+    smallest = 2 * int(np.ceil(window / grid_step_size / 2)) + 1
+    largest = int(smallest * (1 + slack))
+    candidates = [n for n in range(smallest, largest + 1) if good_size(n)]
+    timings = {}
+    for grid_steps in candidates[:max_candidates]:
+        config = lcode_benchmark.make_config(grid_steps, 3, 2)
+        config.grid_step_size = grid_step_size
+        step = lcode_benchmark.benchmark_cases(config)['step']
+        timings[grid_steps] = float(np.median(
+            lcode_benchmark.time_gpu(step, repeat)
+        ))
+        print(f'{"step":>16} N={grid_steps:<5} '
+              f'{timings[grid_steps]:10.3f} ms', flush=True)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--grid-steps', type=int, default=641,
+                        help='grid size to tune the launch shapes on')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--gpu-index', type=int, default=0)
+    parser.add_argument('--window', type=float,
+                        help='transverse window width to suggest a grid for')
+    parser.add_argument('--grid-step-size', type=float, default=.025)
+    parser.add_argument('--window-slack', type=float, default=.1,
+                        help='how much wider than --window the grid can be')
+    parser.add_argument('--max-candidates', type=int, default=8)
+    args = parser.parse_args()
+
+    with cp.cuda.Device(args.gpu_index):
+        lcode.precompile()
+        props = cp.cuda.runtime.getDeviceProperties(args.gpu_index)
+        path = lcode.autotune_profile_path(args.gpu_index)
+        best, timings = tune_threads(args.grid_steps, args.repeat)
+        profile = {'machine': {'host': platform.node(),
+                               'gpu': props['name'].decode(),
+                               'cupy': cp.__version__},
+                   'grid_steps': args.grid_steps,
+                   'threads_per_block': best, 'timings': timings}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(profile, f, indent=1)
+        print(f'Saved {best} to {path}')
+
+        if args.window is not None:
+            grid_timings = suggest_grid_steps(
+                args.window, args.grid_step_size, args.window_slack,
+                args.repeat, args.max_candidates
+            )
+            if grid_timings:
+                fastest = min(grid_timings, key=grid_timings.get)
+                print(f'Suggested grid_steps = {fastest} '
+                      f'(window {(fastest - 1) * args.grid_step_size:g})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016-2019 LCODE team <team@lcode.info>.
+
+# LCODE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCODE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LCODE.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the hot parts of LCODE 3D across a matrix of grid sizes.
+
+Usage: ``python lcode_benchmark.py [--grid-steps 129 257 ...]
+[--output bench.json] [--baseline old_bench.json]``.
+
+LCODE 3D only has a CUDA backend, which is only imported when a CUDA device
+is there, so that the script runs anywhere; without one, it records
+that nothing was measured.
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import types
+
+import numpy as np
+
+
+#: The grid sizes benchmarked by default.
+DEFAULT_GRID_STEPS = (129, 257, 641, 1025, 2049)
+
+
+def make_config(grid_steps, coarseness, fineness, cuda_graph=False):
+    """
+    Make a config from ``config_example`` with the given grid parameters
+    (and ``cuda_graph`` to also benchmark the ``CapturedStep`` replays).
+    """
+    import config_example
+
+    config = types.SimpleNamespace(**{
+        name: value for name, value in vars(config_example).items()
+        if not name.startswith('_') and not isinstance(value, types.ModuleType)
+    })
+    config.grid_steps = grid_steps
+    config.plasma_coarseness, config.plasma_fineness = coarseness, fineness
+    config.reflect_padding_steps = max(config.reflect_padding_steps,
+                                       coarseness + 2)
+    config.plasma_padding_steps = max(config.plasma_padding_steps,
+                                      config.reflect_padding_steps + 1)
+    config.profile, config.cuda_graph = False, cuda_graph
+    return config
+
+
+def time_gpu(func, repeat):
+    """
+    Time ``func()`` with CUDA events ``repeat`` times after a warm-up call.
+    Returns the timings in ms.
+    """
+    import cupy as cp
+
+    func()
+    timings = []
+    for _ in range(repeat):
+        start, end = cp.cuda.Event(), cp.cuda.Event()
+        start.record()
+        func()
+        end.record()
+        end.synchronize()
+        timings.append(cp.cuda.get_elapsed_time(start, end))
+    return timings
+
+
+def benchmark_cases(config):
+    """
+    Initialize a simulation with ``config``, advance it for a couple of steps
+    and return a dictionary of the benchmarked functions (without arguments).
+    """
+    import cupy as cp
+    import lcode
+
+    xs, ys, const, virt_params, state = lcode.init(config)
+    for xi_i in range(2):
+        beam_ro = cp.asarray(config.beam(xi_i, xs, ys))
+        state = lcode.step(config, const, virt_params, state, beam_ro)
+    s = state
+
+    cases = {
+        'dst2d': lambda: lcode.dst2d(s.ro[1:-1, 1:-1]),
+        'mix2d': lambda: lcode.mix2d(s.ro[1:-1, :]),
+        'dct2d': lambda: lcode.dct2d(s.ro),
+        'calculate_Ez': lambda: lcode.calculate_Ez(config, s.jx, s.jy),
+        'calculate_Bz': lambda: lcode.calculate_Bz(config, s.jx, s.jy),
+        'calculate_Ex_Ey_Bx_By': lambda: lcode.calculate_Ex_Ey_Bx_By(
+            config, s.Ex, s.Ey, s.Bx, s.By,
+            beam_ro, s.ro, s.jx, s.jy, s.jz, s.jx, s.jy
+        ),
+        'deposit': lambda: lcode.deposit(
+            config, const.ro_initial, s.x_offt, s.y_offt,
+            const.m, const.q, s.px, s.py, s.pz, virt_params
+        ),
+        'move_smart': lambda: lcode.move_smart(
+            config, const.m, const.q, const.x_init, const.y_init,
+            s.x_offt, s.y_offt, s.x_offt, s.y_offt, s.px, s.py, s.pz,
+            lcode.interleave_fields(s.Ex, s.Ey, s.Ez, s.Bx, s.By, s.Bz)
+        ),
+        'move_deposit': lambda: lcode.move_deposit(
+            config, const.ro_initial, const.m, const.q,
+            const.x_init, const.y_init,
+            s.x_offt, s.y_offt, s.x_offt, s.y_offt, s.px, s.py, s.pz,
+            lcode.interleave_fields(s.Ex, s.Ey, s.Ez, s.Bx, s.By, s.Bz),
+            virt_params
+        ),
+        'step': lambda: lcode.step(config, const, virt_params, s, beam_ro),
+    }
+    if config.cuda_graph:
+        # captured from (a copy of) the same state and replayed in place
+        captured = lcode.CapturedStep(config, const, virt_params)
+        captured(s, beam_ro)
+        cases['captured_step'] = lambda: captured(captured.state, beam_ro)
+    return cases
+
+
+def run(grid_steps_list, coarseness_list, fineness_list, repeat,
+        cuda_graph=False):
+    """
+    Benchmark every case for every grid parameters combination
+    (the CUDA graph replays as well if ``cuda_graph`` is set).
+    Returns a list of result dictionaries.
+    """
+    import lcode
+
+    results = []
+    lcode.precompile()
+    for grid_steps, coarseness, fineness in itertools.product(
+            grid_steps_list, coarseness_list, fineness_list):
+        config = make_config(grid_steps, coarseness, fineness, cuda_graph)
+        for case, func in benchmark_cases(config).items():
+            timings = time_gpu(func, repeat)
+            results.append({'case': case, 'backend': 'cuda',
+                            'grid_steps': grid_steps,
+                            'coarseness': coarseness, 'fineness': fineness,
+                            'median_ms': float(np.median(timings)),
+                            'min_ms': float(np.min(timings))})
+            print(f'{case:>24} N={grid_steps:<5} c={coarseness} '
+                  f'f={fineness} {results[-1]["median_ms"]:10.3f} ms')
+            sys.stdout.flush()
+    return results
+
+
+def result_key(result):
+    return (result['case'], result['backend'], result['grid_steps'],
+            result['coarseness'], result['fineness'])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the slowdown/speedup relative to the baseline results.
+    Returns the list of cases that got slower by more than ``tolerance``.
+    """
+    baseline = {result_key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None:
+            continue
+        ratio = result['median_ms'] / old['median_ms']
+        mark = ''
+        if ratio > 1 + tolerance:
+            mark = ' REGRESSION'
+            regressions.append(result)
+        print(f'{result["case"]:>24} N={result["grid_steps"]:<5} '
+              f'c={result["coarseness"]} f={result["fineness"]} '
+              f'{old["median_ms"]:10.3f} -> {result["median_ms"]:10.3f} ms '
+              f'({ratio:.2f}x){mark}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--grid-steps', type=int, nargs='+',
+                        default=DEFAULT_GRID_STEPS)
+    parser.add_argument('--coarseness', type=int, nargs='+', default=[3])
+    parser.add_argument('--fineness', type=int, nargs='+', default=[2])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--cuda-graph', action='store_true',
+                        help='also time whole steps replayed as CUDA graphs')
+    parser.add_argument('--gpu-index', type=int, default=0)
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--baseline', help='earlier --output to compare with')
+    parser.add_argument('--tolerance', type=float, default=.1,
+                        help='relative slowdown considered a regression')
+    args = parser.parse_args()
+
+    machine = {'host': platform.node(), 'python': platform.python_version()}
+    try:
+        import cupy as cp
+    except ImportError:
+        cp = None
+    device_count = 0
+    if cp is not None:
+        machine['cupy'] = cp.__version__
+        try:
+            device_count = cp.cuda.runtime.getDeviceCount()
+        except cp.cuda.runtime.CUDARuntimeError:
+            pass
+    if not device_count:
+        print('No CUDA device, nothing benchmarked', file=sys.stderr)
+        with open(args.output, 'w') as f:
+            json.dump({'machine': machine, 'skipped': 'no CUDA device',
+                       'results': []}, f, indent=1)
+        return
+
+    with cp.cuda.Device(args.gpu_index) as device:
+        props = cp.cuda.runtime.getDeviceProperties(device.id)
+        machine['gpu'] = props['name'].decode()
+        results = run(args.grid_steps, args.coarseness, args.fineness,
+                      args.repeat, args.cuda_graph)
+
+    with open(args.output, 'w') as f:
+        json.dump({'machine': machine, 'results': results}, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016-2019 LCODE team <team@lcode.info>.
+
+# LCODE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCODE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LCODE.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reuse the results of the LCODE 3D runs that have already been made
+with the same config and the same code.
+
+Usage: ``python lcode_cache.py config.py [--out run] [--param BOOST=2]
+[--cache ~/.cache/lcode/runs] [--max-size 10G]`` to run a simulation
+like ``python lcode.py`` does in ``--out``, unless an identical one
+is in the cache, then its diagnostics and output files are reproduced
+without running anything. ``--key`` only prints the cache key of the config.
+
+The runs are keyed by a fingerprint of all the config values
+(the source code of its functions, like ``beam``, included,
+the ones that only affect the execution, like ``gpu_index``, excluded,
+see ``IGNORED_PARAMS``) and of the ``lcode.py`` source code,
+so any change to either makes a new run.
+The cache is a directory of ``<key>/`` entries with the diagnostics log,
+the output files and the fingerprinted values (``config.json``);
+when it grows larger than ``--max-size``, the least recently used entries
+are removed.
+"""
+
+import argparse
+import functools
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+import types
+
+import numpy as np
+
+from lcode_sweep import load_config, parse_param
+
+
+#: The default cache directory.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lcode',
+                                 'runs')
+#: The default cache size limit in bytes.
+DEFAULT_MAX_SIZE = 10 * 2**30
+
+#: The ``config`` attributes that do not affect the results,
+#: including the ones ``lcode.init`` derives from the others.
+IGNORED_PARAMS = (
+    'gpu_index', 'slab_gpu_indices', 'memory_budget', 'autotune',
+    'cuda_graph', 'profile', 'profile_trace_file',
+    'status_file', 'status_interval',
+    'live_file', 'live_fields', 'live_each_N_steps',
+    'threads_per_block', 'transform_chunk', 'reflect_boundary',
+)
+
+#: The files of a cache entry that are not run outputs.
+ENTRY_FILES = ('done', 'config.json', 'log.txt')
+
+
+def canonical(value):
+    """
+    Convert a config value to something JSON-serializable
+    that only depends on what the value is, not on where it is stored.
+    Functions are represented by their source code and closures,
+    arrays by a hash of their contents,
+    anything else by its ``repr``, unless that is just where it is stored,
+    then it is a ``TypeError``.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): canonical(v) for k, v in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        data = np.ascontiguousarray(value).tobytes()
+        return {'dtype': str(value.dtype), 'shape': list(value.shape),
+                'sha256': hashlib.sha256(data).hexdigest()}
+    if isinstance(value, types.FunctionType):
+        try:
+            source = textwrap.dedent(inspect.getsource(value))
+        except OSError:  # defined interactively
+            source = value.__code__.co_code.hex()
+        closure = [canonical(cell.cell_contents)
+                   for cell in value.__closure__ or ()]
+        return {'source': source, 'closure': closure}
+    if isinstance(value, functools.partial):
+        return {'partial': canonical(value.func),
+                'args': canonical(value.args),
+                'keywords': canonical(value.keywords)}
+    text = repr(value)
+    if ' at 0x' in text:  # the default repr of objects
+        raise TypeError(f'cannot fingerprint {text}')
+    return text
+
+
+def code_fingerprint():
+    """
+    The hash of the ``lcode.py`` source code.
+    """
+    with open(importlib.util.find_spec('lcode').origin, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def run_key(config):
+    """
+    Fingerprint ``config`` (a module or any object with the attributes
+    of ``config_example``) and the code.
+    Returns the cache key and the fingerprinted values.
+    """
+    values = {
+        name: canonical(value) for name, value in sorted(vars(config).items())
+        if not name.startswith('_') and name not in IGNORED_PARAMS
+        and not isinstance(value, types.ModuleType)
+    }
+    description = {'config': values, 'code': code_fingerprint()}
+    text = json.dumps(description, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest(), description
+
+
+def copy_outputs(src, dst):
+    """
+    Copy the run output files and directories from ``src`` to ``dst``.
+    """
+    os.makedirs(dst, exist_ok=True)
+    for name in os.listdir(src):
+        if name in ENTRY_FILES:
+            continue
+        path = os.path.join(src, name)
+        if os.path.isdir(path):
+            shutil.copytree(path, os.path.join(dst, name), dirs_exist_ok=True)
+        else:
+            shutil.copy2(path, dst)
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, names in os.walk(path) for name in names)
+
+
+def fetch(config, out_dir='.', file=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Reproduce the cached run of ``config``, if there is one,
+    copying its output files to ``out_dir`` and printing its diagnostics
+    to ``file`` (``sys.stdout`` if not specified)
+    after a line telling that they are replayed.
+    Returns whether it was found.
+    """
+    key, _ = run_key(config)
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry, 'log.txt')) as log:
+            if not os.path.exists(os.path.join(entry, 'done')):
+                return False
+            copy_outputs(entry, out_dir)
+            print(f'# replayed from the cache entry {key}, the timings, '
+                  f'ETAs and memory figures below are of the original run',
+                  file=file)
+            print(log.read(), end='', file=file, flush=True)
+        os.utime(os.path.join(entry, 'done'))  # mark as recently used
+    except FileNotFoundError:  # not there or just evicted
+        return False
+    return True
+
+
+def evict(cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+    """
+    Remove the least recently used entries until the cache fits
+    into ``max_size`` bytes, but always keep the most recent one.
+    The ones still being written (``.partial``) are left alone,
+    even when already complete and about to be renamed.
+    Returns the amount of removed entries.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.partial'):
+            continue
+        done = os.path.join(cache_dir, name, 'done')
+        if os.path.exists(done):
+            entries.append((os.path.getmtime(done),
+                            dir_size(os.path.join(cache_dir, name)),
+                            os.path.join(cache_dir, name)))
+    entries.sort()
+    total, removed = sum(size for _, size, _ in entries), 0
+    for _, size, path in entries[:-1]:
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total, removed = total - size, removed + 1
+    return removed
+
+
+class Tee:
+    """
+    A file-like object for ``lcode.main`` writing to several files at once.
+    """
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, text):
+        for f in self.files:
+            f.write(text)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+
+def cached_main(config, out_dir='.', file=None,
+                cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+    """
+    Run the simulation like ``lcode.main`` does, unless it is in the cache
+    (see ``fetch``), then store it there and evict the least recently used
+    entries (see ``evict``).
+    Returns whether the run was found in the cache.
+    """
+    import lcode
+
+    if fetch(config, out_dir, file, cache_dir):
+        return True
+    key, description = run_key(config)
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = tempfile.mkdtemp(prefix=f'{key}.', suffix='.partial',
+                               dir=cache_dir)
+    try:
+        with open(os.path.join(partial, 'log.txt'), 'w') as log:
+            lcode.main(config, partial,
+                       Tee(log, sys.stdout if file is None else file))
+        with open(os.path.join(partial, 'config.json'), 'w') as f:
+            json.dump(description, f, indent=1)
+        open(os.path.join(partial, 'done'), 'w').close()
+        copy_outputs(partial, out_dir)
+        try:
+            os.rename(partial, os.path.join(cache_dir, key))
+        except OSError:  # an identical run has been cached meanwhile
+            shutil.rmtree(partial, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    evict(cache_dir, max_size)
+    return False
+
+
+def parse_size(size):
+    """
+    Parse a size in bytes with an optional K, M, G or T suffix, e.g., ``10G``.
+    """
+    size = size.strip().upper()
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('config', help='config file, e.g., config.py')
+    parser.add_argument('--out', default='.', help='output directory')
+    parser.add_argument('--param', action='append', default=[],
+                        help='NAME=value override (repeatable)')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_DIR,
+                        help='cache directory')
+    parser.add_argument('--max-size', type=parse_size,
+                        default=DEFAULT_MAX_SIZE,
+                        help='cache size limit, e.g., 10G')
+    parser.add_argument('--gpu-index', type=int)
+    parser.add_argument('--key', action='store_true',
+                        help='only print the cache key of the config')
+    args = parser.parse_args()
+
+    params = {}
+    for param in args.param:
+        name, (value,) = parse_param(param)
+        params[name] = value
+    config = load_config(os.path.abspath(args.config), params)
+    if args.gpu_index is not None:
+        config.gpu_index = args.gpu_index
+
+    if args.key:
+        print(run_key(config)[0])
+        return
+    os.makedirs(args.out, exist_ok=True)
+    with open(os.path.join(args.out, 'log.txt'), 'a') as log:
+        cached_main(config, args.out, Tee(log, sys.stdout),
+                    args.cache, args.max_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016-2019 LCODE team <team@lcode.info>.
+
+# LCODE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCODE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LCODE.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Publish the fields of a running LCODE 3D simulation to a memory-mapped file
+for the monitoring processes, and read them from there.
+
+``lcode.main`` publishes ``config.live_fields`` (and the latest xi, Ez_00
+and zn) to ``config.live_file`` every ``config.live_each_N_steps`` steps,
+see ``LiveWriter``. Put it on a RAM-backed filesystem (``/dev/shm/lcode``)
+to avoid any disk I/O.
+
+Usage: ``python lcode_live.py /dev/shm/lcode [--interval 1]`` to print
+the published scalars and the field ranges as they change,
+``LiveReader('/dev/shm/lcode').read()`` to get them in your own code
+(only ``numpy`` is needed for that).
+
+The file starts with a header of the magic ``LCODELV1``,
+a sequence counter (little-endian uint64), the size of the layout
+(uint64) and the layout itself, JSON describing the names, shapes
+and offsets of the scalars and the fields, which are float64 arrays.
+The counter is odd while the data is being written and is incremented
+again once it is done, so a read is consistent if the counter was even
+and did not change while reading (a sequence lock).
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+
+MAGIC = b'LCODELV1'
+HEADER = np.dtype([('magic', 'S8'), ('seq', '<u8'), ('layout_size', '<u8')])
+#: Alignment of the data blocks in bytes.
+ALIGNMENT = 64
+#: Bytes reserved for the header and the layout.
+LAYOUT_SPACE = 4096
+
+
+def aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class LiveWriter:
+    """
+    Publish the ``fields`` (arrays named like in the state, on GPU or host)
+    and the ``scalars`` (names) to the memory-mapped file ``path``.
+    The file is created anew (and atomically replaces the older one)
+    with the layout fixed by the shapes of the ``fields`` passed here.
+
+    ``writer.publish(fields, xi=..., ...)`` only snapshots the fields on GPU
+    and starts copying the snapshots to pinned host memory
+    on a separate stream and returns,
+    the copies are written to the file by a later ``writer.poll()``
+    (call it every step, it is a single event query)
+    once they have arrived, so the solver never waits for them.
+    """
+    def __init__(self, path, fields, scalars):
+        self.path = path
+        layout = {'pid': os.getpid(), 'created': time.time(),
+                  'scalars': {'names': list(scalars)}, 'fields': {}}
+        layout['scalars']['offset'] = LAYOUT_SPACE
+        offset = aligned(LAYOUT_SPACE + 8 * len(scalars))
+        for name, array in fields.items():
+            layout['fields'][name] = {'shape': list(array.shape),
+                                      'offset': offset}
+            offset = aligned(offset + 8 * array.size)
+        layout_bytes = json.dumps(layout).encode()
+        assert HEADER.itemsize + len(layout_bytes) <= LAYOUT_SPACE
+
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.truncate(offset)
+        self.mm = np.memmap(tmp, mode='r+', dtype=np.uint8, shape=(offset,))
+        header = np.ndarray((), HEADER, self.mm, 0)
+        header['magic'], header['layout_size'] = MAGIC, len(layout_bytes)
+        self.mm[HEADER.itemsize:HEADER.itemsize + len(layout_bytes)] = \
+            np.frombuffer(layout_bytes, dtype=np.uint8)
+        self.seq = np.ndarray((), '<u8', self.mm, HEADER.fields['seq'][1])
+        self.scalars, self.fields = map_layout(self.mm, layout)
+        os.replace(tmp, path)
+
+        self.stream = self.pending = None
+        self.pinned = {}
+
+    def publish(self, fields, **scalars):
+        """
+        Start publishing ``fields`` and ``scalars``.
+        A publication that is still being copied is finished first.
+        """
+        self.flush()
+        if not any(hasattr(a, 'get') for a in fields.values()):
+            self.write(fields, scalars)
+            return
+        import cupy as cp
+
+        if self.stream is None:
+            self.stream = cp.cuda.Stream()
+            for name, view in self.fields.items():
+                memory = cp.cuda.alloc_pinned_memory(view.nbytes)
+                self.pinned[name] = np.frombuffer(
+                    memory, view.dtype, view.size
+                ).reshape(view.shape)
+        # The next step (or CUDA graph replay) is ordered with the current
+        # stream and may overwrite or free the fields, but not the snapshots
+        # made on it, which are kept until they are downloaded.
+        snapshots = {name: array.copy() for name, array in fields.items()
+                     if hasattr(array, 'get')}
+        self.stream.wait_event(cp.cuda.get_current_stream().record())
+        for name, array in fields.items():
+            if name in snapshots:
+                snapshots[name].get(stream=self.stream, out=self.pinned[name])
+            else:
+                self.pinned[name][...] = array
+        self.pending = self.stream.record(), scalars, snapshots
+
+    def poll(self):
+        """
+        Write the publication to the file if it has been copied from GPU.
+        """
+        if self.pending is not None and self.pending[0].done:
+            _, scalars, _ = self.pending
+            self.write(self.pinned, scalars)
+            self.pending = None
+
+    def flush(self):
+        """
+        Write the pending publication to the file, waiting for it if needed.
+        """
+        if self.pending is not None:
+            self.pending[0].synchronize()
+            self.poll()
+
+    def write(self, fields, scalars):
+        seq = int(self.seq)
+        self.seq[...] = seq + 1  # odd: being written
+        for name, value in scalars.items():
+            self.scalars[name][...] = value
+        for name, array in fields.items():
+            self.fields[name][...] = array
+        self.seq[...] = seq + 2  # even: consistent again
+
+
+def map_layout(mm, layout):
+    """
+    Map the scalars and the fields described by ``layout`` onto ``mm``.
+    Returns two dictionaries of 0-dimensional and full arrays.
+    """
+    scalar_names = layout['scalars']['names']
+    scalar_data = np.ndarray((len(scalar_names),), '<f8', mm,
+                             layout['scalars']['offset'])
+    scalars = {name: scalar_data[k:k + 1].reshape(())
+               for k, name in enumerate(scalar_names)}
+    fields = {name: np.ndarray(tuple(desc['shape']), '<f8', mm,
+                               desc['offset'])
+              for name, desc in layout['fields'].items()}
+    return scalars, fields
+
+
+class LiveReader:
+    """
+    Attach to the file published by ``LiveWriter``.
+    ``reader.fields`` and ``reader.scalars`` are zero-copy views,
+    check that ``reader.sequence()`` was even and stayed the same
+    while you were looking at them, or use ``reader.read()``,
+    which does that for you.
+    A new run replaces the file, ``reader.read()`` then reattaches.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.attach()
+
+    def attach(self):
+        self.inode = os.stat(self.path).st_ino
+        self.mm = np.memmap(self.path, mode='r', dtype=np.uint8)
+        header = np.ndarray((), HEADER, self.mm, 0)
+        if header['magic'] != MAGIC:
+            raise ValueError(f'{self.path} is not an LCODE live file')
+        start = HEADER.itemsize
+        self.layout = json.loads(
+            self.mm[start:start + int(header['layout_size'])].tobytes()
+        )
+        self.seq = np.ndarray((), '<u8', self.mm, HEADER.fields['seq'][1])
+        self.scalars, self.fields = map_layout(self.mm, self.layout)
+
+    def sequence(self):
+        return int(self.seq)
+
+    def read(self, timeout=1):
+        """
+        Copy out a consistent publication.
+        Returns the sequence counter (0 if nothing was published yet),
+        a dictionary of the scalars and a dictionary of the fields.
+        """
+        if os.stat(self.path).st_ino != self.inode:
+            self.attach()
+        deadline = time.monotonic() + timeout
+        while True:
+            seq = self.sequence()
+            if seq % 2 == 0:
+                scalars = {name: float(value)
+                           for name, value in self.scalars.items()}
+                fields = {name: view.copy()
+                          for name, view in self.fields.items()}
+                if self.sequence() == seq:
+                    return seq, scalars, fields
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{self.path} is being written too long')
+            time.sleep(.001)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('path', help='the live file, config.live_file')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='seconds between the checks')
+    args = parser.parse_args()
+
+    reader, last = LiveReader(args.path), None
+    try:
+        while True:
+            seq, scalars, fields = reader.read()
+            if seq and seq != last:
+                ranges = ' '.join(f'{name}=[{a.min():+.3e},{a.max():+.3e}]'
+                                  for name, a in fields.items())
+                values = ' '.join(f'{name}={value:+.4e}'
+                                  for name, value in scalars.items())
+                print(f'{values} {ranges}', flush=True)
+                last = seq
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
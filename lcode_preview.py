@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016-2019 LCODE team <team@lcode.info>.
+
+# LCODE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCODE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LCODE.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Preview LCODE 3D runs at a coarser resolution, abort the hopeless ones early
+and rerun the promising ones at full resolution.
+
+Usage: ``python lcode_preview.py config.py --param BOOST=1,2,4
+[--coarsen 4] [--max-peak-decay 10] [--max-zn 1]
+[--promote] [--promote-top 2] [--out preview]``.
+
+Every parameter combination is first run with the transverse and the
+longitudinal steps ``--coarsen`` times larger (so roughly ``coarsen ** 3``
+times faster) in ``preview/coarse/BOOST=1``.
+The preview is aborted as soon as the last Ez_00 peak is lower than the first
+one by more than ``--max-peak-decay`` percent or zn exceeds ``--max-zn``.
+With ``--promote``, the previews that have reached the end are rerun
+at full resolution in ``preview/BOOST=1``
+(only the ``--promote-top`` ones with the least peak decay, if specified).
+The preview outcomes are saved to ``preview/previews.json``.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import types
+
+from lcode_sweep import load_config, parse_param, run_dir_name
+
+
+def coarsen(config, factor, xi_factor=None):
+    """
+    Derive a config with the transverse step ``factor`` times larger
+    covering the same window, and the xi step ``xi_factor`` (``factor``
+    if not specified) times larger covering the same xi range.
+
+    The padding steps and the plasma coarseness and fineness are kept
+    as they are, so the particles get ``factor ** 2`` times heavier.
+    """
+    xi_factor = factor if xi_factor is None else xi_factor
+    coarse = types.SimpleNamespace(**{
+        name: value for name, value in vars(config).items()
+        if not name.startswith('_') and not isinstance(value, types.ModuleType)
+    })
+    coarse.grid_step_size = config.grid_step_size * factor
+    coarse.grid_steps = config.grid_steps // 2 // factor * 2 + 1
+    coarse.plasma_fineness_center_steps = \
+        config.plasma_fineness_center_steps // factor
+    if config.field_patch_steps is not None:
+        # the patch covers the same central region, if it is still wider
+        # than a couple of the coarser cells
+        refinement = config.field_patch_refinement
+        half_cells = config.field_patch_steps // 2 // refinement // factor
+        coarse.field_patch_steps = (2 * half_cells * refinement + 1
+                                    if half_cells > 1 else None)
+    coarse.xi_step_size = config.xi_step_size * xi_factor
+    coarse.xi_step_size_min = config.xi_step_size_min * xi_factor
+    coarse.xi_step_size_max = config.xi_step_size_max * xi_factor
+    coarse.xi_steps = config.xi_steps // xi_factor
+    coarse.tracked_particles = None  # the particles are different anyway
+    coarse.regrid = None  # the preview stays coarse all along
+    coarse.diagnostics_each_N_steps = max(
+        config.diagnostics_each_N_steps // xi_factor, 1
+    )
+    # the beam is only ever evaluated at the coarse xi steps
+    coarse.beam = lambda xi_i, x, y: config.beam(xi_i * xi_factor, x, y)
+    if config.beam_profile is not None:
+        coarse.beam_amplitude = \
+            lambda xi_i: config.beam_amplitude(xi_i * xi_factor)
+    if coarse.grid_steps <= 2 * config.plasma_padding_steps + 1:
+        raise ValueError(f'coarsening by {factor} leaves no room for plasma')
+    return coarse
+
+
+def preview(config, max_peak_decay=None, max_zn=None, out_dir='.', file=None):
+    """
+    Run the simulation like ``lcode.main`` does, but stop it
+    as soon as the last Ez_00 peak is lower than the first one
+    by more than ``max_peak_decay`` percent or zn exceeds ``max_zn``.
+    Returns a dictionary describing the outcome.
+    """
+    import cupy as cp
+    import lcode
+
+    center = config.grid_steps // 2
+    Ez_00_history, max_zn_seen, reason = [], 0, None
+    with cp.cuda.Device(config.gpu_index):  # for processing the results
+        for result in lcode.simulate(config, {'Ez': (center, center)},
+                                     out_dir=out_dir):
+            Ez_00_history.append(result.Ez)
+            zn_due = config.zn_each_N_steps and (
+                result.xi_i % config.zn_each_N_steps == 0
+            )
+            if zn_due:
+                zn, _ = lcode.diags_ro_noise(config, result.state.ro)
+                max_zn_seen = max(max_zn_seen, float(zn))
+
+            time_for_diags = result.xi_i % config.diagnostics_each_N_steps == 0
+            last_step = result.xi_i == config.xi_steps - 1
+            if time_for_diags or last_step:
+                max_zn_seen = lcode.diagnostics(result.state.ro, config,
+                                                result.xi_i, Ez_00_history,
+                                                max_zn_seen, out_dir, file)
+            if max_zn is not None and max_zn_seen > max_zn:
+                reason = f'zn={max_zn_seen:.3f} > {max_zn}'
+
+            peaks = lcode.diags_peaks(Ez_00_history)
+            peak_decay = 100 * (1 - peaks[-1] / peaks[0]) if peaks.size else 0.
+            if max_peak_decay is not None and peak_decay > max_peak_decay:
+                reason = f'peak decay {peak_decay:.2f}% > {max_peak_decay}%'
+
+            if reason is not None:
+                print(f'# aborted at xi={result.xi:+.4f}: {reason}',
+                      file=file, flush=True)
+                break
+
+    return {'status': 'done' if reason is None else 'aborted',
+            'reason': reason, 'xi': result.xi,
+            'peak_decay': peak_decay, 'max_zn': max_zn_seen}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('config', help='base config file, e.g., config.py')
+    parser.add_argument('--param', action='append', default=[],
+                        help='NAME=value1,value2,... (repeatable)')
+    parser.add_argument('--out', default='preview', help='output directory')
+    parser.add_argument('--coarsen', type=int, default=4,
+                        help='transverse step multiplier for the previews')
+    parser.add_argument('--coarsen-xi', type=int,
+                        help='xi step multiplier (default: --coarsen)')
+    parser.add_argument('--max-peak-decay', type=float,
+                        help='abort on Ez_00 peak decay larger than that, %%')
+    parser.add_argument('--max-zn', type=float,
+                        help='abort on zn larger than that')
+    parser.add_argument('--promote', action='store_true',
+                        help='rerun the completed previews at full resolution')
+    parser.add_argument('--promote-top', type=int,
+                        help='only promote that many with the least decay')
+    parser.add_argument('--gpu-index', type=int, default=0)
+    args = parser.parse_args()
+
+    import cupy as cp
+    import lcode
+
+    config_path = os.path.abspath(args.config)
+    names_values = [parse_param(param) for param in args.param]
+    names = [name for name, values in names_values]
+    grid = [dict(zip(names, values)) for values in
+            itertools.product(*[values for name, values in names_values])]
+
+    with cp.cuda.Device(args.gpu_index):
+        print(f'Kernels compiled or loaded in {lcode.precompile():.2f}s')
+
+    previews = []
+    for params in grid:
+        run_dir = os.path.join(args.out, 'coarse', run_dir_name(params))
+        os.makedirs(run_dir, exist_ok=True)
+        config = load_config(config_path, params)
+        config.gpu_index = args.gpu_index
+        coarse = coarsen(config, args.coarsen, args.coarsen_xi)
+        with open(os.path.join(run_dir, 'log.txt'), 'a') as log:
+            outcome = preview(coarse, args.max_peak_decay, args.max_zn,
+                              run_dir, log)
+        outcome['params'] = params
+        previews.append(outcome)
+        print(f'{outcome["status"]:>8} {run_dir_name(params)} '
+              f'xi={outcome["xi"]:+.2f} decay={outcome["peak_decay"]:+.2f}% '
+              f'zn={outcome["max_zn"]:.3f}')
+        sys.stdout.flush()
+
+    with open(os.path.join(args.out, 'previews.json'), 'w') as f:
+        json.dump(previews, f, indent=1)
+
+    if not args.promote:
+        return
+    promising = sorted((p for p in previews if p['status'] == 'done'),
+                       key=lambda p: p['peak_decay'])[:args.promote_top]
+    for outcome in promising:
+        run_dir = os.path.join(args.out, run_dir_name(outcome['params']))
+        os.makedirs(run_dir, exist_ok=True)
+        print(f'promoted {run_dir_name(outcome["params"])}')
+        sys.stdout.flush()
+        config = load_config(config_path, outcome['params'])
+        config.gpu_index = args.gpu_index
+        with open(os.path.join(run_dir, 'log.txt'), 'a') as log:
+            lcode.main(config, run_dir, log)
+        open(os.path.join(run_dir, 'done'), 'w').close()
+
+
+if __name__ == '__main__':
+    main()
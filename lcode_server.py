@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016-2019 LCODE team <team@lcode.info>.
+
+# LCODE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCODE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LCODE.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Run LCODE 3D simulations submitted over a local UNIX socket
+by a long-lived process that keeps everything warm.
+
+Usage: ``python lcode_server.py [--socket lcode.sock] [--gpu-index 0]``
+to start the server, ``python lcode_server.py --submit config.py
+[--out run] [--param BOOST=2] [--socket lcode.sock]`` to submit a job
+and follow its progress.
+
+The server compiles the kernels once on startup, and the solver matrices,
+FFT plans, plasma arrays and the ``cupy`` memory pool of one job
+are reused by the next ones with the same grids,
+so short jobs start almost instantly.
+The jobs are executed one by one in the order of submission.
+
+The protocol is JSON lines: the client sends a single
+``{"config": "/abs/config.py", "out": "/abs/run", "params": {"BOOST": 2}}``
+and receives ``{"status": "queued", "position": 1}``,
+``{"status": "running"}``, a ``{"log": "xi=-0.0100 ..."}`` per diagnostics
+line and, finally, ``{"status": "done"}``
+or ``{"status": "failed", "error": "Traceback ..."}``.
+The output directory gets the same ``log.txt`` and diagnostics files
+as a ``python lcode.py`` run in it.
+"""
+
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+from lcode_sweep import load_config, parse_param
+
+
+#: The default socket path.
+DEFAULT_SOCKET = 'lcode.sock'
+
+
+class StreamingLog:
+    """
+    A file-like object for ``lcode.main`` that appends the printed lines
+    to ``log`` and passes them to ``send`` as ``{"log": line}`` messages.
+    """
+    def __init__(self, log, send):
+        self.log, self.send, self.pending = log, send, ''
+
+    def write(self, text):
+        self.log.write(text)
+        *lines, self.pending = (self.pending + text).split('\n')
+        for line in lines:
+            self.send({'log': line})
+
+    def flush(self):
+        self.log.flush()
+
+
+def run_job(job, gpu_index, send):
+    """
+    Run the simulation described by ``job`` on the GPU ``gpu_index``,
+    passing the progress messages to ``send``.
+    """
+    import lcode
+
+    out_dir = job.get('out', '.')
+    os.makedirs(out_dir, exist_ok=True)
+    config = load_config(job['config'], job.get('params', {}))
+    config.gpu_index = gpu_index
+    with open(os.path.join(out_dir, 'log.txt'), 'a') as log:
+        print(f'# {json.dumps(job)}', file=log, flush=True)
+        lcode.main(config, out_dir, StreamingLog(log, send))
+
+
+def worker(jobs, gpu_index):
+    """
+    Execute the queued jobs one by one, forever.
+    The jobs come as ``(job, messages)`` pairs,
+    where ``messages`` is a queue of the progress messages for the client.
+    """
+    import cupy as cp
+
+    with cp.cuda.Device(gpu_index):
+        while True:
+            job, messages = jobs.get()
+            messages.put({'status': 'running'})
+            try:
+                run_job(job, gpu_index, messages.put)
+            except Exception:
+                messages.put({'status': 'failed',
+                              'error': traceback.format_exc()})
+            else:
+                messages.put({'status': 'done'})
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Accept a single job per connection, queue it
+    and stream its progress back until it finishes.
+    The job keeps running if the client disconnects.
+    """
+    def handle(self):
+        def send(message):
+            self.wfile.write(json.dumps(message).encode() + b'\n')
+            self.wfile.flush()
+
+        try:
+            job = json.loads(self.rfile.readline())
+            job['config'] = os.path.abspath(job['config'])
+            job['out'] = os.path.abspath(job.get('out', '.'))
+        except (ValueError, KeyError, TypeError) as e:
+            send({'status': 'failed', 'error': f'malformed job: {e}'})
+            return
+
+        messages = queue.Queue()
+        self.server.jobs.put((job, messages))
+        print(f'queued {job["config"]} -> {job["out"]}')
+        sys.stdout.flush()
+        message = {'status': 'queued', 'position': self.server.jobs.qsize()}
+        while True:
+            try:
+                send(message)
+            except OSError:
+                pass  # the client is gone, but the job is not
+            if message.get('status') in ('done', 'failed'):
+                print(f'{message["status"]:>8} {job["out"]}')
+                sys.stdout.flush()
+                return
+            message = messages.get()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, jobs):
+        self.jobs = jobs
+        super().__init__(socket_path, JobHandler)
+
+
+def serve(socket_path, gpu_index):
+    """
+    Serve the jobs submitted to ``socket_path`` until interrupted.
+    """
+    import cupy as cp
+    import lcode
+
+    with cp.cuda.Device(gpu_index):
+        print(f'Kernels compiled or loaded in {lcode.precompile():.2f}s')
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)  # left behind by a dead server
+    jobs = queue.Queue()
+    threading.Thread(target=worker, args=(jobs, gpu_index),
+                     daemon=True).start()
+    # the configs are Python code executed by the server, keep it private
+    old_umask = os.umask(0o177)
+    try:
+        server = Server(socket_path, jobs)
+    finally:
+        os.umask(old_umask)
+    print(f'Listening on {socket_path}')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def submit(socket_path, job, file=None):
+    """
+    Submit ``job`` to the server at ``socket_path``
+    and print its progress to ``file`` (``sys.stdout`` if not specified).
+    Returns the final status message.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(job).encode() + b'\n')
+        for line in sock.makefile():
+            message = json.loads(line)
+            if 'log' in message:
+                print(message['log'], file=file, flush=True)
+            elif message['status'] == 'queued':
+                print(f'# queued at position {message["position"]}',
+                      file=file, flush=True)
+            elif message['status'] == 'failed':
+                print(message['error'], file=file, flush=True)
+                return message
+            elif message['status'] == 'done':
+                return message
+    return {'status': 'failed', 'error': 'connection closed by the server'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--gpu-index', type=int, default=0)
+    parser.add_argument('--submit', metavar='CONFIG',
+                        help='submit a config file to a running server')
+    parser.add_argument('--out', default='.',
+                        help='output directory of the submitted job')
+    parser.add_argument('--param', action='append', default=[],
+                        help='NAME=value override (repeatable)')
+    args = parser.parse_args()
+
+    if args.submit is None:
+        serve(args.socket, args.gpu_index)
+        return
+
+    params = {}
+    for param in args.param:
+        name, (value,) = parse_param(param)
+        params[name] = value
+    job = {'config': os.path.abspath(args.submit),
+           'out': os.path.abspath(args.out), 'params': params}
+    status = submit(args.socket, job)
+    sys.exit(0 if status['status'] == 'done' else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2016-2019 LCODE team <team@lcode.info>.
+
+# LCODE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCODE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LCODE.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Run LCODE 3D for every combination of the config parameter values.
+
+Usage: ``python lcode_sweep.py config.py --param BOOST=1,2,4
+--param SIGMA=.5,1 [--out sweep] [--runs-per-gpu 1] [--retries 1]``.
+
+Every run gets its own output directory (``sweep/BOOST=1,SIGMA=0.5``)
+with a ``log.txt`` and a ``done`` marker, runs marked as done are skipped,
+so rerunning the same command resumes an interrupted sweep.
+
+With ``--batch-size K`` the runs are advanced K at a time in lockstep
+(see ``lcode.main_batch``), which only works if the scanned parameters
+do not affect the grids, that is, only the beam.
+
+With ``--cache DIR`` the runs identical to the ones made before
+(by this or any other sweep sharing the cache) are reproduced
+from the cache instead (see ``lcode_cache``).
+The batched runs are only looked up there, not stored.
+"""
+
+import argparse
+import ast
+import contextlib
+import importlib.util
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+
+
+def load_config(config_path, params):
+    """
+    Import ``config_path`` as a fresh module, override its attributes
+    with ``params`` and fill in the options it predates
+    (see ``lcode.fill_config_defaults``). Functions defined in the config,
+    like ``beam``, see the overridden values, but the values derived
+    from the overridden ones at import time (like ``xi_steps``)
+    have to be overridden explicitly.
+    """
+    import lcode
+
+    spec = importlib.util.spec_from_file_location('config', config_path)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    for name, value in params.items():
+        if not hasattr(config, name) and name not in lcode.CONFIG_DEFAULTS:
+            raise AttributeError(f'{config_path} does not define {name}')
+        setattr(config, name, value)
+    return lcode.fill_config_defaults(config)
+
+
+def parse_param(param):
+    """
+    Parse ``NAME=value1,value2,...`` into a name and a list of values.
+    """
+    name, values = param.split('=', 1)
+    values = ast.literal_eval(f'[{values}]')
+    return name.strip(), values
+
+
+def run_dir_name(params):
+    return ','.join(f'{name}={value}' for name, value in params.items())
+
+
+#: The GPU assigned to this worker process, see ``init_worker``.
+worker_gpu_index = None
+
+
+def init_worker(gpu_indices):
+    """
+    Pick a GPU for the worker process from the queue of available ones.
+    The worker processes live for the whole sweep,
+    so compiled kernels, memoized solver matrices and FFT plans
+    are reused by all the runs they execute.
+    """
+    global worker_gpu_index
+    worker_gpu_index = gpu_indices.get()
+
+
+def run_task(task):
+    return run_batch(*task)
+
+
+def run_one(config_path, params, run_dir, cache=None):
+    """
+    Run a single simulation in ``run_dir``, through the cache
+    if ``cache`` (a cache directory and a size limit) is specified.
+    """
+    import lcode
+    import lcode_cache
+
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    try:
+        with open('log.txt', 'a') as log, contextlib.redirect_stdout(log):
+            config = load_config(config_path, params)
+            config.gpu_index = worker_gpu_index
+            if cache is None:
+                lcode.main(config)
+            else:
+                lcode_cache.cached_main(config, '.', None, *cache)
+    finally:
+        os.chdir(cwd)
+
+
+def run_batch(config_path, params_list, run_dirs, retries, cache=None):
+    """
+    Run the simulations with ``params_list`` in the corresponding ``run_dirs``
+    (as a batch, if there are several of them),
+    retrying up to ``retries`` times.
+    If ``cache`` (a cache directory and a size limit) is specified,
+    the cached runs are reproduced from it instead.
+    Returns the run directories and their final status.
+    """
+    import lcode
+    import lcode_cache
+
+    todo = []
+    for params, run_dir in zip(params_list, run_dirs):
+        os.makedirs(run_dir, exist_ok=True)
+        if not os.path.exists(os.path.join(run_dir, 'done')):
+            with open(os.path.join(run_dir, 'params.json'), 'w') as f:
+                json.dump(params, f)
+            todo.append((params, run_dir))
+    if cache is not None and len(todo) > 1:  # single runs go through run_one
+        for params, run_dir in list(todo):
+            with open(os.path.join(run_dir, 'log.txt'), 'a') as log:
+                try:
+                    found = lcode_cache.fetch(load_config(config_path, params),
+                                              run_dir, log, cache[0])
+                except Exception:
+                    # the attempts below fail the run if it is its config
+                    traceback.print_exc(file=log)
+                    continue
+            if found:
+                open(os.path.join(run_dir, 'done'), 'w').close()
+                todo.remove((params, run_dir))
+    if not todo:
+        return run_dirs, 'skipped'
+    params_list, run_dirs = zip(*todo)
+
+    for attempt in range(retries + 1):
+        for run_dir in run_dirs:
+            with open(os.path.join(run_dir, 'log.txt'), 'a') as log:
+                print(f'# attempt {attempt + 1}, GPU {worker_gpu_index}',
+                      file=log)
+        try:
+            if len(run_dirs) == 1:
+                run_one(config_path, params_list[0], run_dirs[0], cache)
+            else:
+                configs = [load_config(config_path, params)
+                           for params in params_list]
+                for config in configs:
+                    config.gpu_index = worker_gpu_index
+                lcode.main_batch(configs, run_dirs)
+        except Exception:
+            for run_dir in run_dirs:
+                with open(os.path.join(run_dir, 'log.txt'), 'a') as log:
+                    traceback.print_exc(file=log)
+            continue
+        for run_dir in run_dirs:
+            open(os.path.join(run_dir, 'done'), 'w').close()
+        return run_dirs, 'done'
+    return run_dirs, 'failed'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('config', help='base config file, e.g., config.py')
+    parser.add_argument('--param', action='append', default=[],
+                        help='NAME=value1,value2,... (repeatable)')
+    parser.add_argument('--out', default='sweep', help='output directory')
+    parser.add_argument('--gpu-indices', type=int, nargs='+',
+                        help='GPUs to use (default: all of them)')
+    parser.add_argument('--runs-per-gpu', type=int, default=1)
+    parser.add_argument('--retries', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--cache', help='reuse the identical runs from there')
+    parser.add_argument('--cache-max-size', default='10G',
+                        help='cache size limit, e.g., 10G')
+    args = parser.parse_args()
+
+    config_path = os.path.abspath(args.config)
+    names_values = [parse_param(param) for param in args.param]
+    names = [name for name, values in names_values]
+    grid = [dict(zip(names, values)) for values in
+            itertools.product(*[values for name, values in names_values])]
+
+    gpu_indices = args.gpu_indices
+    if gpu_indices is None:
+        import cupy as cp
+        gpu_indices = list(range(cp.cuda.runtime.getDeviceCount()))
+    processes = len(gpu_indices) * args.runs_per_gpu
+
+    # CUDA does not survive forking, so the workers are spawned.
+    context = multiprocessing.get_context('spawn')
+    gpu_queue = context.Queue()
+    for gpu_index in gpu_indices * args.runs_per_gpu:
+        gpu_queue.put(gpu_index)
+
+    run_dirs = [os.path.abspath(os.path.join(args.out, run_dir_name(params)))
+                for params in grid]
+    cache = None
+    if args.cache is not None:
+        import lcode_cache
+        cache = (os.path.abspath(args.cache),
+                 lcode_cache.parse_size(args.cache_max_size))
+    tasks = [(config_path, grid[i:i + args.batch_size],
+              run_dirs[i:i + args.batch_size], args.retries, cache)
+             for i in range(0, len(grid), args.batch_size)]
+    failed = 0
+    with context.Pool(processes, init_worker, (gpu_queue,)) as pool:
+        for batch_run_dirs, status in pool.imap_unordered(run_task, tasks):
+            for run_dir in batch_run_dirs:
+                print(f'{status:>8} {run_dir}')
+                failed += status == 'failed'
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
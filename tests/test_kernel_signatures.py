@@ -0,0 +1,112 @@
+import ast
+import pathlib
+import types
+
+import numpy as np
+import pytest
+
+numba = pytest.importorskip('numba')
+
+LCODE = pathlib.Path(__file__).parent.parent / 'lcode.py'
+
+
+def precompiled_signatures():
+    """
+    The ``(kernel name, signature)`` pairs ``precompile`` compiles,
+    with the signatures evaluated from the ``lcode.py`` source,
+    which does not need ``cupy`` (or a GPU) to be importable.
+    """
+    tree = ast.parse(LCODE.read_text())
+    namespace = {'numba': numba}
+    functions = {}
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            functions[node.name] = node
+        elif isinstance(node, ast.Assign):
+            names = [target.id for target in ast.walk(node.targets[0])
+                     if isinstance(target, ast.Name)]
+            if all(name.startswith(('_i8', '_f8')) or
+                   name.endswith('_SIGNATURE') for name in names):
+                exec(compile(ast.Module([node], []), str(LCODE), 'exec'),
+                     namespace)
+    pairs = []
+    for call in ast.walk(functions['precompile']):
+        if isinstance(call, ast.Call) and getattr(call.func, 'attr',
+                                                  None) == 'compile':
+            kernel, signature = call.func.value.id, call.args[0].id
+            pairs.append((functions[kernel], namespace[signature]))
+    return pairs
+
+
+@pytest.mark.parametrize('kernel, signature', precompiled_signatures(),
+                         ids=lambda pair: getattr(pair, 'name', ''))
+def test_signature_arity(kernel, signature):
+    assert len(signature) == len(kernel.args.args)
+
+
+def matches(value, numba_type):
+    """Whether launching with ``value`` would use the ``numba_type`` one."""
+    if isinstance(numba_type, numba.types.Array):
+        return (value.dtype == np.dtype(str(numba_type.dtype)) and
+                value.ndim == numba_type.ndim and
+                (numba_type.layout != 'C' or value.flags.c_contiguous))
+    return numba.typeof(value) == numba_type
+
+
+class RecordingKernel:
+    """Wraps a CUDA kernel to record the arguments it is launched with."""
+
+    def __init__(self, kernel):
+        self.kernel, self.launches = kernel, []
+
+    def __getitem__(self, launch_config):
+        def launch(*args):
+            self.launches.append(args)
+            return self.kernel[launch_config](*args)
+        return launch
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'fused_push_deposit': True},
+    {'field_patch_steps': 17, 'field_patch_refinement': 2},
+], ids=['default', 'fused', 'patch'])
+def test_signature_matches_launch(monkeypatch, options):
+    lcode = pytest.importorskip('lcode')
+    import config_example
+    config = types.SimpleNamespace(**{
+        name: value for name, value in vars(config_example).items()
+        if not name.startswith('__')
+    })
+    config.grid_steps, config.grid_step_size = 41, .1
+    config.plasma_padding_steps, config.autotune = 7, False
+    vars(config).update(options)
+
+    signatures = {
+        'deposit_kernel': lcode.DEPOSIT_KERNEL_SIGNATURE,
+        'deposit_patch_kernel': lcode.DEPOSIT_KERNEL_SIGNATURE,
+        'move_smart_kernel': lcode.MOVE_SMART_KERNEL_SIGNATURE,
+        'move_deposit_kernel': lcode.MOVE_DEPOSIT_KERNEL_SIGNATURE,
+    }
+    kernels = {name: RecordingKernel(getattr(lcode, name))
+               for name in signatures}
+    for name, kernel in kernels.items():
+        monkeypatch.setattr(lcode, name, kernel)
+
+    xs, ys, const, virt_params, state = lcode.init(config)
+    patch_beam_ro = None
+    if config.field_patch_steps is not None:
+        patch_xs = lcode.patch_grid(config)
+        patch_beam_ro = config.beam(30, patch_xs[:, None], patch_xs[None, :])
+    lcode.step(config, const, virt_params, state, config.beam(30, xs, ys),
+               patch_beam_ro=patch_beam_ro)
+
+    launched = 0
+    for name, kernel in kernels.items():
+        for args in kernel.launches:
+            launched += 1
+            assert len(args) == len(signatures[name])
+            for i, (value, numba_type) in enumerate(zip(args,
+                                                        signatures[name])):
+                assert matches(value, numba_type), (name, i, numba_type)
+    assert launched